@@ -0,0 +1,17 @@
+from modelus import *
+
+class Child(Model):
+    id = Field(String, primary_key=True)
+    value = Field(String)
+
+class Parent(Model):
+    id = Field(String, primary_key=True)
+    keys = Field(List(ForeignKey(Child, cascade=True)))
+
+class Document(Model):
+    id = Field(String, primary_key=True)
+    name = Field(String, required=True, maxlength=1024)
+    email = Field(EmailAddress)
+    count = Field(Integer, min=0)
+    created = Field(DateTime, default_setter='utcnow')
+    tags = Field(List(String))
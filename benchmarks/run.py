@@ -0,0 +1,419 @@
+'''Benchmarks models, validation and the database backends.
+
+Run from the root of the repository:
+
+    $ python -m benchmarks.run --backend memory fakeredis fakeredis-blob --count 100 1000 --size 1 10 --output results.json
+    $ python -m benchmarks.run --compare results.json
+
+count is the number of models each benchmark operates on, size is the length of string and list values.
+The sqlite backend uses --sqlite-path, which is deleted before each run.
+The -blob backends store the models with RedisDatabase's blob_models.
+The redis backends use --redis-url, or REDIS_URL, and flush the database before each run.
+sharded-redis uses --redis-shard-urls, or REDIS_SHARD_URLS, a server per shard, ie. several local redis-server processes.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from statistics import median
+from threading import Thread
+from time import perf_counter
+from .models import Child, Parent, Document
+
+
+BACKENDS = {}
+def backend(name):
+    '''Registers a function which returns an empty database, or raises an exception if it's unavailable.
+    '''
+    def decorator(fn):
+        BACKENDS[name] = fn
+        return fn
+    return decorator
+
+BENCHMARKS = {}
+def benchmark(name):
+    '''Registers a function of (db, count, size) which prepares the database
+    and returns the function to be timed.
+    '''
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+
+@backend('memory')
+def memory(args):
+    from modelus.backends.memory import MemoryDatabase
+    return MemoryDatabase()
+
+@backend('fakeredis')
+def fakeredis(args):
+    from fakeredis import FakeRedis
+    from modelus.backends.redis import RedisDatabase
+    return RedisDatabase(FakeRedis())
+
+@backend('fakeredis-blob')
+def fakeredis_blob(args):
+    from fakeredis import FakeRedis
+    from modelus.backends.redis import RedisDatabase
+    return RedisDatabase(FakeRedis(), blob_models=[Child, Parent, Document])
+
+@backend('concurrent-memory')
+def concurrent_memory(args):
+    from modelus.backends.memory import ConcurrentMemoryDatabase
+    return ConcurrentMemoryDatabase()
+
+@backend('sharded-fakeredis')
+def sharded_fakeredis(args):
+    from fakeredis import FakeRedis, FakeServer
+    from modelus.backends.redis import RedisDatabase
+    from modelus.backends.sharded import ShardedDatabase
+    return ShardedDatabase([RedisDatabase(FakeRedis(server=FakeServer())) for _ in range(args.shards)])
+
+@backend('sharded-redis')
+def sharded_redis(args):
+    from redis import Redis
+    from modelus.backends.redis import RedisDatabase
+    from modelus.backends.sharded import ShardedDatabase
+    clients = [Redis.from_url(url) for url in args.redis_shard_urls.split(',')]
+    for client in clients:
+        client.flushdb()
+    return ShardedDatabase([RedisDatabase(client) for client in clients])
+
+@backend('sqlite')
+def sqlite(args):
+    from modelus.backends.sqlite import SQLiteDatabase
+    # each run starts with a new database file
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(args.sqlite_path + suffix):
+            os.remove(args.sqlite_path + suffix)
+    return SQLiteDatabase(args.sqlite_path)
+
+@backend('redis')
+def redis(args):
+    from redis import Redis
+    from modelus.backends.redis import RedisDatabase
+    client = Redis.from_url(args.redis_url)
+    client.flushdb()
+    return RedisDatabase(client)
+
+@backend('redis-blob')
+def redis_blob(args):
+    from redis import Redis
+    from modelus.backends.redis import RedisDatabase
+    client = Redis.from_url(args.redis_url)
+    client.flushdb()
+    return RedisDatabase(client, blob_models=[Child, Parent, Document])
+
+
+def children(db, count, size):
+    return [Child(db, id=str(index), value='a' * size) for index in range(count)]
+
+def parents(db, count, size):
+    '''Creates count parents, each with size children.
+    '''
+    models = children(db, count * size, size)
+    db.save_many(models)
+    parents = [Parent(db, id=str(index), keys=models[index * size:(index + 1) * size]) for index in range(count)]
+    db.save_many(parents)
+    return parents
+
+@benchmark('construct')
+def construct(db, count, size):
+    def run():
+        for index in range(count):
+            Document(db, id=str(index), name='a' * size, count=index, tags=['a'] * size)
+    return run
+
+@benchmark('validate')
+def validate(db, count, size):
+    models = [Document(db, id=str(index), name='a' * size, email='a@example.com', count=index, tags=['a'] * size) for index in range(count)]
+    def run():
+        for model in models:
+            model.data
+    return run
+
+@benchmark('access')
+def access(db, count, size):
+    models = [Document(db, id=str(index), name='a' * size, count=index, tags=['a'] * size) for index in range(count)]
+    def run():
+        # containers are read once per item, as in a nested loop
+        for model in models:
+            for index in range(size):
+                model.tags[index]
+                model.name
+    return run
+
+@benchmark('create')
+def create(db, count, size):
+    def run():
+        for index in range(count):
+            db.create(Child, id=str(index), value='a' * size)
+    return run
+
+@benchmark('load')
+def load(db, count, size):
+    db.save_many(children(db, count, size))
+    def run():
+        for index in range(count):
+            db.load(Child, str(index))
+    return run
+
+@benchmark('load_data')
+def load_data(db, count, size):
+    db.save_many([Document(db, id=str(index), name='a' * size, email='a@example.com', count=index, tags=['a'] * size) for index in range(count)])
+    keys = [str(index) for index in range(count)]
+    def run():
+        # loaded models are only validated if they have changed
+        for model in db.load_many(Document, keys):
+            model.data
+    return run
+
+@benchmark('load_many')
+def load_many(db, count, size):
+    db.save_many(children(db, count, size))
+    keys = [str(index) for index in range(count)]
+    def run():
+        db.load_many(Child, keys)
+    return run
+
+@benchmark('save')
+def save(db, count, size):
+    models = children(db, count, size)
+    db.save_many(models)
+    def run():
+        for model in models:
+            model.value = 'b' * size
+            db.save(model)
+    return run
+
+@benchmark('save_partial')
+def save_partial(db, count, size):
+    models = children(db, count, size)
+    db.save_many(models)
+    def run():
+        for model in models:
+            model.value = 'b' * size
+            db.save(model, partial=True)
+    return run
+
+@benchmark('save_many')
+def save_many(db, count, size):
+    models = children(db, count, size)
+    def run():
+        db.save_many(models)
+    return run
+
+@benchmark('increment')
+def increment(db, count, size):
+    models = [Document(db, id=str(index), name='a' * size, count=index, tags=['a'] * size) for index in range(count)]
+    db.save_many(models)
+    def run():
+        for model in models:
+            db.increment(model, 'count')
+    return run
+
+@benchmark('increment_load_save')
+def increment_load_save(db, count, size):
+    # the read-modify-write which increment replaces
+    db.save_many([Document(db, id=str(index), name='a' * size, count=index, tags=['a'] * size) for index in range(count)])
+    def run():
+        for index in range(count):
+            model = db.load(Document, str(index))
+            model.count += 1
+            db.save(model)
+    return run
+
+@benchmark('append')
+def append(db, count, size):
+    models = [Document(db, id=str(index), name='a' * size, count=index, tags=['a'] * size) for index in range(count)]
+    db.save_many(models)
+    def run():
+        for model in models:
+            db.append(model, 'tags', 'b')
+    return run
+
+@benchmark('delete')
+def delete(db, count, size):
+    db.save_many(children(db, count, size))
+    def run():
+        for index in range(count):
+            db.delete_key(Child, str(index))
+    return run
+
+@benchmark('dereference')
+def dereference(db, count, size):
+    parents(db, count, size)
+    keys = [str(index) for index in range(count)]
+    def run():
+        # each foreign key is loaded as it is accessed
+        for parent in db.load_many(Parent, keys):
+            [child.value for child in parent.keys]
+    return run
+
+@benchmark('prefetch')
+def prefetch(db, count, size):
+    parents(db, count, size)
+    keys = [str(index) for index in range(count)]
+    def run():
+        for parent in db.load_many(Parent, keys, prefetch='keys'):
+            [child.value for child in parent.keys]
+    return run
+
+@benchmark('cascade_delete')
+def cascade_delete(db, count, size):
+    models = [db.load(Parent, parent.id) for parent in parents(db, count, size)]
+    def run():
+        db.delete_many(models)
+    return run
+
+
+def run_threads(threads, work):
+    '''Calls work(thread) in each thread, returning once they have all finished.
+    '''
+    pool = [Thread(target=work, args=(thread,)) for thread in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+def parallel_validate(workers):
+    def prepare(db, count, size):
+        from modelus.validation import validate_many
+        documents = [dict(id=str(index), name='a' * size, email='a@example.com', count=index, tags=['a'] * size) for index in range(count)]
+        def run():
+            # includes starting the worker processes
+            validate_many(Document, documents, workers=workers)
+        return run
+    return prepare
+
+def threaded_load(threads):
+    def prepare(db, count, size):
+        db.save_many(children(db, count, size))
+        keys = [str(index) for index in range(count)]
+        def run():
+            run_threads(threads, lambda thread: [db.load(Child, key) for key in keys[thread::threads]])
+        return run
+    return prepare
+
+def threaded_save(threads):
+    def prepare(db, count, size):
+        models = children(db, count, size)
+        def run():
+            run_threads(threads, lambda thread: [db.save(model) for model in models[thread::threads]])
+        return run
+    return prepare
+
+# the same work split between a number of threads, only backends which are thread-safe should be used
+for threads in [1, 2, 4, 8]:
+    benchmark(f'load_threads_{threads}')(threaded_load(threads))
+    benchmark(f'save_threads_{threads}')(threaded_save(threads))
+for workers in [1, 2, 4]:
+    benchmark(f'validate_workers_{workers}')(parallel_validate(workers))
+
+
+def measure(args, backend, benchmark, count, size):
+    timings = []
+    for _ in range(args.repeat):
+        # each repetition starts with an empty database
+        db = BACKENDS[backend](args)
+        run = BENCHMARKS[benchmark](db, count, size)
+        start = perf_counter()
+        run()
+        timings.append(perf_counter() - start)
+        close = getattr(db, 'close', None)
+        if close is not None:
+            close()
+    return {
+        'backend': backend,
+        'benchmark': benchmark,
+        'count': count,
+        'size': size,
+        'repeat': args.repeat,
+        'min': min(timings),
+        'median': median(timings),
+        'ops_per_second': count / min(timings) if min(timings) else None,
+    }
+
+def available(args, name):
+    try:
+        db = BACKENDS[name](args)
+    except Exception as e:
+        # the package isn't installed or the server can't be reached
+        print(f'Skipping {name}: {e}', file=sys.stderr)
+        return False
+    close = getattr(db, 'close', None)
+    if close is not None:
+        close()
+    return True
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def key(result):
+    return (result['backend'], result['benchmark'], result['count'], result['size'])
+
+def report(results, baseline):
+    previous = {key(result): result for result in baseline['results']} if baseline else {}
+    print(f'{"backend":<18} {"benchmark":<20} {"count":>8} {"size":>6} {"median (s)":>12} {"ops/s":>12} {"change":>8}')
+    for result in results:
+        change = ''
+        if key(result) in previous:
+            change = f'{result["median"] / previous[key(result)]["median"] - 1.:+.1%}'
+        ops = f'{result["ops_per_second"]:.0f}' if result['ops_per_second'] else '-'
+        print(f'{result["backend"]:<18} {result["benchmark"]:<20} {result["count"]:>8} {result["size"]:>6} {result["median"]:>12.6f} {ops:>12} {change:>8}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark modelus models and backends')
+    parser.add_argument('--backend', nargs='+', choices=list(BACKENDS), default=['memory', 'fakeredis'])
+    parser.add_argument('--benchmark', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--count', nargs='+', type=int, default=[1000], help='number of models per benchmark')
+    parser.add_argument('--size', nargs='+', type=int, default=[10], help='length of string and list values')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+    parser.add_argument('--redis-shard-urls', default=os.environ.get('REDIS_SHARD_URLS', 'redis://localhost:6379/0,redis://localhost:6380/0'),
+        help='comma separated urls of the redis servers used by sharded-redis')
+    parser.add_argument('--shards', type=int, default=4, help='the number of shards used by sharded-fakeredis')
+    parser.add_argument('--sqlite-path', default=os.path.join(tempfile.gettempdir(), 'modelus-benchmark.db'),
+        help='the file the sqlite backend uses, it is replaced before each run')
+    parser.add_argument('--output', help='write the results as JSON to this file, - writes to stdout')
+    parser.add_argument('--compare', help='a previous JSON output to compare the results against')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = []
+    for backend in args.backend:
+        if not available(args, backend):
+            continue
+        for benchmark in args.benchmark:
+            for count in args.count:
+                for size in args.size:
+                    results.append(measure(args, backend, benchmark, count, size))
+
+    output = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(output, sys.stdout, indent=2)
+    else:
+        report(results, baseline)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(output, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+from .database import BaseDatabase
+
+class AsyncDatabase(BaseDatabase):
+    '''The asyncio equivalent of Database, every operation is a coroutine.
+    Backends must implement load_documents, save_many and delete_keys.
+
+    Foreign keys can't be loaded when the field is accessed,
+    they must be loaded with prefetch or resolve first.
+
+    >>> modela = await db.load(ModelA, 'a', prefetch='keys')
+    >>> modela.keys[0].value
+    >>> keys = await db.resolve(modela, 'keys')
+    '''
+    asynchronous = True
+
+    async def create(self, cls, **values):
+        obj = cls(self, **values)
+        await self.save(obj)
+        return obj
+
+    async def load(self, cls, id, prefetch=None):
+        return (await self.load_many(cls, [id], prefetch=prefetch))[0]
+
+    async def load_many(self, cls, ids, ignore_missing=False, prefetch=None):
+        documents = await self.load_documents(cls, ids)
+        objs = [self._hydrate(cls, document) if document is not None else None for document in documents]
+        self._missing(cls, ids, objs, ignore_missing)
+        if prefetch:
+            await self.prefetch([obj for obj in objs if obj is not None], prefetch)
+        return objs
+
+    async def load_documents(self, cls, ids):
+        raise NotImplementedError
+
+    async def prefetch(self, objs, paths):
+        await self._prefetch(objs, self._prefetch_tree(paths))
+
+    async def _prefetch(self, objs, tree):
+        for name, children in tree.items():
+            loaded = {}
+            for target, ids in self._prefetch_keys(objs, name).items():
+                for key, model in zip(ids, await self.load_many(target, ids, ignore_missing=True)):
+                    if model is not None:
+                        loaded[(target, key)] = model
+
+            related = self._prefetch_resolve(objs, name, loaded)
+            if children:
+                await self._prefetch(related, children)
+
+    async def resolve(self, obj, field):
+        '''Loads the foreign keys of the field and returns its value.
+        '''
+        await self.prefetch([obj], field)
+        return getattr(obj, field)
+
+    async def save(self, obj, partial=False, validate=True):
+        await self.save_many([obj], partial=partial, validate=validate)
+
+    async def save_many(self, objs, partial=False, validate=True, workers=None, executor=None):
+        raise NotImplementedError
+
+    async def update_key(self, cls, id, field, operation, *values):
+        '''See Database.update_key.
+        '''
+        raise NotImplementedError
+
+    async def _update(self, obj, field, operation, values):
+        value = await self.update_key(obj.__class__, obj.primary_key, field, operation, *values)
+        return self._update_model(obj, field, operation, values, value)
+
+    async def increment(self, obj, field, amount=1):
+        return await self._update(obj, field, 'increment', [amount])
+
+    async def append(self, obj, field, *values):
+        await self._update(obj, field, 'append', values)
+
+    async def remove(self, obj, field, *values):
+        await self._update(obj, field, 'remove', values)
+
+    async def add(self, obj, field, *values):
+        await self._update(obj, field, 'add', values)
+
+    async def discard(self, obj, field, *values):
+        await self._update(obj, field, 'discard', values)
+
+    async def delete_key(self, cls, id):
+        await self.delete_keys(cls, [id])
+
+    async def delete_keys(self, cls, ids):
+        raise NotImplementedError
+
+    async def delete_keys_many(self, keys):
+        for cls, ids in keys.items():
+            await self.delete_keys(cls, ids)
+
+    async def delete(self, obj):
+        await self.delete_many([obj])
+
+    async def delete_many(self, objs):
+        '''Deletes the models, following any foreign keys with cascade set.
+        Each level of foreign keys is loaded with a single load per model.
+        '''
+        keys = {}
+        visited = set()
+        pending = list(objs)
+        while pending:
+            level = self._cascade_level(pending, visited, keys)
+            pending = []
+            for field, cascading in self._cascade_fields(level).items():
+                await self.prefetch(cascading, field)
+                pending.extend(self._cascade_children(cascading, field))
+
+        await self.delete_keys_many(keys)
+
+    async def referrers(self, obj, cls=None, field=None):
+        referrers = {}
+        for model, name in self._referring_fields(obj.__class__, cls, field):
+            for referrer in await self.find(model, **{name: obj.primary_key}):
+                referrers[(model, referrer.primary_key)] = referrer
+        return list(referrers.values())
+
+    async def find(self, cls, **equals):
+        return await self.load_many(cls, await self.find_keys(cls, **equals))
+
+    async def find_one(self, cls, **equals):
+        keys = await self.find_keys(cls, **equals)
+        return await self.load(cls, keys[0]) if keys else None
+
+    async def find_keys(self, cls, **equals):
+        raise NotImplementedError
+
+    async def range(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None, batch_size=100):
+        '''An asynchronous iterator of the models.
+        '''
+        keys = await self.range_keys(cls, field, min, max, descending, offset, limit)
+        for index in range(0, len(keys), batch_size):
+            for obj in await self.load_many(cls, keys[index:index + batch_size], ignore_missing=True):
+                if obj is not None:
+                    yield obj
+
+    async def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        raise NotImplementedError
+
+    async def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        '''See Database.range_items.
+        '''
+        keys = await self.range_keys(cls, field, min, max, descending, offset, limit)
+        return [(document[field], key) for key, document in zip(keys, await self.load_documents(cls, keys)) if document is not None]
+
+    async def iterate(self, cls, batch_size=100, raw=False):
+        '''An asynchronous iterator of every instance of the model.
+        '''
+        async for keys in self.scan_keys(cls, batch_size):
+            if raw:
+                documents = await self.load_documents(cls, keys)
+            else:
+                documents = await self.load_many(cls, keys, ignore_missing=True)
+            for document in documents:
+                if document is not None:
+                    yield document
+
+    def scan_keys(self, cls, batch_size=100):
+        '''An asynchronous iterator of lists of primary keys, backends implement this as an async generator.
+        '''
+        raise NotImplementedError
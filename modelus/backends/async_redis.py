@@ -0,0 +1,176 @@
+import asyncio
+from itertools import islice
+from cerberedis import CerbeRedis
+from modelus.fields import rules
+from .async_database import AsyncDatabase
+from .redis import RedisLayout, NoScriptError, WatchError, UPDATE_SCRIPT, UPDATE_SHA
+
+class AsyncRedisDatabase(RedisLayout, AsyncDatabase):
+    '''Asynchronous redis backend using a redis.asyncio client.
+    Uses the same layout as RedisDatabase, so both can be used with the same data.
+
+    Loads which are made concurrently, ie. from tasks run with asyncio.gather,
+    are sent to redis in a single pipeline.
+
+    >>> from redis.asyncio import Redis
+    >>> db = AsyncRedisDatabase(Redis())
+    >>> modelas = await asyncio.gather(*[db.load(ModelA, id) for id in ids])
+
+    blob_models is a list of models to store as a single msgpack encoded string, see RedisDatabase.
+    '''
+    def __init__(self, redis, blob_models=None):
+        self.redis = redis
+        self.db = CerbeRedis(self.redis, rules())
+        self._set_blob_models(blob_models)
+        # loads waiting to be sent, a list of (cls, ids, future)
+        self._pending = []
+        # asyncio only keeps weak references to tasks, so the tasks sending the loads are kept until they finish
+        self._tasks = set()
+
+    async def load_documents(self, cls, ids):
+        ids = list(ids)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((cls, ids, future))
+        # send the loads once every task that is ready to run has had the chance to queue its own
+        if len(self._pending) == 1:
+            loop.call_soon(self._send_pending)
+        return await future
+
+    def _send_pending(self):
+        pending, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._load_pending(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load_pending(self, pending):
+        try:
+            p = self.redis.pipeline(transaction=False)
+            for cls, ids, future in pending:
+                self._queue_load(p, cls, ids)
+            results = iter(await p.execute())
+        except Exception as e:
+            for cls, ids, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for cls, ids, future in pending:
+            chunk = iter(list(islice(results, self._load_results(cls, ids))))
+            if future.done():
+                continue
+            try:
+                future.set_result(self._raise_documents(cls, ids, chunk))
+            except Exception as e:
+                future.set_exception(e)
+
+    async def _read_indexes(self, requests, deleted=None):
+        '''Reads the current index values with a single round trip.
+        If deleted is provided, {cls: ids}, raises IntegrityError if they are still referenced.
+        '''
+        p = self.redis.pipeline(transaction=False)
+        checks = self._queue_reference_reads(p, deleted)
+        state = self._queue_index_reads(p, requests)
+        if state is None and not checks:
+            return []
+        results = iter(await p.execute())
+        if checks:
+            self._check_references(deleted, checks, self._raise_references(checks, results))
+        return self._index_updates(state, results) if state is not None else []
+
+    async def _write(self, requests, queue, deleted=None):
+        '''See RedisDatabase._write.
+        '''
+        watched = self._index_watch_keys(requests, deleted)
+        p = self.redis.pipeline(transaction=True)
+        try:
+            while True:
+                try:
+                    if watched:
+                        await p.watch(*watched)
+                    index_updates = await self._read_indexes(requests, deleted)
+                    p.multi()
+                    queue(p, index_updates)
+                    await p.execute()
+                    return
+                except WatchError:
+                    continue
+        finally:
+            await p.reset()
+
+    async def save_many(self, objs, partial=False, validate=True, workers=None, executor=None):
+        documents = self._documents(objs, partial, validate, workers, executor)
+        if not documents:
+            return
+
+        await self._write(self._save_requests(documents), lambda p, index_updates: self._queue_save(p, documents, index_updates))
+
+        for obj, document, is_partial in documents:
+            obj.mark_clean()
+
+    async def update_key(self, cls, id, field, operation, *values):
+        '''See RedisDatabase.update_key.
+        '''
+        values = self._check_update(cls, field, operation, values)
+        if operation != 'increment' and not values:
+            return None
+        if self._watched(cls, field):
+            return await self._update_watched(cls, id, field, operation, values)
+        keys, arguments = self._update_commands(cls, id, field, operation, values)
+        try:
+            result = await self.redis.evalsha(UPDATE_SHA, len(keys), *keys, *arguments)
+        except NoScriptError:
+            result = await self.redis.eval(UPDATE_SCRIPT, len(keys), *keys, *arguments)
+        return self._raise_update(cls, id, field, operation, result)
+
+    async def _update_watched(self, cls, id, field, operation, values):
+        p = self.redis.pipeline(transaction=True)
+        try:
+            while True:
+                try:
+                    await p.watch(*self._watched_keys(cls, id, field))
+                    value, documents = self._watched_update(cls, id, (await self.load_documents(cls, [id]))[0], field, operation, values)
+                    unique_keys = self._unique_keys(cls, field, value)
+                    if unique_keys:
+                        await p.watch(*unique_keys)
+                    index_updates = await self._read_indexes(self._save_requests(documents))
+                    p.multi()
+                    self._queue_watched_update(p, cls, id, field, operation, values, documents, index_updates)
+                    await p.execute()
+                    return value if operation == 'increment' else None
+                except WatchError:
+                    continue
+        finally:
+            await p.reset()
+
+    async def delete_keys(self, cls, ids):
+        await self.delete_keys_many({cls: ids})
+
+    async def delete_keys_many(self, keys):
+        keys = {cls: list(ids) for cls, ids in keys.items() if ids}
+        if not keys:
+            return
+        requests = [request for cls, ids in keys.items() for request in self._delete_requests(cls, ids)]
+        await self._write(requests, lambda p, index_updates: self._queue_delete(p, keys, index_updates), keys)
+
+    async def scan_keys(self, cls, batch_size=100):
+        batch = []
+        async for key in self.redis.scan_iter(match=self._scan_pattern(cls), count=batch_size, _type=self._scan_type(cls)):
+            batch.append(self._raise_scanned_key(cls, key))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def find_keys(self, cls, **equals):
+        members = await self.redis.sinter(*self._index_query_keys(cls, equals))
+        return sorted(self._raise_key(cls, member) for member in members)
+
+    async def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        command, args, kwargs = self._range_query(cls, field, min, max, descending, offset, limit)
+        return [self._raise_key(cls, member) for member in await getattr(self.redis, command)(*args, **kwargs)]
+
+    async def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        command, args, kwargs = self._range_query(cls, field, min, max, descending, offset, limit)
+        return [(score, self._raise_key(cls, member)) for member, score in await getattr(self.redis, command)(*args, withscores=True, **kwargs)]
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from .database import Database
+
+class CachedDatabase(Database):
+    '''Wraps another database, keeping recently loaded documents in memory.
+
+    maxsize is the maximum number of documents to keep, the least recently used are evicted first.
+    ttl is the number of seconds a document may be cached for, None caches until evicted.
+    models is a list of the models to cache, None caches every model.
+
+    Saves and deletes made through the cache invalidate the cached documents.
+    Changes made directly to the wrapped database, or by other processes, are not seen until
+    the document expires or is evicted.
+
+    >>> db = CachedDatabase(RedisDatabase(redis), maxsize=10000, ttl=60, models=[User, Config])
+    '''
+    def __init__(self, db, maxsize=1024, ttl=None, models=None):
+        self.db = db
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.models = set(models) if models is not None else None
+        # (cls, primary key): (expiry time, document)
+        self._cache = OrderedDict()
+        self._lock = RLock()
+        # incremented by each invalidation, so a load can tell whether a document was invalidated while it was fetched
+        self._generation = 0
+        # (cls, primary key): generation, of the documents invalidated while any fetch is in progress
+        self._invalidated = {}
+        self._cleared = 0
+        self._fetches = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._cache)}
+
+    def _cached(self, cls):
+        return self.models is None or cls in self.models
+
+    def load_documents(self, cls, ids):
+        if not self._cached(cls):
+            return self.db.load_documents(cls, ids)
+
+        documents = [None] * len(ids)
+        missing = {}
+        now = monotonic()
+        with self._lock:
+            for index, id in enumerate(ids):
+                key = (cls, id)
+                entry = self._cache.get(key)
+                if entry is not None and (entry[0] is None or entry[0] > now):
+                    self._cache.move_to_end(key)
+                    documents[index] = entry[1]
+                    self.hits += 1
+                    continue
+                if entry is not None:
+                    del self._cache[key]
+                missing.setdefault(id, []).append(index)
+                self.misses += 1
+            if missing:
+                generation = self._generation
+                self._fetches += 1
+
+        if missing:
+            try:
+                loaded = self.db.load_documents(cls, list(missing))
+                with self._lock:
+                    for (id, indices), document in zip(missing.items(), loaded):
+                        if document is None:
+                            continue
+                        # don't cache a document which was saved or deleted while it was being fetched
+                        # invalidations after this are still recorded, as the fetch hasn't finished
+                        if self._cleared <= generation and self._invalidated.get((cls, id), 0) <= generation:
+                            self._store((cls, id), document)
+                        for index in indices:
+                            documents[index] = document
+            finally:
+                with self._lock:
+                    self._fetches -= 1
+                    if not self._fetches:
+                        self._invalidated = {}
+
+        return [self._copy_document(document) if document is not None else None for document in documents]
+
+    def _store(self, key, document):
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        self._cache[key] = (expires, self._copy_document(document))
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, cls, ids):
+        with self._lock:
+            self._generation += 1
+            for id in ids:
+                self._cache.pop((cls, id), None)
+                if self._fetches:
+                    self._invalidated[(cls, id)] = self._generation
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._cleared = self._generation
+            self._cache.clear()
+
+    def save_many(self, objs, partial=False, validate=True, workers=None, executor=None):
+        objs = list(objs)
+        try:
+            self.db.save_many(objs, partial=partial, validate=validate, workers=workers, executor=executor)
+        finally:
+            for obj in objs:
+                self.invalidate(obj.__class__, [obj.primary_key])
+
+    def update_key(self, cls, id, field, operation, *values):
+        try:
+            return self.db.update_key(cls, id, field, operation, *values)
+        finally:
+            self.invalidate(cls, [id])
+
+    def delete_keys(self, cls, ids):
+        ids = list(ids)
+        try:
+            self.db.delete_keys(cls, ids)
+        finally:
+            self.invalidate(cls, ids)
+
+    def iterate(self, cls, batch_size=100, raw=False):
+        # read directly from the wrapped database so the cache isn't flushed by the scan
+        for document in self.db.iterate(cls, batch_size=batch_size, raw=True):
+            yield document if raw else self._hydrate(cls, document)
+
+    def scan_keys(self, cls, batch_size=100):
+        return self.db.scan_keys(cls, batch_size)
+
+    def delete_keys_many(self, keys):
+        keys = {cls: list(ids) for cls, ids in keys.items()}
+        try:
+            self.db.delete_keys_many(keys)
+        finally:
+            for cls, ids in keys.items():
+                self.invalidate(cls, ids)
+
+    def find_keys(self, cls, **equals):
+        return self.db.find_keys(cls, **equals)
+
+    def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return self.db.range_keys(cls, field, min, max, descending, offset, limit)
+
+    def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return self.db.range_items(cls, field, min, max, descending, offset, limit)
@@ -1,13 +1,562 @@
+from datetime import date, datetime, timezone
+from modelus.model import Model, ValidationError
+from modelus.instrumentation import instrumented
+from modelus.validation import validate_many
 
-class Database(object):
+
+class MissingKeysError(ValueError):
+    '''Raised when one or more models could not be found.
+    The keys attribute contains every primary key which was not found.
+    '''
+    def __init__(self, cls, keys):
+        self.cls = cls
+        self.keys = list(keys)
+        if len(self.keys) == 1:
+            message = f'No instance of {cls.__name__} with primary key "{self.keys[0]}" found'
+        else:
+            message = f'No instances of {cls.__name__} with primary keys {self.keys} found'
+        super().__init__(message)
+
+
+class IntegrityError(TypeError):
+    '''Raised when deleting a model which is still referenced by a foreign key.
+    '''
+    def __init__(self, cls, key, referrer, field, keys):
+        self.cls = cls
+        self.key = key
+        self.referrer = referrer
+        self.field = field
+        self.keys = sorted(keys)
+        super().__init__(f'{cls.__name__} "{key}" is referenced by {referrer.__name__}.{field} of {self.keys}')
+
+
+class BaseDatabase(object):
+    '''Functionality shared by the synchronous and asynchronous databases which doesn't perform any I/O.
+    '''
+    asynchronous = False
+    # whether deleting a model which is still referenced raises IntegrityError
+    # disabled for databases which are wrapped by another which checks them, ie. the shards of ShardedDatabase
+    check_references = True
+    # the backend operations which are measured when an instrument is set
+    INSTRUMENTED = ['load_documents', 'save_many', 'delete_keys', 'delete_keys_many', 'find_keys', 'range_keys', 'range_items', 'update_key']
+    # operation: the field types it can be applied to, see update_key
+    UPDATES = {
+        'increment': ['integer', 'float', 'number'],
+        'append': ['list'],
+        'remove': ['list'],
+        'add': ['set'],
+        'discard': ['set'],
+    }
+    _instrument = None
+
+    @property
+    def instrument(self):
+        return self._instrument
+
+    @instrument.setter
+    def instrument(self, instrument):
+        '''Reports each backend operation to the instrument, see modelus.instrumentation.
+        The operations are only wrapped while an instrument is set, so there is no cost when it is None.
+        '''
+        for name in self.INSTRUMENTED:
+            self.__dict__.pop(name, None)
+            if instrument is not None:
+                setattr(self, name, instrumented(getattr(self, name), instrument))
+        self._instrument = instrument
+        self._instrument_backend(instrument)
+
+    def _instrument_backend(self, instrument):
+        '''Called when the instrument is changed, backends which perform I/O should count their round trips and bytes.
+        '''
+        pass
+
+    def _hydrate(self, cls, document):
+        # the document was validated when it was saved
+        return cls.from_document(self, document)
+
+    def _copy_document(self, document):
+        # containers can be modified in place, so don't share them
+        # tracked containers are copied as plain containers, so the copies don't reference the model
+        return {k: list(v) if isinstance(v, list) else set(v) if isinstance(v, set) else v for k, v in document.items()}
+
+    def _missing(self, cls, ids, objs, ignore_missing):
+        missing = [id for id, obj in zip(ids, objs) if obj is None]
+        if missing and not ignore_missing:
+            raise MissingKeysError(cls, missing)
+
+    def _values(self, value):
+        # the key may be a list, so convert everything to a list
+        if value is None:
+            return []
+        if isinstance(value, (set, list)):
+            return value
+        return [value]
+
+    def _prefetch_tree(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        # merge the paths so shared prefixes are only loaded once
+        tree = {}
+        for path in paths:
+            node = tree
+            for name in path.split('.'):
+                node = node.setdefault(name, {})
+        return tree
+
+    def _prefetch_keys(self, objs, name):
+        '''Returns the unresolved keys of the field, grouped by their target model.
+        '''
+        keys = {}
+        for obj in objs:
+            target = obj._foreign_keys.get(name)
+            if target is None:
+                raise TypeError(f'{obj.__class__.__name__}.{name} is not a foreign key')
+            pending = keys.setdefault(target, {})
+            for value in self._values(obj._data.get(name)):
+                if not isinstance(value, Model):
+                    pending[value] = None
+        return {target: list(ids) for target, ids in keys.items()}
+
+    def _prefetch_resolve(self, objs, name, loaded):
+        '''Replaces the keys with the loaded models.
+        loaded is a dict of (target model, key): model.
+        Returns the models referenced by the field.
+        '''
+        related = {}
+        for obj in objs:
+            target = obj._foreign_keys[name]
+            def resolve(value):
+                if isinstance(value, Model):
+                    return value
+                return loaded.get((target, value), value)
+
+            value = obj._data.get(name)
+            if value is None:
+                continue
+            if isinstance(value, list):
+                value = [resolve(item) for item in value]
+            elif isinstance(value, set):
+                value = {resolve(item) for item in value}
+            else:
+                value = resolve(value)
+            obj._data[name] = value
+
+            for item in self._values(value):
+                if isinstance(item, Model):
+                    related[id(item)] = item
+        return list(related.values())
+
+    def _check_ordered(self, cls, field):
+        if field not in cls._ordered:
+            raise TypeError(f'{cls.__name__}.{field} is not ordered')
+
+    def _index_query(self, cls, equals):
+        '''Returns a list of (field, value) ensuring each field is indexed.
+        '''
+        if not equals:
+            raise ValueError('At least one field must be provided')
+        query = []
+        for field, value in equals.items():
+            if field not in cls._indexes:
+                raise TypeError(f'{cls.__name__}.{field} is not indexed')
+            # foreign keys are indexed by their primary key
+            if isinstance(value, Model):
+                value = value.primary_key
+            query.append((field, value))
+        return query
+
+    def _score(self, value):
+        # a number which orders the values of an ordered field, ie. the score of a redis sorted set
+        if isinstance(value, datetime):
+            # naive datetimes are treated as UTC
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            return value.timestamp()
+        if isinstance(value, date):
+            return value.toordinal()
+        return value
+
+    def _index_values(self, document, field):
+        return [item for item in self._values(document.get(field)) if item is not None]
+
+    def _cascade_level(self, pending, visited, keys):
+        '''Returns the models which haven't been visited yet, adding their keys to keys.
+        '''
+        level = []
+        for obj in pending:
+            key = (obj.__class__, obj.primary_key)
+            if key in visited:
+                continue
+            visited.add(key)
+            level.append(obj)
+            keys.setdefault(obj.__class__, []).append(obj.primary_key)
+        return level
+
+    def _cascade_fields(self, level):
+        '''Returns {field: [models]} of the foreign keys with cascade set.
+        '''
+        fields = {}
+        for obj in level:
+            for field, model in obj._foreign_key_cascades:
+                fields.setdefault(field, []).append(obj)
+        return fields
+
+    def _cascade_children(self, objs, field):
+        # keys which couldn't be loaded have already been deleted
+        return [value for obj in objs for value in self._values(obj._data.get(field)) if isinstance(value, Model)]
+
+    def _referring_fields(self, target, cls=None, field=None):
+        referrers = [(model, name) for model, name in target._referrers if cls in [None, model] and field in [None, name]]
+        if cls is not None and field is not None and not referrers:
+            raise TypeError(f'{cls.__name__}.{field} is not a foreign key to {target.__name__}')
+        return referrers
+
+    def _reference_checks(self, keys):
+        '''Returns a (referring model, field, model, key) for each foreign key which may reference the deleted models.
+        keys is {cls: [ids]}.
+        '''
+        if not self.check_references:
+            return []
+        return [(referrer, field, cls, id) for cls, ids in keys.items() for referrer, field in cls._referrers for id in ids]
+
+    def _check_references(self, keys, checks, results):
+        '''Raises IntegrityError if any of the deleted models are referenced by a model which isn't being deleted.
+        results is the primary keys of the referring models for each check.
+        '''
+        deleted = {cls: set(ids) for cls, ids in keys.items()}
+        for (referrer, field, cls, id), referring in zip(checks, results):
+            remaining = set(referring) - deleted.get(referrer, set())
+            if remaining:
+                raise IntegrityError(cls, id, referrer, field, remaining)
+
+    def _check_update(self, cls, field, operation, values):
+        '''Checks the operation can be applied to the field, and returns the values as they are stored.
+        Only the values are checked, not the field once they have been applied, so rules such as min and maxlength aren't.
+        '''
+        types = self.UPDATES.get(operation)
+        if types is None:
+            raise ValueError(f'Unknown operation "{operation}", must be one of {list(self.UPDATES)}')
+        schema = cls.schema.get(field)
+        if schema is None or field == cls._primary_key:
+            raise TypeError(f'{cls.__name__}.{field} is not a field which can be updated')
+        if schema['type'] not in types:
+            raise TypeError(f'{cls.__name__}.{field} is a {schema["type"]} field, {operation} requires a {" or ".join(types)} field')
+
+        if operation == 'increment':
+            amount, = values
+            if isinstance(amount, bool) or not isinstance(amount, int if schema['type'] == 'integer' else (int, float)):
+                raise ValueError(f'{cls.__name__}.{field} can\'t be incremented by {amount!r}')
+            return [amount]
+        values = [self._key(value) for value in values]
+        if operation in ['append', 'add']:
+            values = self._check_items(cls, field, values)
+        return values
+
+    def _check_items(self, cls, field, values):
+        schema = cls.schema[field]['schema']
+        validator = cls.compiled_item_validator(field)
+        # cerberus is only used if there are rules other than the type, as it's far slower than isinstance
+        if set(schema) - {'type'} - ({'coerce'} if schema.get('coerce') == 'primary_key' else set()):
+            normalized = []
+            for value in values:
+                document = validator.normalized({'item': value})
+                if document is None or not validator(document):
+                    raise ValidationError({field: validator.errors.get('item', validator.errors)})
+                normalized.append(document['item'])
+            return normalized
+        definition = validator.types_mapping[schema['type']]
+        for value in values:
+            if not isinstance(value, definition.included_types) or isinstance(value, definition.excluded_types):
+                raise ValidationError({field: [f'must be of {schema["type"]} type']})
+        return values
+
+    def _key(self, value):
+        # foreign keys are stored as their primary key
+        return value.primary_key if isinstance(value, Model) else value
+
+    def _updated(self, operation, current, values):
+        '''Returns the value of a field once the operation has been applied to it, see update_key.
+        '''
+        if operation == 'increment':
+            return (current or 0) + values[0]
+        items = list(current or [])
+        if operation == 'append':
+            items.extend(values)
+        elif operation == 'add':
+            keys = {self._key(item) for item in items}
+            items.extend(value for value in values if self._key(value) not in keys)
+        else:
+            removed = {self._key(value) for value in values}
+            items = [item for item in items if self._key(item) not in removed]
+        return items if operation in ['append', 'remove'] else set(items)
+
+    def _update_model(self, obj, field, operation, values, value):
+        '''Applies an update which has been stored to the model, without marking the field dirty.
+        Increments are set to the stored value, other operations are applied to the model's value.
+        '''
+        if operation != 'increment':
+            value = self._updated(operation, obj._data.get(field), values)
+        obj._data[field] = value
+        return value
+
+    def _is_partial(self, obj, partial):
+        # a partial save is only possible if the model has been loaded or saved previously
+        # and the primary key hasn't changed since
+        return partial and obj._dirty is not None and obj._primary_key not in obj._dirty
+
+    def _documents(self, objs, partial, validate=True, workers=None, executor=None):
+        '''Validates the models before anything is written.
+        If workers or executor is provided, new models are validated by worker processes, see validate_many.
+        Returns a list of (obj, document, partial), models with nothing to write are skipped.
+        '''
+        documents = []
+        pending = {}
+        for position, obj in enumerate(objs):
+            is_partial = self._is_partial(obj, partial)
+            # nothing to write
+            if is_partial and not obj._dirty:
+                continue
+            if validate and (workers or executor) and obj._dirty is None:
+                # validated in full, so they can be validated in parallel
+                pending.setdefault(obj.__class__, []).append((len(documents), position, obj))
+                documents.append(None)
+                continue
+            documents.append((obj, obj.document(partial=is_partial, validate=validate), is_partial))
+
+        errors = []
+        for cls, items in pending.items():
+            results = validate_many(cls, [obj._unvalidated(None) for index, position, obj in items], workers, executor=executor)
+            for (index, position, obj), result in zip(items, results):
+                if isinstance(result, ValidationError):
+                    # the position in objs rather than the models of the class
+                    result.index = position
+                    errors.append(result)
+                    continue
+                obj._normalised(result)
+                documents[index] = (obj, result, False)
+        if errors:
+            raise min(errors, key=lambda error: error.index)
+        return documents
+
+
+class Database(BaseDatabase):
+    '''Backends must implement load_documents, save_many and delete_keys.
+    '''
     def create(self, cls, **values):
+        # check the primary key doesn't already exist
+        obj = cls(self, **values)
+        self.save(obj)
+        return obj
+
+    def load(self, cls, id, prefetch=None):
+        return self.load_many(cls, [id], prefetch=prefetch)[0]
+
+    def load_many(self, cls, ids, ignore_missing=False, prefetch=None):
+        '''Loads multiple models, which are returned in the same order as ids.
+        Raises MissingKeysError listing every key that wasn't found.
+        If ignore_missing is True, missing models are returned as None instead.
+        prefetch is passed to Database.prefetch.
+        '''
+        documents = self.load_documents(cls, ids)
+        objs = [self._hydrate(cls, document) if document is not None else None for document in documents]
+        self._missing(cls, ids, objs, ignore_missing)
+        if prefetch:
+            self.prefetch([obj for obj in objs if obj is not None], prefetch)
+        return objs
+
+    def load_documents(self, cls, ids):
+        '''Returns the stored document for each id, or None if it doesn't exist.
+        '''
         raise NotImplementedError
 
-    def load(self, cls, id):
+    def prefetch(self, objs, paths):
+        '''Resolves the foreign keys of every model with a single load_many per target model.
+        paths is a field name or a list of field names, nested foreign keys are separated by '.'.
+        ie. db.prefetch(objs, ['keys', 'parent.keys'])
+        Keys which cannot be found are left unresolved.
+        '''
+        self._prefetch(objs, self._prefetch_tree(paths))
+
+    def _prefetch(self, objs, tree):
+        for name, children in tree.items():
+            loaded = {}
+            for target, ids in self._prefetch_keys(objs, name).items():
+                for key, model in zip(ids, self.load_many(target, ids, ignore_missing=True)):
+                    if model is not None:
+                        loaded[(target, key)] = model
+
+            related = self._prefetch_resolve(objs, name, loaded)
+            if children:
+                self._prefetch(related, children)
+
+    def save(self, obj, partial=False, validate=True):
+        '''Saves the model.
+        If partial is True, only the fields which have changed since the model was loaded or saved
+        are validated and written.
+        If validate is False, the model is trusted to be valid and is written without being validated
+        or normalised, this is intended for data which has already been validated.
+        '''
+        self.save_many([obj], partial=partial, validate=validate)
+
+    def save_many(self, objs, partial=False, validate=True, workers=None, executor=None):
+        '''Saves the models, see save.
+        If workers or executor is provided, models which haven't been saved or loaded are validated
+        by that many processes, or by a pool from modelus.validation.pool, which is worthwhile for large batches.
+        The ValidationError of the first invalid model is raised, its index is the model's position in objs.
+        '''
+        raise NotImplementedError
+
+    def update_key(self, cls, id, field, operation, *values):
+        '''Atomically applies the operation to a single field of a stored model, without loading or saving it.
+        operation is one of:
+            'increment': adds the value to an integer, float or number field, which is treated as 0 if it is empty.
+            'append', 'remove': appends the values to, or removes every occurrence of them from, a list field.
+            'add', 'discard': adds the values to, or removes them from, a set field.
+        Added values are validated against the field's item schema, and unique indexes are checked.
+        Returns the new value of incremented fields, otherwise None.
+        Raises MissingKeysError if the model doesn't exist.
+        ie. db.update_key(User, 'bob', 'score', 'increment', 5)
+        '''
         raise NotImplementedError
 
-    def save(self, obj):
+    def _update(self, obj, field, operation, values):
+        value = self.update_key(obj.__class__, obj.primary_key, field, operation, *values)
+        return self._update_model(obj, field, operation, values, value)
+
+    def increment(self, obj, field, amount=1):
+        '''Atomically adds amount to the field, returns the new value which is also set on obj.
+        '''
+        return self._update(obj, field, 'increment', [amount])
+
+    def append(self, obj, field, *values):
+        '''Atomically appends the values to a list field, the values are also appended to obj.
+        '''
+        self._update(obj, field, 'append', values)
+
+    def remove(self, obj, field, *values):
+        '''Atomically removes every occurrence of the values from a list field, and from obj.
+        '''
+        self._update(obj, field, 'remove', values)
+
+    def add(self, obj, field, *values):
+        '''Atomically adds the values to a set field, the values are also added to obj.
+        '''
+        self._update(obj, field, 'add', values)
+
+    def discard(self, obj, field, *values):
+        '''Atomically removes the values from a set field, and from obj.
+        '''
+        self._update(obj, field, 'discard', values)
+
+    def delete_key(self, cls, id):
+        self.delete_keys(cls, [id])
+
+    def delete_keys(self, cls, ids):
+        '''Deletes the models with the specified ids, foreign keys are not followed.
+        '''
         raise NotImplementedError
 
+    def delete_keys_many(self, keys):
+        '''Deletes the models of several classes, keys is {cls: [ids]}.
+        Raises IntegrityError if a model is still referenced by a foreign key of a model that isn't deleted.
+        Backends should override this to delete every key in a single operation.
+        '''
+        for cls, ids in keys.items():
+            self.delete_keys(cls, ids)
+
     def delete(self, obj):
+        self.delete_many([obj])
+
+    def delete_many(self, objs):
+        '''Deletes the models, following any foreign keys with cascade set.
+        The foreign keys are followed breadth first, each model is only visited once,
+        and each level is loaded with a single load per model.
+        The collected keys are then deleted with a single delete_keys_many.
+        '''
+        keys = {}
+        visited = set()
+        pending = list(objs)
+        while pending:
+            level = self._cascade_level(pending, visited, keys)
+            pending = []
+            for field, cascading in self._cascade_fields(level).items():
+                self.prefetch(cascading, field)
+                pending.extend(self._cascade_children(cascading, field))
+
+        self.delete_keys_many(keys)
+
+    def referrers(self, obj, cls=None, field=None):
+        '''Returns the models which reference obj with a foreign key, see Model.referrers.
+        '''
+        referrers = {}
+        for model, name in self._referring_fields(obj.__class__, cls, field):
+            for referrer in self.find(model, **{name: obj.primary_key}):
+                referrers[(model, referrer.primary_key)] = referrer
+        return list(referrers.values())
+
+    def find(self, cls, **equals):
+        '''Returns the models whose indexed fields match all of the provided values.
+        Container fields match if they contain the value.
+        ie. db.find(User, email='bob@example.com')
+        '''
+        return self.load_many(cls, self.find_keys(cls, **equals))
+
+    def find_one(self, cls, **equals):
+        '''Returns the first matching model, or None.
+        '''
+        keys = self.find_keys(cls, **equals)
+        return self.load(cls, keys[0]) if keys else None
+
+    def find_keys(self, cls, **equals):
+        '''Returns the primary keys of the matching models.
+        '''
         raise NotImplementedError
+
+    def range(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        '''Returns the models whose ordered field is between min and max inclusive, sorted by the field.
+        Either bound may be None. Models with the same value are sorted by primary key.
+        The models are loaded lazily, in batches, as the result is iterated.
+        ie. db.range(Post, 'created', min=datetime.utcnow() - timedelta(hours=1), descending=True, limit=10)
+        '''
+        return self._iterate_keys(cls, self.range_keys(cls, field, min, max, descending, offset, limit))
+
+    def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        '''Returns the primary keys of the models which would be returned by range.
+        '''
+        raise NotImplementedError
+
+    def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        '''Returns a (value, primary key) of each model which would be returned by range.
+        Backends may return the value as its _score, so values from different databases are compared by their score.
+        '''
+        keys = self.range_keys(cls, field, min, max, descending, offset, limit)
+        return [(document[field], key) for key, document in zip(keys, self.load_documents(cls, keys)) if document is not None]
+
+    def iterate(self, cls, batch_size=100, raw=False):
+        '''Iterates over every instance of the model, loading batch_size models at a time
+        so that only a single batch is held in memory.
+        If raw is True, the stored documents are returned instead of models.
+        Models saved or deleted while iterating may or may not be included.
+        ie. for user in db.iterate(User, batch_size=1000): ...
+        '''
+        for keys in self.scan_keys(cls, batch_size):
+            if raw:
+                documents = self.load_documents(cls, keys)
+            else:
+                documents = self.load_many(cls, keys, ignore_missing=True)
+            for document in documents:
+                # skip models deleted since the keys were read
+                if document is not None:
+                    yield document
+
+    def scan_keys(self, cls, batch_size=100):
+        '''Yields lists of up to batch_size primary keys which together cover every instance of the model.
+        '''
+        raise NotImplementedError
+
+    def _iterate_keys(self, cls, keys, batch_size=100):
+        for index in range(0, len(keys), batch_size):
+            for obj in self.load_many(cls, keys[index:index + batch_size], ignore_missing=True):
+                # skip models deleted since the keys were read
+                if obj is not None:
+                    yield obj
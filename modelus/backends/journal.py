@@ -0,0 +1,152 @@
+import os
+import pickle
+import struct
+import zlib
+from mmap import mmap, ACCESS_READ
+from threading import Lock, Timer
+from time import monotonic
+
+class Journal(object):
+    '''An append-only log of operations, periodically compacted into a snapshot.
+
+    Each record is prefixed with its length and checksum, so a record which was only partially
+    written when the process stopped is detected and discarded.
+    The snapshot is written to a temporary file and renamed, so it is replaced atomically.
+
+    fsync is when the log is flushed to disk:
+        'always': after every record.
+        a number: at most every fsync milliseconds, records written since the last flush are flushed
+            by a timer once the interval has passed, even if nothing else is written.
+        'never': left to the operating system.
+    snapshot_every is the number of records after which the log should be compacted, None never compacts.
+    '''
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, path, fsync='always', snapshot_every=None):
+        if fsync not in ['always', 'never'] and not isinstance(fsync, (int, float)):
+            raise ValueError(f'fsync must be "always", "never" or a number of milliseconds, not {fsync!r}')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.snapshot_path = os.path.join(path, 'snapshot')
+        self.log_path = os.path.join(path, 'log')
+        self.fsync = fsync
+        self.snapshot_every = snapshot_every
+        self.records = 0
+        self._synced = monotonic()
+        # whether records have been written since the last flush, and the timer which will flush them
+        self._unsynced = False
+        self._timer = None
+        # the timer flushes from its own thread
+        self._lock = Lock()
+        self._log = None
+
+    @property
+    def due(self):
+        '''Whether enough records have been written that the log should be compacted.
+        '''
+        return self.snapshot_every is not None and self.records >= self.snapshot_every
+
+    def _map(self, path):
+        # memory map the file to avoid copying it, empty files can't be mapped
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return b''
+        with open(path, 'rb') as f:
+            return mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    def _unmap(self, data):
+        if isinstance(data, mmap):
+            data.close()
+
+    def load(self):
+        '''Opens the log, returning the snapshot and the operations written since.
+        '''
+        data = self._map(self.snapshot_path)
+        snapshot = pickle.loads(data) if data else {}
+        self._unmap(data)
+
+        operations = []
+        data = self._map(self.log_path)
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            length, checksum = self.HEADER.unpack_from(data, offset)
+            start, end = offset + self.HEADER.size, offset + self.HEADER.size + length
+            record = data[start:end]
+            # stop at a partially written record
+            if end > len(data) or zlib.crc32(record) != checksum:
+                break
+            operations.append(pickle.loads(record))
+            offset = end
+        self._unmap(data)
+
+        self._log = open(self.log_path, 'ab')
+        # discard the partially written record so new records aren't written after it
+        self._log.truncate(offset)
+        self.records = len(operations)
+        return snapshot, operations
+
+    def append(self, operation):
+        record = pickle.dumps(operation, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._log.write(self.HEADER.pack(len(record), zlib.crc32(record)) + record)
+            self._log.flush()
+            self.records += 1
+
+            if self.fsync == 'always':
+                self._sync()
+            elif self.fsync != 'never':
+                remaining = self.fsync / 1000. - (monotonic() - self._synced)
+                if remaining <= 0:
+                    self._sync()
+                else:
+                    self._unsynced = True
+                    self._schedule(remaining)
+
+    def _schedule(self, delay):
+        if self._timer is None:
+            self._timer = Timer(delay, self._sync_pending)
+            # don't keep the process running, close flushes any remaining records
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _sync_pending(self):
+        with self._lock:
+            self._timer = None
+            if self._unsynced and self._log is not None and not self._log.closed:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._log.fileno())
+        self._synced = monotonic()
+        self._unsynced = False
+
+    def snapshot(self, state):
+        '''Writes the state as the new snapshot, and empties the log.
+        '''
+        temporary = self.snapshot_path + '.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.snapshot_path)
+        # ensure the rename is durable before the log is emptied
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        with self._lock:
+            self._log.truncate(0)
+            self._sync()
+            self.records = 0
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._log is not None and not self._log.closed:
+                self._log.flush()
+                if self.fsync != 'never':
+                    self._sync()
+                self._log.close()
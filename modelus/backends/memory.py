@@ -1,41 +1,344 @@
-from .database import Database
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from threading import local, Lock, RLock
+from modelus.model import model
+from .database import Database, MissingKeysError
+from .journal import Journal
 
 class MemoryDatabase(Database):
-    def __init__(self):
+    '''Stores the models in memory.
+
+    If path is provided, the models are persisted to that directory as an append-only log
+    of every save and delete, which is compacted into a snapshot every snapshot_every operations.
+    The snapshot and log are loaded when the database is created, so the models must be defined first.
+    fsync is one of 'always', 'never' or the maximum number of milliseconds between flushing the log to disk.
+
+    >>> db = MemoryDatabase('/var/lib/app', fsync=100)
+    '''
+    def __init__(self, path=None, fsync='always', snapshot_every=10000):
         self.models = {}
+        # cls: {field: {value: {primary key}}}
+        self.indexes = {}
+        # cls: {field: ([sorted values], [primary keys])}
+        self.ordered = {}
+        self.journal = None
+        if path is not None:
+            self.journal = Journal(path, fsync, snapshot_every)
+            self._restore(*self.journal.load())
+
+    def _restore(self, snapshot, operations):
+        for name, instances in snapshot.items():
+            cls = model(name)
+            self.models[cls] = instances
+            for id, document in instances.items():
+                self._index(cls, id, document)
+        for action, items in operations:
+            # models are logged by name
+            self._apply(action, [(model(name), *item) for name, *item in items])
+
+    def _apply(self, action, items):
+        if action == 'put':
+            for cls, id, document in items:
+                self._put(cls, id, document)
+        elif action == 'update':
+            for cls, id, field, value in items:
+                self._update_field(cls, id, field, value)
+        else:
+            for cls, id in items:
+                self._remove(cls, id)
+
+    def _write(self, action, items):
+        '''Logs and applies the operation, items are (cls, id, document) to put,
+        (cls, id, field, value) to update or (cls, id) to remove.
+        '''
+        if self.journal is not None:
+            self.journal.append((action, [(cls.__name__, *item) for cls, *item in items]))
+        self._apply(action, items)
+        if self.journal is not None and self.journal.due:
+            self.snapshot()
+
+    def snapshot(self):
+        '''Writes every model to the snapshot and empties the log.
+        '''
+        if self.journal is None:
+            raise ValueError('MemoryDatabase was not created with a path')
+        self.journal.snapshot({cls.__name__: instances for cls, instances in self.models.items()})
 
-    def create(self, cls, **values):
-        # check the primary key doesn't already exist
-        obj = cls(self, **values)
-        self.save(obj)
-        return obj
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
 
-    def load(self, cls, id):
+    def load_documents(self, cls, ids):
         instances = self.models.get(cls, {})
-        data = instances.get(id)
-        if not data:
-            raise ValueError(f'No instance of {cls.__name__} with primary key "{id}" found')
-        return cls(self, **data)
-
-    def save(self, obj):
-        instances = self.models.get(obj.__class__, {})
-        self.models[obj.__class__] = instances
-        instances[obj.primary_key] = obj.data
-
-    def delete_key(self, cls, id):
-        instances = self.models[cls]
-        del instances[id]
-
-    def delete(self, obj):
-        # recursively follow foreign keys with cascade set and delete those too
-        for field, model in obj._foreign_key_cascades:
-            objects = getattr(obj, field)
-            # the key may be a list, so convert everything to a list
-            if not isinstance(objects, (set, list)):
-                objects = [objects]
-
-            for object in objects:
-                self.delete(object)
-
-        # delete the object itself
-        self.delete_key(obj.__class__, obj.primary_key)
+        # the documents are used by the models as they are, so don't share them
+        return [self._copy_document(document) if document is not None else None for document in map(instances.get, ids)]
+
+    def save_many(self, objs, partial=False, validate=True, workers=None, executor=None):
+        documents = self._documents(objs, partial, validate, workers, executor)
+        self._save_documents(documents, validate)
+        for obj, document, is_partial in documents:
+            obj.mark_clean()
+
+    def _save_documents(self, documents, validate):
+        # build the complete documents before anything is written
+        writes = []
+        for obj, document, is_partial in documents:
+            instances = self.models.get(obj.__class__, {})
+            if is_partial and obj.primary_key in instances:
+                document = {**instances[obj.primary_key], **document}
+            elif is_partial:
+                # the model was deleted elsewhere, so write it in full
+                document = obj.document(validate=validate)
+            writes.append((obj.__class__, obj.primary_key, document))
+
+        self._check_unique(writes)
+        if writes:
+            self._write('put', writes)
+
+    def update_key(self, cls, id, field, operation, *values):
+        values = self._check_update(cls, field, operation, values)
+        document = self.models.get(cls, {}).get(id)
+        if document is None:
+            raise MissingKeysError(cls, [id])
+        value = self._updated(operation, document.get(field), values)
+        self._check_unique([(cls, id, {field: value})])
+        # only the field is logged
+        self._write('update', [(cls, id, field, value)])
+        return value if operation == 'increment' else None
+
+    def delete_keys(self, cls, ids):
+        self.delete_keys_many({cls: ids})
+
+    def delete_keys_many(self, keys):
+        checks = self._reference_checks(keys)
+        self._check_references(keys, checks, [self.indexes.get(referrer, {}).get(field, {}).get(id, ()) for referrer, field, cls, id in checks])
+        items = [(cls, id) for cls, ids in keys.items() for id in ids]
+        if items:
+            self._write('remove', items)
+
+    def find_keys(self, cls, **equals):
+        indexes = self.indexes.get(cls, {})
+        keys = None
+        for field, value in self._index_query(cls, equals):
+            matches = indexes.get(field, {}).get(value, set())
+            keys = set(matches) if keys is None else keys & matches
+        return sorted(keys)
+
+    def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return [key for value, key in self._range(cls, field, min, max, descending, offset, limit)]
+
+    def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return self._range(cls, field, min, max, descending, offset, limit)
+
+    def _range(self, cls, field, min, max, descending, offset, limit):
+        self._check_ordered(cls, field)
+        values, keys = self.ordered.get(cls, {}).get(field, ([], []))
+        start = bisect_left(values, min) if min is not None else 0
+        end = bisect_right(values, max) if max is not None else len(values)
+        items = list(zip(values[start:end], keys[start:end]))
+        if descending:
+            items.reverse()
+        end = offset + limit if limit is not None else None
+        return items[offset:end]
+
+    def scan_keys(self, cls, batch_size=100):
+        # iterate over a copy of the keys so models can be saved and deleted while iterating
+        keys = list(self.models.get(cls, {}))
+        for index in range(0, len(keys), batch_size):
+            yield keys[index:index + batch_size]
+
+    def _check_unique(self, writes):
+        claimed = {}
+        for cls, id, document in writes:
+            indexes = self.indexes.get(cls, {})
+            for field, unique in cls._indexes.items():
+                if not unique:
+                    continue
+                for value in self._index_values(document, field):
+                    owners = indexes.get(field, {}).get(value, set())
+                    # check against existing models and the other models being saved
+                    if owners - {id} or claimed.setdefault((cls, field, value), id) != id:
+                        raise ValueError(f'{cls.__name__}.{field} must be unique, "{value}" is already in use')
+
+    def _put(self, cls, id, document):
+        # don't share containers with the model
+        document = self._copy_document(document)
+        instances = self.models.get(cls, {})
+        self.models[cls] = instances
+        self._unindex(cls, id, instances.get(id))
+        instances[id] = document
+        self._index(cls, id, document)
+
+    def _update_field(self, cls, id, field, value):
+        instances = self.models.get(cls, {})
+        document = instances.get(id)
+        if document is None:
+            return
+        self._unindex(cls, id, {field: document.get(field)})
+        # the document is replaced rather than modified, so it can be copied without a lock
+        instances[id] = {**document, field: value}
+        self._index(cls, id, {field: value})
+
+    def _remove(self, cls, id):
+        instances = self.models.get(cls, {})
+        self._unindex(cls, id, instances.pop(id, None))
+
+    def _index(self, cls, id, document):
+        indexes = self.indexes.setdefault(cls, {})
+        for field in cls._indexes:
+            index = indexes.setdefault(field, {})
+            for value in self._index_values(document, field):
+                index.setdefault(value, set()).add(id)
+
+        ordered = self.ordered.setdefault(cls, {})
+        for field in cls._ordered:
+            value = document.get(field)
+            if value is None:
+                continue
+            values, keys = ordered.setdefault(field, ([], []))
+            # keep equal values sorted by primary key
+            start, end = bisect_left(values, value), bisect_right(values, value)
+            position = start + bisect_left(keys[start:end], id)
+            values.insert(position, value)
+            keys.insert(position, id)
+
+    def _unindex(self, cls, id, document):
+        if document is None:
+            return
+        indexes = self.indexes.get(cls, {})
+        for field in cls._indexes:
+            index = indexes.get(field, {})
+            for value in self._index_values(document, field):
+                keys = index.get(value, set())
+                keys.discard(id)
+                if not keys:
+                    index.pop(value, None)
+
+        ordered = self.ordered.get(cls, {})
+        for field in cls._ordered:
+            value = document.get(field)
+            if value is None or field not in ordered:
+                continue
+            values, keys = ordered[field]
+            start, end = bisect_left(values, value), bisect_right(values, value)
+            position = start + keys[start:end].index(id)
+            del values[position]
+            del keys[position]
+
+
+class ConcurrentMemoryDatabase(MemoryDatabase):
+    '''A MemoryDatabase which can be shared between threads.
+
+    Each model has its own lock, so operations on different models don't block each other.
+    Operations on several models take their locks in the same order, so batch saves and
+    cascading deletes are applied atomically without deadlocking.
+    Stored documents are replaced rather than modified, so loads only hold the lock while
+    collecting the documents, which are copied once it is released.
+    Models are validated before any locks are taken.
+
+    >>> db = ConcurrentMemoryDatabase('/var/lib/app', fsync=100)
+    '''
+    def __init__(self, path=None, fsync='always', snapshot_every=10000):
+        # cls: lock
+        self._locks = {}
+        self._locks_lock = Lock()
+        # the journal is shared by every model
+        self._journal_lock = Lock()
+        # the number of _locked blocks each thread is in
+        self._depth = local()
+        super().__init__(path, fsync, snapshot_every)
+
+    def _lock(self, cls):
+        lock = self._locks.get(cls)
+        if lock is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(cls, RLock())
+        return lock
+
+    @contextmanager
+    def _locked(self, classes):
+        # a consistent order prevents deadlocks between operations on several models
+        classes = sorted(set(classes), key=lambda cls: (cls.__module__, cls.__qualname__, id(cls)))
+        locks = [self._lock(cls) for cls in classes]
+        acquired = []
+        self._depth.value = getattr(self._depth, 'value', 0) + 1
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            self._depth.value -= 1
+
+    def _write(self, action, items):
+        # the journal is snapshotted by the caller, once it has released its locks
+        if self.journal is not None:
+            with self._journal_lock:
+                self.journal.append((action, [(cls.__name__, *item) for cls, *item in items]))
+        self._apply(action, items)
+
+    def _snapshot_if_due(self):
+        # snapshots take every lock, so they wait until the thread holds none
+        if self.journal is not None and self.journal.due and not self._depth.value:
+            self.snapshot()
+
+    def snapshot(self):
+        if self.journal is None:
+            raise ValueError('MemoryDatabase was not created with a path')
+        with self._locked(list(self.models)), self._journal_lock:
+            self.journal.snapshot({cls.__name__: dict(instances) for cls, instances in list(self.models.items())})
+
+    def load_documents(self, cls, ids):
+        with self._locked([cls]):
+            instances = self.models.get(cls, {})
+            documents = [instances.get(id) for id in ids]
+        return [self._copy_document(document) if document is not None else None for document in documents]
+
+    def _save_documents(self, documents, validate):
+        with self._locked([obj.__class__ for obj, document, is_partial in documents]):
+            super()._save_documents(documents, validate)
+        self._snapshot_if_due()
+
+    def delete_keys_many(self, keys):
+        classes = [*keys, *(referrer for cls in keys for referrer, field in cls._referrers)]
+        with self._locked(classes):
+            super().delete_keys_many(keys)
+        self._snapshot_if_due()
+
+    def delete_many(self, objs):
+        objs = list(objs)
+        # lock every model the cascade can reach, and the models which can reference them
+        classes = {obj.__class__ for obj in objs}
+        pending = list(classes)
+        while pending:
+            cls = pending.pop()
+            for field, target in cls._foreign_key_cascades:
+                if target not in classes:
+                    classes.add(target)
+                    pending.append(target)
+        classes.update(referrer for cls in list(classes) for referrer, field in cls._referrers)
+        with self._locked(classes):
+            super().delete_many(objs)
+        self._snapshot_if_due()
+
+    def update_key(self, cls, id, field, operation, *values):
+        with self._locked([cls]):
+            value = super().update_key(cls, id, field, operation, *values)
+        self._snapshot_if_due()
+        return value
+
+    def find_keys(self, cls, **equals):
+        with self._locked([cls]):
+            return super().find_keys(cls, **equals)
+
+    def _range(self, cls, field, min, max, descending, offset, limit):
+        with self._locked([cls]):
+            return super()._range(cls, field, min, max, descending, offset, limit)
+
+    def scan_keys(self, cls, batch_size=100):
+        with self._locked([cls]):
+            keys = list(self.models.get(cls, {}))
+        for index in range(0, len(keys), batch_size):
+            yield keys[index:index + batch_size]
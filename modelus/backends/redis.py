@@ -1,41 +1,543 @@
-from .database import Database
+from hashlib import sha1
+from itertools import islice
+from .database import Database, MissingKeysError
 from cerberedis import CerbeRedis
+from modelus import codec
 from modelus.fields import rules
+from modelus.instrumentation import CountingRedis
 
-class RedisDatabase(Database):
-    def __init__(self, redis):
+try:
+    from redis.exceptions import NoScriptError, WatchError
+except ImportError:
+    # the client is provided by the caller, so the redis package may not be installed
+    class NoScriptError(Exception):
+        pass
+    class WatchError(Exception):
+        pass
+
+
+# applies an update to KEYS[2] if the model's hash, KEYS[1], exists, so an update can't create part of a model
+# ARGV is each command's name and number of arguments followed by the arguments, the last command's result is returned
+UPDATE_SCRIPT = '''
+if redis.call('exists', KEYS[1]) == 0 then
+    return false
+end
+local result
+local index = 1
+while index <= #ARGV do
+    local count = tonumber(ARGV[index + 1])
+    result = redis.call(ARGV[index], KEYS[2], unpack(ARGV, index + 2, index + 1 + count))
+    index = index + 2 + count
+end
+return result
+'''
+UPDATE_SHA = sha1(UPDATE_SCRIPT.encode('utf-8')).hexdigest()
+
+class RedisLayout(object):
+    '''How models and indexes are stored in redis.
+    Commands are queued on pipelines and their results processed separately,
+    so the layout is shared by the synchronous and asynchronous backends.
+
+    Models are stored in a hash, with each list and set in its own key, unless they are one of the
+    blob_models. These are stored as a single msgpack encoded string, so they are loaded with a single
+    GET and decode, but partial saves write the whole document.
+    '''
+    def _set_blob_models(self, blob_models):
+        self.blob_models = set(blob_models or [])
+        if self.blob_models and not codec.available():
+            raise ImportError('blob_models requires msgpack, install it with "pip install msgpack"')
+
+    def _instrument_backend(self, instrument):
+        redis = self.redis.wrapped if isinstance(self.redis, CountingRedis) else self.redis
+        self.redis = CountingRedis(redis) if instrument is not None else redis
+
+    def _containers(self, cls):
+        if cls in self.blob_models:
+            return []
+        return [(name, schema) for name, schema in cls.schema.items() if schema['type'] in ['list', 'set']]
+
+    def _item_schema(self, cls, field):
+        # containers are indexed by their items
+        schema = cls.schema[field]
+        if schema['type'] in ['list', 'set']:
+            return schema['schema']
+        return schema
+
+    def _decode(self, value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def _lower_key(self, cls, id):
+        return self._decode(self.db.lower_field(cls.schema[cls._primary_key], id))
+
+    def _raise_key(self, cls, value):
+        return self.db.raise_field(cls.schema[cls._primary_key], value)
+
+    def _queue_load(self, p, cls, ids):
+        # fetch every hash and container with a single round trip
+        if cls in self.blob_models:
+            for id in ids:
+                p.get(self.db.key(cls.__name__, id))
+            return
+        containers = self._containers(cls)
+        for id in ids:
+            key = self.db.key(cls.__name__, id)
+            p.hgetall(key)
+            self._queue_containers(p, key, containers)
+
+    def _load_results(self, cls, ids):
+        # the number of results _queue_load queues
+        return len(ids) * (1 + len(self._containers(cls)))
+
+    def _raise_documents(self, cls, ids, results):
+        '''Consumes the results queued by _queue_load.
+        '''
+        if cls in self.blob_models:
+            documents = []
+            for id in ids:
+                document = self._unpack(next(results))
+                # fields which the model no longer has are ignored
+                documents.append({name: value for name, value in document.items() if name in cls.schema} if document is not None else None)
+            return documents
+        containers = self._containers(cls)
+        documents = []
+        for id in ids:
+            hash = next(results)
+            data = self._raise_containers(containers, results)
+            # don't return empty dicts, return None instead
+            if not hash:
+                documents.append(None)
+                continue
+            for name, value in hash.items():
+                schema = cls.schema.get(self._decode(name))
+                if schema is not None:
+                    data[self._decode(name)] = self.db.raise_field(schema, value)
+            documents.append(data)
+        return documents
+
+    def _pack(self, document):
+        return codec.pack({name: value for name, value in document.items() if value is not None})
+
+    def _unpack(self, value):
+        return codec.unpack(value) if value is not None else None
+
+    def _queue_containers(self, p, key, containers):
+        for name, schema in containers:
+            sub_key = f'{key}::{name}'
+            if schema['type'] == 'list':
+                p.lrange(sub_key, 0, -1)
+            else:
+                p.smembers(sub_key)
+
+    def _raise_containers(self, containers, results):
+        '''Consumes one result per container from the results iterator.
+        '''
+        data = {}
+        for name, schema in containers:
+            values = next(results)
+            # ignore empty containers
+            if not values:
+                continue
+            if schema['type'] == 'list':
+                data[name] = [self.db.raise_field(schema['schema'], value) for value in values]
+            else:
+                data[name] = {self.db.raise_field(schema['schema'], value) for value in values}
+        return data
+
+    def _scan_pattern(self, cls):
+        return self.db.key(cls.__name__, '*')
+
+    def _scan_type(self, cls):
+        # containers are stored beneath the model's key, so scans are limited to hashes
+        return 'STRING' if cls in self.blob_models else 'HASH'
+
+    def _raise_scanned_key(self, cls, key):
+        return self._raise_key(cls, key[len(self.db.key(cls.__name__, '')):])
+
+    def _queue_fields(self, p, cls, id, fields):
+        key = self.db.key(cls.__name__, id)
+        if cls in self.blob_models:
+            p.get(key)
+            return
+        scalars = [field for field in fields if cls.schema[field]['type'] not in ['list', 'set']]
+        if scalars:
+            p.hmget(key, *scalars)
+        self._queue_containers(p, key, [(field, cls.schema[field]) for field in fields if field not in scalars])
+
+    def _raise_fields(self, cls, fields, results):
+        '''Consumes the results queued by _queue_fields.
+        '''
+        if cls in self.blob_models:
+            document = self._unpack(next(results)) or {}
+            return {field: document[field] for field in fields if document.get(field) is not None}
+        scalars = [field for field in fields if cls.schema[field]['type'] not in ['list', 'set']]
+        data = {}
+        if scalars:
+            for field, value in zip(scalars, next(results)):
+                if value is not None:
+                    data[field] = self.db.raise_field(cls.schema[field], value)
+        data.update(self._raise_containers([(field, cls.schema[field]) for field in fields if field not in scalars], results))
+        return data
+
+    def _queue_save(self, p, documents, index_updates):
+        for obj, document, is_partial in documents:
+            if obj.__class__ in self.blob_models:
+                if is_partial:
+                    # the unchanged fields were validated when they were loaded or saved
+                    document = {**obj.document(validate=False), **document}
+                p.set(self.db.key(obj.__class__.__name__, obj.primary_key), self._pack(document))
+            elif is_partial:
+                self._save_fields(p, obj.__class__, obj.primary_key, document)
+            else:
+                self.db._save(p, obj.__class__.__name__, obj.schema, obj.primary_key, document)
+        self._queue_index_updates(p, index_updates)
+
+    def _save_fields(self, p, cls, id, data):
+        '''Writes only the provided fields.
+        Scalar values are set in the model's hash, containers replace their own key.
+        '''
+        key = self.db.key(cls.__name__, id)
+        for name, value in data.items():
+            schema = cls.schema[name]
+            if schema['type'] in ['list', 'set']:
+                sub_key = f'{key}::{name}'
+                p.delete(sub_key)
+                items = [self.db.lower_field(schema['schema'], item) for item in value or []]
+                if items:
+                    if schema['type'] == 'list':
+                        p.rpush(sub_key, *items)
+                    else:
+                        p.sadd(sub_key, *items)
+            elif value is None:
+                p.hdel(key, name)
+            else:
+                p.hset(key, name, self.db.lower_field(schema, value))
+
+    def _watched(self, cls, field):
+        '''Whether the update must be made with a watched transaction rather than UPDATE_SCRIPT,
+        which is the case if an index must be updated or the model is stored as a blob.
+        '''
+        return cls in self.blob_models or field in self._indexed(cls)
+
+    def _update_commands(self, cls, id, field, operation, values):
+        '''Returns the keys and arguments of UPDATE_SCRIPT.
+        '''
+        key = self.db.key(cls.__name__, id)
+        schema = cls.schema[field]
+        if operation == 'increment':
+            command = 'hincrby' if schema['type'] == 'integer' else 'hincrbyfloat'
+            return [key, key], [command, 2, field, values[0]]
+        items = [self.db.lower_field(schema['schema'], value) for value in values]
+        if operation == 'remove':
+            # a count of 0 removes every occurrence
+            return [key, f'{key}::{field}'], [argument for item in items for argument in ['lrem', 2, 0, item]]
+        command = {'append': 'rpush', 'add': 'sadd', 'discard': 'srem'}[operation]
+        return [key, f'{key}::{field}'], [command, len(items), *items]
+
+    def _queue_update(self, p, keys, arguments):
+        # the commands of UPDATE_SCRIPT, for when the model is known to exist
+        index = 0
+        while index < len(arguments):
+            command, count = arguments[index:index + 2]
+            getattr(p, command)(keys[1], *arguments[index + 2:index + 2 + count])
+            index += 2 + count
+
+    def _raise_update(self, cls, id, field, operation, result):
+        if result is None:
+            raise MissingKeysError(cls, [id])
+        return self.db.raise_field(cls.schema[field], result) if operation == 'increment' else None
+
+    def _watched_keys(self, cls, id, field):
+        key = self.db.key(cls.__name__, id)
+        if cls in self.blob_models or cls.schema[field]['type'] not in ['list', 'set']:
+            return [key]
+        return [key, f'{key}::{field}']
+
+    def _unique_keys(self, cls, field, value):
+        # watched so a unique value can't be claimed between being checked and written
+        if not cls._indexes.get(field):
+            return []
+        return [self._index_key(cls, field, item) for item in self._index_values({field: value}, field)]
+
+    def _watched_update(self, cls, id, document, field, operation, values):
+        '''Returns the new value and the documents to pass to _queue_save, given the current document.
+        '''
+        if document is None:
+            raise MissingKeysError(cls, [id])
+        value = self._updated(operation, document.get(field), values)
+        # the model is only used to build the document of blob models
+        return value, [(cls.from_document(self, document), {field: value}, True)]
+
+    def _queue_watched_update(self, p, cls, id, field, operation, values, documents, index_updates):
+        if cls in self.blob_models:
+            self._queue_save(p, documents, index_updates)
+            return
+        self._queue_update(p, *self._update_commands(cls, id, field, operation, values))
+        self._queue_index_updates(p, index_updates)
+
+    def _queue_delete(self, p, keys, index_updates):
+        '''keys is {cls: [ids]}.
+        '''
+        deleted = []
+        for cls, ids in keys.items():
+            for id in ids:
+                key = self.db.key(cls.__name__, id)
+                deleted.append(key)
+                # containers are stored in their own keys
+                deleted.extend(f'{key}::{name}' for name, schema in self._containers(cls))
+        p.delete(*deleted)
+        self._queue_index_updates(p, index_updates)
+
+    def _index_query_keys(self, cls, equals):
+        return [self._index_key(cls, field, value) for field, value in self._index_query(cls, equals)]
+
+    def _range_query(self, cls, field, min, max, descending, offset, limit):
+        '''Returns the command and arguments for range_keys.
+        '''
+        self._check_ordered(cls, field)
+        min = self._score(min) if min is not None else '-inf'
+        max = self._score(max) if max is not None else '+inf'
+        num = limit if limit is not None else -1
+        key = self._ordered_key(cls, field)
+        if descending:
+            return 'zrevrangebyscore', (key, max, min), {'start': offset, 'num': num}
+        return 'zrangebyscore', (key, min, max), {'start': offset, 'num': num}
+
+    def _ordered_key(self, cls, field):
+        return f'modelus::ordered::{cls.__name__}::{field}'
+
+    def _index_key(self, cls, field, value):
+        value = self._decode(self.db.lower_field(self._item_schema(cls, field), value))
+        return f'modelus::index::{cls.__name__}::{field}::{value}'
+
+    def _indexed(self, cls):
+        # the fields which have an index of either type
+        return list(dict.fromkeys([*cls._indexes, *cls._ordered]))
+
+    def _save_requests(self, documents):
+        return [
+            # partial saves only change the fields in the document
+            (obj.__class__, obj.primary_key, [field for field in self._indexed(obj.__class__) if not is_partial or field in document], document)
+            for obj, document, is_partial in documents
+        ]
+
+    def _delete_requests(self, cls, ids):
+        return [(cls, id, self._indexed(cls), None) for id in ids]
+
+    def _queue_index_reads(self, p, requests):
+        '''Queues the reads required to update the indexes when saving or deleting models.
+        requests is a list of (cls, id, fields, document), document is None for deletions.
+        Returns the state to pass to _index_updates, or None if there are no indexes to update.
+        '''
+        requests = [(cls, id, fields, document or {}) for cls, id, fields, document in requests if fields]
+        if not requests:
+            return None
+
+        checks = []
+        for cls, id, fields, document in requests:
+            for field in fields:
+                if cls._indexes.get(field):
+                    checks.extend((cls, id, field, value) for value in self._index_values(document, field))
+
+        # read the current values and the owners of any unique values
+        for cls, id, fields, document in requests:
+            self._queue_fields(p, cls, id, fields)
+        for cls, id, field, value in checks:
+            p.smembers(self._index_key(cls, field, value))
+        return requests, checks
+
+    def _index_updates(self, state, results):
+        '''Consumes the results queued by _queue_index_reads.
+        Returns a list of (command, key, member) to apply with the write,
+        raises ValueError if a unique value is already in use.
+        '''
+        requests, checks = state
+        updates = []
+        for cls, id, fields, document in requests:
+            current = self._raise_fields(cls, fields, results)
+            member = self._lower_key(cls, id)
+            for field in fields:
+                if field in cls._indexes:
+                    old = {self._index_key(cls, field, value) for value in self._index_values(current, field)}
+                    new = {self._index_key(cls, field, value) for value in self._index_values(document, field)}
+                    updates.extend(('srem', key, member) for key in old - new)
+                    updates.extend(('sadd', key, member) for key in new - old)
+                if field in cls._ordered:
+                    key = self._ordered_key(cls, field)
+                    old, new = current.get(field), document.get(field)
+                    if new is None and old is not None:
+                        updates.append(('zrem', key, member))
+                    elif new is not None and new != old:
+                        updates.append(('zadd', key, {member: self._score(new)}))
+
+        claimed = {}
+        for cls, id, field, value in checks:
+            key = self._index_key(cls, field, value)
+            owners = {self._decode(owner) for owner in next(results)} - {self._lower_key(cls, id)}
+            # check against existing models and the other models being saved
+            if owners or claimed.setdefault(key, id) != id:
+                raise ValueError(f'{cls.__name__}.{field} must be unique, "{value}" is already in use')
+        return updates
+
+    def _queue_reference_reads(self, p, keys):
+        '''Queues the reads of the models referencing the deleted models.
+        Returns the checks to pass to _check_references with the results of _raise_references.
+        '''
+        checks = self._reference_checks(keys) if keys else []
+        for referrer, field, cls, id in checks:
+            p.smembers(self._index_key(referrer, field, id))
+        return checks
+
+    def _raise_references(self, checks, results):
+        return [{self._raise_key(referrer, member) for member in next(results)} for referrer, field, cls, id in checks]
+
+    def _index_watch_keys(self, requests, deleted=None):
+        '''Returns the keys read by _queue_index_reads and _queue_reference_reads,
+        which are watched so the indexes can't change between being read and written.
+        '''
+        keys = []
+        for cls, id, fields, document in requests:
+            for field in fields:
+                keys.extend(self._watched_keys(cls, id, field))
+                if document is not None:
+                    keys.extend(self._unique_keys(cls, field, document.get(field)))
+        if deleted:
+            keys.extend(self._index_key(referrer, field, id) for referrer, field, cls, id in self._reference_checks(deleted))
+        return list(dict.fromkeys(keys))
+
+    def _queue_index_updates(self, p, index_updates):
+        for command, key, member in index_updates:
+            getattr(p, command)(key, member)
+
+
+class RedisDatabase(RedisLayout, Database):
+    '''blob_models is a list of models to store as a single msgpack encoded string rather than a hash,
+    which requires the msgpack package.
+
+    >>> db = RedisDatabase(Redis(), blob_models=[User])
+    '''
+    def __init__(self, redis, blob_models=None):
         self.redis = redis
         self.db = CerbeRedis(self.redis, rules())
+        self._set_blob_models(blob_models)
 
-    def create(self, cls, **values):
-        # check the primary key doesn't already exist
-        obj = cls(self, **values)
-        self.save(obj)
-        return obj
+    def load_documents(self, cls, ids):
+        p = self.redis.pipeline(transaction=False)
+        self._queue_load(p, cls, ids)
+        return self._raise_documents(cls, ids, iter(p.execute()))
 
-    def load(self, cls, id):
-        data = self.db.load(cls.__name__, cls.schema, id)
-        if not data:
-            raise ValueError(f'No instance of {cls.__name__} with primary key "{id}" found')
-        return cls(self, **data)
+    def _read_indexes(self, requests, deleted=None):
+        '''Reads the current index values with a single round trip.
+        If deleted is provided, {cls: ids}, raises IntegrityError if they are still referenced.
+        '''
+        p = self.redis.pipeline(transaction=False)
+        checks = self._queue_reference_reads(p, deleted)
+        state = self._queue_index_reads(p, requests)
+        if state is None and not checks:
+            return []
+        results = iter(p.execute())
+        if checks:
+            self._check_references(deleted, checks, self._raise_references(checks, results))
+        return self._index_updates(state, results) if state is not None else []
 
-    def save(self, obj):
-        self.db.save(obj.__class__.__name__, obj.schema, obj.primary_key, obj.data)
+    def _write(self, requests, queue, deleted=None):
+        '''Reads the current index values, then calls queue(p, index_updates) to queue the writes in a transaction.
+        The models and indexes which are read are watched, and the transaction is retried if they change meanwhile,
+        so concurrent saves can't both claim a unique value or remove each other's index entries.
+        '''
+        watched = self._index_watch_keys(requests, deleted)
+        p = self.redis.pipeline(transaction=True)
+        try:
+            while True:
+                try:
+                    if watched:
+                        p.watch(*watched)
+                    index_updates = self._read_indexes(requests, deleted)
+                    p.multi()
+                    queue(p, index_updates)
+                    p.execute()
+                    return
+                except WatchError:
+                    continue
+        finally:
+            p.reset()
 
-    def delete_key(self, cls, id):
-        key = self.db.key(cls.__name__, id)
-        self.redis.delete(key)
+    def save_many(self, objs, partial=False, validate=True, workers=None, executor=None):
+        documents = self._documents(objs, partial, validate, workers, executor)
+        if not documents:
+            return
+
+        self._write(self._save_requests(documents), lambda p, index_updates: self._queue_save(p, documents, index_updates))
+
+        for obj, document, is_partial in documents:
+            obj.mark_clean()
+
+    def update_key(self, cls, id, field, operation, *values):
+        '''Fields without an index are updated with a single script which runs the native command, ie. HINCRBY.
+        Indexed fields and blob models are read and written in a transaction, which is retried if they change meanwhile.
+        '''
+        values = self._check_update(cls, field, operation, values)
+        if operation != 'increment' and not values:
+            return None
+        if self._watched(cls, field):
+            return self._update_watched(cls, id, field, operation, values)
+        keys, arguments = self._update_commands(cls, id, field, operation, values)
+        try:
+            result = self.redis.evalsha(UPDATE_SHA, len(keys), *keys, *arguments)
+        except NoScriptError:
+            result = self.redis.eval(UPDATE_SCRIPT, len(keys), *keys, *arguments)
+        return self._raise_update(cls, id, field, operation, result)
+
+    def _update_watched(self, cls, id, field, operation, values):
+        p = self.redis.pipeline(transaction=True)
+        try:
+            while True:
+                try:
+                    p.watch(*self._watched_keys(cls, id, field))
+                    value, documents = self._watched_update(cls, id, self.load_documents(cls, [id])[0], field, operation, values)
+                    unique_keys = self._unique_keys(cls, field, value)
+                    if unique_keys:
+                        p.watch(*unique_keys)
+                    index_updates = self._read_indexes(self._save_requests(documents))
+                    p.multi()
+                    self._queue_watched_update(p, cls, id, field, operation, values, documents, index_updates)
+                    p.execute()
+                    return value if operation == 'increment' else None
+                except WatchError:
+                    continue
+        finally:
+            p.reset()
+
+    def delete_keys(self, cls, ids):
+        self.delete_keys_many({cls: ids})
+
+    def delete_keys_many(self, keys):
+        keys = {cls: list(ids) for cls, ids in keys.items() if ids}
+        if not keys:
+            return
+        requests = [request for cls, ids in keys.items() for request in self._delete_requests(cls, ids)]
+        self._write(requests, lambda p, index_updates: self._queue_delete(p, keys, index_updates), keys)
+
+    def scan_keys(self, cls, batch_size=100):
+        '''Uses SCAN, so redis isn't blocked, keys may be returned more than once
+        if the keyspace is resized while iterating.
+        '''
+        keys = self.redis.scan_iter(match=self._scan_pattern(cls), count=batch_size, _type=self._scan_type(cls))
+        while True:
+            batch = [self._raise_scanned_key(cls, key) for key in islice(keys, batch_size)]
+            if not batch:
+                return
+            yield batch
 
-    def delete(self, obj):
-        # recursively follow foreign keys with cascade set and delete those too
-        for field, model in obj._foreign_key_cascades:
-            objects = getattr(obj, field)
-            # the key may be a list, so convert everything to a list
-            if not isinstance(objects, (set, list)):
-                objects = [objects]
+    def find_keys(self, cls, **equals):
+        members = self.redis.sinter(*self._index_query_keys(cls, equals))
+        return sorted(self._raise_key(cls, member) for member in members)
 
-            for object in objects:
-                self.delete(object)
+    def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        command, args, kwargs = self._range_query(cls, field, min, max, descending, offset, limit)
+        return [self._raise_key(cls, member) for member in getattr(self.redis, command)(*args, **kwargs)]
 
-        # delete the object itself
-        self.delete_key(obj.__class__, obj.primary_key)
+    def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        '''The values are the scores of the sorted set, see _score.
+        '''
+        command, args, kwargs = self._range_query(cls, field, min, max, descending, offset, limit)
+        return [(score, self._raise_key(cls, member)) for member, score in getattr(self.redis, command)(*args, withscores=True, **kwargs)]
@@ -0,0 +1,134 @@
+from .database import Database
+
+class Session(Database):
+    '''Wraps another database with an identity map and a unit of work.
+
+    Each model is only loaded once per session, and loading it again returns the same instance.
+    Saves and deletes are queued until flush is called, which writes them with a single
+    batched call to the wrapped database.
+
+    >>> with Session(db) as session:
+    ...     modela = session.load(ModelA, 'a')
+    ...     modela.keys[0].value = 'b'
+    ...     session.save(modela.keys[0])
+    '''
+    def __init__(self, db):
+        self.db = db
+        # (cls, primary key): model
+        self.identity_map = {}
+        # (cls, primary key): (model, partial, validate)
+        self._saves = {}
+        # cls: {primary key: None}
+        self._deletes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # only write the changes if no exception was raised
+        if type is None:
+            self.flush()
+
+    def _deleted(self, cls, id):
+        return (cls, id) not in self.identity_map and id in self._deletes.get(cls, {})
+
+    def load_documents(self, cls, ids):
+        return self.db.load_documents(cls, ids)
+
+    def load_many(self, cls, ids, ignore_missing=False, prefetch=None):
+        missing = [id for id in dict.fromkeys(ids) if (cls, id) not in self.identity_map and not self._deleted(cls, id)]
+        if missing:
+            for id, obj in zip(missing, self.db.load_many(cls, missing, ignore_missing=True)):
+                if obj is not None:
+                    # load any foreign keys through the session
+                    obj.db = self
+                    self.identity_map[(cls, id)] = obj
+
+        objs = [self.identity_map.get((cls, id)) for id in ids]
+        self._missing(cls, ids, objs, ignore_missing)
+        if prefetch:
+            self.prefetch([obj for obj in objs if obj is not None], prefetch)
+        return objs
+
+    def scan_keys(self, cls, batch_size=100):
+        # queued changes aren't visible until they are flushed
+        return self.db.scan_keys(cls, batch_size)
+
+    def find_keys(self, cls, **equals):
+        # queued saves aren't visible until they are flushed, queued deletes are excluded
+        return [id for id in self.db.find_keys(cls, **equals) if not self._deleted(cls, id)]
+
+    def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return [id for id in self.db.range_keys(cls, field, min, max, descending, offset, limit) if not self._deleted(cls, id)]
+
+    def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return [(value, id) for value, id in self.db.range_items(cls, field, min, max, descending, offset, limit) if not self._deleted(cls, id)]
+
+    def save_many(self, objs, partial=False, validate=True):
+        for obj in objs:
+            # nothing to write
+            if self._is_partial(obj, partial) and not obj._dirty:
+                continue
+            key = (obj.__class__, obj.primary_key)
+            self.identity_map[key] = obj
+            # saving a model after deleting it replaces the delete
+            self._deletes.get(obj.__class__, {}).pop(obj.primary_key, None)
+            # a full save takes precedence over a partial save, and validated over unvalidated
+            _, queued_partial, queued_validate = self._saves.get(key, (obj, partial, validate))
+            self._saves[key] = (obj, partial and queued_partial, validate or queued_validate)
+
+    def update_key(self, cls, id, field, operation, *values):
+        '''Updates are written immediately rather than queued until flush,
+        so a queued save of the same model which includes the field will overwrite them.
+        '''
+        return self.db.update_key(cls, id, field, operation, *values)
+
+    def delete_keys(self, cls, ids):
+        deletes = self._deletes.setdefault(cls, {})
+        for id in ids:
+            self.identity_map.pop((cls, id), None)
+            self._saves.pop((cls, id), None)
+            deletes[id] = None
+
+    def expunge(self, obj):
+        '''Removes the model from the session, any queued save is discarded.
+        '''
+        key = (obj.__class__, obj.primary_key)
+        self.identity_map.pop(key, None)
+        self._saves.pop(key, None)
+
+    def clear(self):
+        '''Discards the identity map and any queued writes.
+        '''
+        self.identity_map = {}
+        self._saves = {}
+        self._deletes = {}
+
+    def flush(self, workers=None, executor=None):
+        '''Writes the queued saves and deletes to the wrapped database.
+        The models are validated as they are written, workers and executor are passed to save_many.
+        If a write fails, the writes which haven't been made are queued again, so they can be corrected and flushed again,
+        but the batches written before it aren't rolled back.
+        '''
+        deletes, self._deletes = self._deletes, {}
+        saves, self._saves = self._saves, {}
+
+        # saves are written first, so models which no longer reference a deleted model are updated before it is deleted
+        try:
+            for partial, validate in [(False, True), (False, False), (True, True), (True, False)]:
+                keys = [key for key, (obj, is_partial, is_validated) in saves.items() if (is_partial, is_validated) == (partial, validate)]
+                if keys:
+                    self.db.save_many([saves[key][0] for key in keys], partial=partial, validate=validate, workers=workers, executor=executor)
+                for key in keys:
+                    del saves[key]
+
+            deletes = {cls: ids for cls, ids in deletes.items() if ids}
+            if deletes:
+                self.db.delete_keys_many({cls: list(ids) for cls, ids in deletes.items()})
+                deletes = {}
+        except:
+            for key, value in saves.items():
+                self._saves.setdefault(key, value)
+            for cls, ids in deletes.items():
+                self._deletes.setdefault(cls, {}).update(ids)
+            raise
@@ -0,0 +1,255 @@
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from heapq import merge
+from itertools import islice
+from threading import Lock
+from .database import Database
+
+
+class HashRing(object):
+    '''Maps keys to nodes with consistent hashing.
+    Each node is placed on the ring replicas times, so keys are spread evenly,
+    and adding or removing a node only moves the keys of that node.
+    '''
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        # sorted hashes and the node at each
+        self._hashes = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def _hash(self, value):
+        return int.from_bytes(blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            hash = self._hash(f'{node}::{replica}')
+            index = bisect(self._hashes, hash)
+            self._hashes.insert(index, hash)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        points = [(hash, owner) for hash, owner in zip(self._hashes, self._nodes) if owner != node]
+        self._hashes = [hash for hash, owner in points]
+        self._nodes = [owner for hash, owner in points]
+
+    def node(self, key):
+        if not self._hashes:
+            raise ValueError('The ring has no nodes')
+        # the first node clockwise of the key
+        index = bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class ShardedDatabase(Database):
+    '''Spreads the models across several databases.
+    Each model is stored in the shard chosen by a consistent hash of its model name and primary key.
+    Batch operations are sent to every shard involved in parallel.
+
+    shards is a dict of {name: database}, or a list of databases which are named by their position.
+    The names decide where each model is stored, so they must stay the same between processes and restarts.
+
+    Writes to several shards aren't atomic, if one shard fails the others are still written.
+    Unique values and foreign key references are checked across every shard before writing.
+
+    >>> db = ShardedDatabase([RedisDatabase(Redis(port=6379)), RedisDatabase(Redis(port=6380))])
+    >>> db.add_shard('2', RedisDatabase(Redis(port=6381)))
+    >>> db.rebalance([User, Score])
+    '''
+    def __init__(self, shards, replicas=100, workers=None):
+        if not isinstance(shards, dict):
+            shards = {str(index): shard for index, shard in enumerate(shards)}
+        self.shards = {}
+        self.ring = HashRing(replicas=replicas)
+        self.workers = workers
+        self._executor = None
+        self._lock = Lock()
+        for name, shard in shards.items():
+            self.add_shard(name, shard)
+
+    def add_shard(self, name, db):
+        '''Adds a shard to the ring.
+        Models which now belong to the new shard aren't found until rebalance has moved them.
+        '''
+        if name in self.shards:
+            raise ValueError(f'Shard "{name}" already exists')
+        # references are checked across every shard
+        db.check_references = False
+        self.shards[name] = db
+        self.ring.add(name)
+
+    def remove_shard(self, name, models, batch_size=100):
+        '''Moves the models stored in the shard to the remaining shards, and removes it.
+        Returns the removed database.
+        '''
+        self.ring.remove(name)
+        try:
+            self._move(name, self.shards[name], models, batch_size)
+        except:
+            self.ring.add(name)
+            raise
+        db = self.shards.pop(name)
+        db.check_references = True
+        return db
+
+    def rebalance(self, models, batch_size=100):
+        '''Moves every instance of the models which isn't stored in the shard it belongs to.
+        Call this after adding a shard. Returns the number of models moved.
+        '''
+        return sum(self._move(name, shard, models, batch_size) for name, shard in list(self.shards.items()))
+
+    def _move(self, name, shard, models, batch_size):
+        moved = 0
+        for cls in models:
+            for keys in shard.scan_keys(cls, batch_size):
+                targets = {}
+                for id in keys:
+                    owner = self._owner(cls, id)
+                    if owner != name:
+                        targets.setdefault(owner, []).append(id)
+                for owner, ids in targets.items():
+                    documents = shard.load_documents(cls, ids)
+                    # the documents were validated when they were first saved
+                    self.shards[owner].save_many([cls.from_document(self, document) for document in documents if document is not None], validate=False)
+                    shard.delete_keys(cls, ids)
+                    moved += len(ids)
+        return moved
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+        for shard in self.shards.values():
+            close = getattr(shard, 'close', None)
+            if close is not None:
+                close()
+
+    def _owner(self, cls, id):
+        return self.ring.node(f'{cls.__name__}::{id}')
+
+    def shard(self, cls, id):
+        '''Returns the database the model is stored in.
+        '''
+        return self.shards[self._owner(cls, id)]
+
+    def _fan_out(self, fn, groups):
+        '''Calls fn(shard, value) for each {shard name: value}, in parallel if there is more than one.
+        Returns {shard name: result}.
+        '''
+        if len(groups) <= 1:
+            return {name: fn(self.shards[name], value) for name, value in groups.items()}
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers or len(self.shards))
+            executor = self._executor
+        futures = {name: executor.submit(fn, self.shards[name], value) for name, value in groups.items()}
+        # wait for every shard before raising, so nothing is left running
+        errors = [future.exception() for future in futures.values()]
+        for error in errors:
+            if error is not None:
+                raise error
+        return {name: future.result() for name, future in futures.items()}
+
+    def _all(self, fn):
+        return list(self._fan_out(lambda shard, value: fn(shard), {name: None for name in self.shards}).values())
+
+    def _group(self, cls, ids):
+        '''Returns {shard name: [(position, id)]}.
+        '''
+        groups = {}
+        for index, id in enumerate(ids):
+            groups.setdefault(self._owner(cls, id), []).append((index, id))
+        return groups
+
+    def load_documents(self, cls, ids):
+        ids = list(ids)
+        groups = self._group(cls, ids)
+        results = self._fan_out(lambda shard, items: shard.load_documents(cls, [id for index, id in items]), groups)
+        documents = [None] * len(ids)
+        for name, items in groups.items():
+            for (index, id), document in zip(items, results[name]):
+                documents[index] = document
+        return documents
+
+    def save_many(self, objs, partial=False, validate=True, workers=None, executor=None):
+        documents = self._documents(objs, partial, validate, workers, executor)
+        if not documents:
+            return
+        self._check_unique(documents)
+
+        groups = {}
+        for obj, document, is_partial in documents:
+            groups.setdefault(self._owner(obj.__class__, obj.primary_key), []).append(obj)
+        # the models were validated above, so the shards write them as they are
+        self._fan_out(lambda shard, objs: shard.save_many(objs, partial=partial, validate=False), groups)
+
+    def _check_unique(self, documents):
+        claimed = {}
+        for obj, document, is_partial in documents:
+            cls = obj.__class__
+            for field, unique in cls._indexes.items():
+                if not unique or field not in document:
+                    continue
+                for value in self._index_values(document, field):
+                    owners = set(self.find_keys(cls, **{field: value})) - {obj.primary_key}
+                    # check against existing models and the other models being saved
+                    if owners or claimed.setdefault((cls, field, value), obj.primary_key) != obj.primary_key:
+                        raise ValueError(f'{cls.__name__}.{field} must be unique, "{value}" is already in use')
+
+    def update_key(self, cls, id, field, operation, *values):
+        values = self._check_update(cls, field, operation, values)
+        shard = self.shard(cls, id)
+        if cls._indexes.get(field):
+            # unique values are checked across every shard, as they are when saving
+            if operation == 'increment':
+                document = shard.load_documents(cls, [id])[0]
+                added = [self._updated(operation, document.get(field), values)] if document is not None else []
+            else:
+                added = values if operation in ['append', 'add'] else []
+            for value in added:
+                if set(self.find_keys(cls, **{field: value})) - {id}:
+                    raise ValueError(f'{cls.__name__}.{field} must be unique, "{value}" is already in use')
+        return shard.update_key(cls, id, field, operation, *values)
+
+    def delete_keys(self, cls, ids):
+        self.delete_keys_many({cls: ids})
+
+    def delete_keys_many(self, keys):
+        keys = {cls: list(ids) for cls, ids in keys.items() if ids}
+        if not keys:
+            return
+        checks = self._reference_checks(keys)
+        self._check_references(keys, checks, [self.find_keys(referrer, **{field: id}) for referrer, field, cls, id in checks])
+
+        groups = {}
+        for cls, ids in keys.items():
+            for name, items in self._group(cls, ids).items():
+                groups.setdefault(name, {})[cls] = [id for index, id in items]
+        self._fan_out(lambda shard, keys: shard.delete_keys_many(keys), groups)
+
+    def find_keys(self, cls, **equals):
+        return sorted({key for keys in self._all(lambda shard: shard.find_keys(cls, **equals)) for key in keys})
+
+    def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return [key for value, key in self.range_items(cls, field, min, max, descending, offset, limit)]
+
+    def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        self._check_ordered(cls, field)
+        # every shard could hold the first offset + limit models, so they're merged by the values in their ordered indexes
+        count = offset + limit if limit is not None else None
+        items = self._all(lambda shard: shard.range_items(cls, field, min, max, descending, 0, count))
+        merged = merge(*items, key=lambda item: (self._score(item[0]), item[1]), reverse=descending)
+        end = offset + limit if limit is not None else None
+        return list(islice(merged, offset, end))
+
+    def iterate(self, cls, batch_size=100, raw=False):
+        for shard in list(self.shards.values()):
+            for document in shard.iterate(cls, batch_size=batch_size, raw=True):
+                yield document if raw else self._hydrate(cls, document)
+
+    def scan_keys(self, cls, batch_size=100):
+        for shard in list(self.shards.values()):
+            yield from shard.scan_keys(cls, batch_size)
@@ -0,0 +1,338 @@
+import json
+import sqlite3
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from threading import local, Lock
+from cerberedis import CerbeRedis
+from modelus.fields import rules
+from .database import Database, MissingKeysError
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+class Table(object):
+    '''How a model is stored in sqlite, and the statements used to do so.
+    Each field is a column, lists and sets are stored as JSON arrays.
+    Indexed lists and sets also have a table of (key, value) so they can be queried.
+    '''
+    COLUMN_TYPES = {'string': 'TEXT', 'integer': 'INTEGER', 'boolean': 'INTEGER', 'float': 'REAL', 'number': 'REAL', 'binary': 'BLOB'}
+    NATIVE_TYPES = ['string', 'integer', 'float', 'number', 'binary']
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.name = cls.__name__
+        self.key = cls._primary_key
+        self.fields = list(cls.schema)
+        self.key_index = self.fields.index(self.key)
+        self.containers = {field: f'{self.name}::{field}' for field in cls._indexes if cls.schema[field]['type'] in ['list', 'set']}
+        self.lowerers = {field: self._lowerer(cls.schema[field]) for field in self.fields}
+        self.raisers = {field: self._raiser(cls.schema[field]) for field in self.fields}
+        self.item_lowerers = {field: self._lowerer(cls.schema[field]['schema']) for field in self.containers}
+
+        columns = ', '.join(_quote(field) for field in self.fields)
+        self.select = f'SELECT {columns} FROM {_quote(self.name)} WHERE {_quote(self.key)} IN '
+        self.delete = f'DELETE FROM {_quote(self.name)} WHERE {_quote(self.key)} = ?'
+        # statements to save each set of fields, partial saves only update the fields which changed
+        self._upserts = {}
+
+    def create(self, connection):
+        '''Creates the table and its indexes, adding any fields which are missing from an existing table.
+        '''
+        table = _quote(self.name)
+        columns = [f'{_quote(field)} {self._column_type(field)}' + (' PRIMARY KEY' if field == self.key else '') for field in self.fields]
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(columns)})')
+        existing = {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}
+        for field in self.fields:
+            if field not in existing:
+                connection.execute(f'ALTER TABLE {table} ADD COLUMN {_quote(field)} {self._column_type(field)}')
+
+        for field in [*self.cls._indexes, *self.cls._ordered]:
+            index = _quote(f'{self.name}::{field}::index')
+            if field in self.containers:
+                values = _quote(self.containers[field])
+                connection.execute(f'CREATE TABLE IF NOT EXISTS {values} (key, value)')
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {values} (value)')
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {_quote(self.containers[field] + "::key")} ON {values} (key)')
+            elif field != self.key:
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {table} ({_quote(field)})')
+
+    def _column_type(self, field):
+        return self.COLUMN_TYPES.get(self.cls.schema[field]['type'], 'TEXT')
+
+    def _lowerer(self, schema):
+        type = schema['type']
+        if type in ['list', 'set']:
+            lower = self._lowerer(schema['schema'])
+            return lambda x: json.dumps([lower(item) for item in x])
+        if type in self.NATIVE_TYPES:
+            return lambda x: x
+        if type == 'boolean':
+            return int
+        if type == 'datetime':
+            # aware datetimes are stored in UTC so they sort correctly
+            return lambda x: (x.astimezone(timezone.utc) if x.tzinfo is not None else x).isoformat()
+        if type == 'date':
+            return lambda x: x.isoformat()
+        to_bytes, _ = self._rules(type)
+        return lambda x: str(to_bytes(x))
+
+    def _raiser(self, schema):
+        type = schema['type']
+        if type in ['list', 'set']:
+            raise_ = self._raiser(schema['schema'])
+            container = list if type == 'list' else set
+            return lambda x: container(raise_(item) for item in json.loads(x))
+        if type in self.NATIVE_TYPES:
+            return lambda x: x
+        if type == 'boolean':
+            return bool
+        if type == 'datetime':
+            return datetime.fromisoformat
+        if type == 'date':
+            return date.fromisoformat
+        _, from_bytes = self._rules(type)
+        return lambda x: from_bytes(x.encode('utf-8'))
+
+    def _rules(self, type):
+        codec = {**CerbeRedis.rules, **rules()}.get(type)
+        if codec is None:
+            raise TypeError(f'No rules specified for how to handle type "{type}"')
+        return codec
+
+    def lower(self, field, value):
+        return self.lowerers[field](value) if value is not None else None
+
+    def lower_item(self, field, value):
+        # indexed values of containers are stored individually
+        lower = self.item_lowerers.get(field, self.lowerers[field])
+        return lower(value) if value is not None else None
+
+    def raise_key(self, value):
+        return self.raisers[self.key](value)
+
+    def raise_row(self, row):
+        return {field: self.raisers[field](value) for field, value in zip(self.fields, row) if value is not None}
+
+    def upsert(self, fields):
+        '''Returns the statement which inserts the whole document, or only updates the fields if it exists.
+        '''
+        statement = self._upserts.get(fields)
+        if statement is None:
+            columns = ', '.join(_quote(field) for field in self.fields)
+            values = ', '.join('?' for field in self.fields)
+            updates = ', '.join(f'{_quote(field)} = excluded.{_quote(field)}' for field in fields if field != self.key)
+            statement = f'INSERT INTO {_quote(self.name)} ({columns}) VALUES ({values}) ON CONFLICT({_quote(self.key)}) DO '
+            statement += f'UPDATE SET {updates}' if updates else 'NOTHING'
+            self._upserts[fields] = statement
+        return statement
+
+    def query(self, field):
+        '''Returns the statement which selects the keys of the models with a value of field.
+        '''
+        if field in self.containers:
+            return f'SELECT key FROM {_quote(self.containers[field])} WHERE value = ?'
+        return f'SELECT {_quote(self.key)} FROM {_quote(self.name)} WHERE {_quote(field)} = ?'
+
+
+class SQLiteDatabase(Database):
+    '''Stores the models in a sqlite database file, with a table per model.
+
+    Each thread uses its own connection. The database uses write-ahead logging by default,
+    so reads aren't blocked by writes, and synchronous is the sqlite synchronous pragma.
+
+    >>> db = SQLiteDatabase('/var/lib/app/models.db')
+    '''
+    # the maximum number of keys loaded by a single statement
+    BATCH_SIZE = 500
+
+    def __init__(self, path, journal_mode='WAL', synchronous='NORMAL', timeout=5.0):
+        self.path = path
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.timeout = timeout
+        self._local = local()
+        self._lock = Lock()
+        self._connections = []
+        # cls: Table, tables are created the first time the model is used
+        self._tables = {}
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # transactions are started explicitly
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            connection.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            connection.execute(f'PRAGMA synchronous={self.synchronous}')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        '''Closes the connection of every thread.
+        '''
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = local()
+
+    def _table(self, cls):
+        table = self._tables.get(cls)
+        if table is None:
+            table = Table(cls)
+            if self.connection.in_transaction:
+                table.create(self.connection)
+            else:
+                with self._transaction() as connection:
+                    table.create(connection)
+            self._tables[cls] = table
+        return table
+
+    @contextmanager
+    def _transaction(self):
+        connection = self.connection
+        # take the write lock up front, so the reads in the transaction can't be made stale
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def load_documents(self, cls, ids):
+        table = self._table(cls)
+        keys = [table.lower(table.key, id) for id in ids]
+        rows = {}
+        for index in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[index:index + self.BATCH_SIZE]
+            for row in self.connection.execute(table.select + f'({", ".join("?" for key in batch)})', batch):
+                rows[row[table.key_index]] = row
+        return [table.raise_row(rows[key]) if key in rows else None for key in keys]
+
+    def save_many(self, objs, partial=False, validate=True, workers=None, executor=None):
+        documents = self._documents(objs, partial, validate, workers, executor)
+        if not documents:
+            return
+
+        # group the documents by the statement which saves them
+        groups = {}
+        for obj, document, is_partial in documents:
+            table = self._table(obj.__class__)
+            fields = tuple(field for field in table.fields if field in document) if is_partial else tuple(table.fields)
+            # the whole document is inserted in case the model was deleted elsewhere
+            full = {**obj.document(validate=False), **document} if is_partial else document
+            groups.setdefault((table, fields), []).append((obj.primary_key, full))
+
+        with self._transaction() as connection:
+            self._check_unique(connection, groups)
+            for (table, fields), rows in groups.items():
+                connection.executemany(table.upsert(fields), [[table.lower(field, document.get(field)) for field in table.fields] for id, document in rows])
+                for field in fields:
+                    if field in table.containers:
+                        self._replace_values(connection, table, field, rows)
+
+        for obj, document, is_partial in documents:
+            obj.mark_clean()
+
+    def _replace_values(self, connection, table, field, rows):
+        values = table.containers[field]
+        connection.executemany(f'DELETE FROM "{values}" WHERE key = ?', [(table.lower(table.key, id),) for id, document in rows])
+        connection.executemany(f'INSERT INTO "{values}" (key, value) VALUES (?, ?)', [
+            (table.lower(table.key, id), table.lower_item(field, value))
+            for id, document in rows
+            for value in self._index_values(document, field)
+        ])
+
+    def _check_unique(self, connection, groups):
+        claimed = {}
+        for (table, fields), rows in groups.items():
+            for field, unique in table.cls._indexes.items():
+                if not unique or field not in fields:
+                    continue
+                for id, document in rows:
+                    for value in self._index_values(document, field):
+                        owners = {key for key, in connection.execute(table.query(field), (table.lower_item(field, value),))}
+                        # check against existing models and the other models being saved
+                        if owners - {table.lower(table.key, id)} or claimed.setdefault((table.cls, field, value), id) != id:
+                            raise ValueError(f'{table.cls.__name__}.{field} must be unique, "{value}" is already in use')
+
+    def update_key(self, cls, id, field, operation, *values):
+        '''The field is read and written in a single transaction, which holds the write lock.
+        '''
+        values = self._check_update(cls, field, operation, values)
+        table = self._table(cls)
+        column, key = _quote(field), _quote(table.key)
+        with self._transaction() as connection:
+            row = connection.execute(f'SELECT {column} FROM {_quote(table.name)} WHERE {key} = ?', (table.lower(table.key, id),)).fetchone()
+            if row is None:
+                raise MissingKeysError(cls, [id])
+            value = self._updated(operation, table.raisers[field](row[0]) if row[0] is not None else None, values)
+            rows = [(id, {field: value})]
+            self._check_unique(connection, {(table, (field,)): rows})
+            connection.execute(f'UPDATE {_quote(table.name)} SET {column} = ? WHERE {key} = ?', (table.lower(field, value), table.lower(table.key, id)))
+            if field in table.containers:
+                self._replace_values(connection, table, field, rows)
+        return value if operation == 'increment' else None
+
+    def delete_keys(self, cls, ids):
+        self.delete_keys_many({cls: ids})
+
+    def delete_keys_many(self, keys):
+        keys = {cls: list(ids) for cls, ids in keys.items() if ids}
+        if not keys:
+            return
+        with self._transaction() as connection:
+            checks = self._reference_checks(keys)
+            self._check_references(keys, checks, [self._find(connection, referrer, [(field, id)]) for referrer, field, cls, id in checks])
+            for cls, ids in keys.items():
+                table = self._table(cls)
+                rows = [(table.lower(table.key, id),) for id in ids]
+                connection.executemany(table.delete, rows)
+                for values in table.containers.values():
+                    connection.executemany(f'DELETE FROM "{values}" WHERE key = ?', rows)
+
+    def _find(self, connection, cls, query):
+        table = self._table(cls)
+        statement = ' INTERSECT '.join(table.query(field) for field, value in query)
+        return [table.raise_key(key) for key, in connection.execute(statement, [table.lower_item(field, value) for field, value in query])]
+
+    def find_keys(self, cls, **equals):
+        return sorted(self._find(self.connection, cls, self._index_query(cls, equals)))
+
+    def range_keys(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return [key for value, key in self._range(cls, field, min, max, descending, offset, limit)]
+
+    def range_items(self, cls, field, min=None, max=None, descending=False, offset=0, limit=None):
+        return self._range(cls, field, min, max, descending, offset, limit)
+
+    def _range(self, cls, field, min, max, descending, offset, limit):
+        self._check_ordered(cls, field)
+        table = self._table(cls)
+        column, key = _quote(field), _quote(table.key)
+        conditions, values = [f'{column} IS NOT NULL'], []
+        if min is not None:
+            conditions.append(f'{column} >= ?')
+            values.append(table.lower(field, min))
+        if max is not None:
+            conditions.append(f'{column} <= ?')
+            values.append(table.lower(field, max))
+        # equal values are ordered by primary key
+        order = 'DESC' if descending else 'ASC'
+        statement = f'SELECT {column}, {key} FROM {_quote(table.name)} WHERE {" AND ".join(conditions)} ORDER BY {column} {order}, {key} {order} LIMIT ? OFFSET ?'
+        rows = self.connection.execute(statement, [*values, limit if limit is not None else -1, offset])
+        return [(table.raisers[field](value), table.raise_key(key)) for value, key in rows]
+
+    def scan_keys(self, cls, batch_size=100):
+        '''Keys are read in order a batch at a time, so models can be saved and deleted while iterating.
+        '''
+        table = self._table(cls)
+        key = _quote(table.key)
+        statement = f'SELECT {key} FROM {_quote(table.name)} WHERE {key} > ? ORDER BY {key} LIMIT ?'
+        batch = [key for key, in self.connection.execute(f'SELECT {key} FROM {_quote(table.name)} ORDER BY {key} LIMIT ?', (batch_size,))]
+        while batch:
+            yield [table.raise_key(key) for key in batch]
+            batch = [key for key, in self.connection.execute(statement, (batch[-1], batch_size))]
@@ -0,0 +1,63 @@
+'''Packs documents into a single compact binary blob using msgpack.
+
+Types which msgpack doesn't support are packed as extension types.
+Dates, datetimes, IP addresses and sets are supported, other types can be added with register_extension.
+
+>>> data = pack({'id': 'a', 'created': datetime.utcnow()})
+>>> unpack(data)
+{'id': 'a', 'created': datetime.datetime(...)}
+'''
+import struct
+from datetime import date, datetime
+from ipaddress import IPv4Address, IPv6Address
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# type: (code, encode)
+_encoders = {}
+# code: decode
+_decoders = {}
+def register_extension(code, type, encode, decode):
+    '''Registers a type which msgpack doesn't support.
+    encode converts the value to bytes, decode converts the bytes back to the value.
+    code must be unique and between 0 and 127.
+    '''
+    _encoders[type] = (code, encode)
+    _decoders[code] = decode
+
+def _default(value):
+    extension = _encoders.get(type(value))
+    if extension is None:
+        # fall back to a slower lookup for sub-classes
+        extension = next((extension for cls, extension in _encoders.items() if isinstance(value, cls)), None)
+        if extension is None:
+            raise TypeError(f'Cannot pack values of type {type(value).__name__}')
+    code, encode = extension
+    return msgpack.ExtType(code, encode(value))
+
+def _ext_hook(code, data):
+    decode = _decoders.get(code)
+    if decode is None:
+        return msgpack.ExtType(code, data)
+    return decode(data)
+
+def available():
+    return msgpack is not None
+
+def pack(document):
+    return msgpack.packb(document, default=_default, use_bin_type=True)
+
+def unpack(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+DATE = struct.Struct('<i')
+register_extension(1, date, lambda x: DATE.pack(x.toordinal()), lambda x: date.fromordinal(DATE.unpack(x)[0]))
+register_extension(2, datetime, lambda x: x.isoformat().encode('utf-8'), lambda x: datetime.fromisoformat(x.decode('utf-8')))
+register_extension(3, IPv4Address, lambda x: x.packed, IPv4Address)
+register_extension(4, IPv6Address, lambda x: x.packed, IPv6Address)
+register_extension(5, set, lambda x: pack(list(x)), lambda x: set(unpack(x)))
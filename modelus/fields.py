@@ -1,15 +1,31 @@
 from datetime import date, datetime
 from inspect import isclass
-from ipaddress import IPv4Address, IPv6Address
+from ipaddress import ip_address, IPv4Address, IPv6Address
 from cerberus import TypeDefinition
+from modelus.instrumentation import measure
 
 class Field(object):
-    def __init__(self, type, primary_key=False, **kwargs):
+    ORDERED_TYPES = ['integer', 'float', 'number', 'date', 'datetime']
+
+    def __init__(self, type, primary_key=False, index=False, unique=False, ordered=False, **kwargs):
+        '''index maintains a secondary index on the field which can be queried with db.find.
+        unique indicates that no two models may share a value, this implies index.
+        ordered maintains a sorted index on a numeric or temporal field which can be queried with db.range.
+        '''
         self.type = type() if isclass(type) else type
         self.primary_key = primary_key
+        # foreign keys are always indexed so the models referencing a model can be found
+        item_type = self.type.type if isinstance(self.type, (List, Set)) else self.type
+        self.index = index or unique or isinstance(item_type, ForeignKey)
+        self.unique = unique
+        self.ordered = ordered
+        # the slot the value is stored in, set by ModelMeta for compact models
+        self.slot = None
         self.schema = {**self.type.schema, **kwargs}
         if self.primary_key:
             self.schema['required'] = True
+        if self.ordered and self.schema['type'] not in self.ORDERED_TYPES:
+            raise TypeError(f'Fields of type "{self.schema["type"]}" cannot be ordered')
 
     def __set_name__(self, owner, name):
         self.name = name
@@ -17,13 +33,26 @@ class Field(object):
 
     def __set__(self, instance, value):
         value = self.type.set(instance, value)
-        instance._data[self.name] = value
+        if self.slot is None:
+            instance._data[self.name] = value
+        else:
+            setattr(instance, self.slot, value)
+        instance.mark_dirty(self.name)
 
     def __get__(self, instance, value):
-        value = instance._data.get(self.name)
-        value = self.type.get(instance, value)
-        # update the value incase it changed
-        instance._data[self.name] = value
+        if self.slot is None:
+            raw = instance._data.get(self.name)
+        else:
+            raw = getattr(instance, self.slot, None)
+        if raw is None:
+            return None
+        value = self.type.get(instance, raw)
+        # keep the converted value so it isn't converted again
+        if value is not raw:
+            if self.slot is None:
+                instance._data[self.name] = value
+            else:
+                setattr(instance, self.slot, value)
         return value
 
 _types_mapping = {}
@@ -51,6 +80,8 @@ class FieldTypeMeta(type):
 
 class FieldType(object, metaclass=FieldTypeMeta):
     schema = None
+    # whether get converts the stored value, ie. foreign keys load their model
+    resolves = False
 
     def __init__(self, **kwargs):
         self.schema.update(**kwargs)
@@ -108,26 +139,64 @@ class IPV6Address(FieldType):
     rules = {'ipv6address': [lambda x: str(x), lambda x: IPv6Address(x.decode('utf-8'))]}
 
 
-class List(FieldType):
-    schema = {'type': 'list'}
+def _mutator(method):
+    def mutate(self, *args, **kwargs):
+        self._changed()
+        return method(self, *args, **kwargs)
+    mutate.__name__ = method.__name__
+    return mutate
+
+class Tracked(object):
+    '''Marks the field dirty when the container is modified in place.
+    resolved is None if the items are never converted, otherwise it is False once
+    the items need converting again, ie. a foreign key was appended.
+    '''
+    __slots__ = ()
+
+    def _changed(self):
+        if self.instance is not None:
+            self.instance.mark_dirty(self.name)
+        if self.resolved:
+            self.resolved = False
+
+    def __reduce_ex__(self, protocol):
+        # copies and pickles are plain containers which aren't attached to the model
+        return (self.BASE, (self.BASE(self),))
+
+class TrackedList(Tracked, list):
+    BASE = list
+    __slots__ = ('instance', 'name', 'resolved')
+
+    def __init__(self, items=(), instance=None, name=None, resolved=None):
+        super().__init__(items)
+        self.instance = instance
+        self.name = name
+        self.resolved = resolved
 
-    def __init__(self, type, **kwargs):
-        self.type = type() if isclass(type) else type
-        if self.type.schema['type'] in ['list', 'set']:
-            raise TypeError('Container fields are not nestable')
-        super().__init__(schema=self.type.schema, **kwargs)
+class TrackedSet(Tracked, set):
+    BASE = set
+    __slots__ = ('instance', 'name', 'resolved')
 
-    def __set_name__(self, owner, name):
-        self.type.__set_name__(owner, name)
+    def __init__(self, items=(), instance=None, name=None, resolved=None):
+        super().__init__(items)
+        self.instance = instance
+        self.name = name
+        self.resolved = resolved
 
-    def set(self, instance, value):
-        return [self.type.set(instance, item) for item in value]
+for name in ['append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort', 'reverse',
+        '__setitem__', '__delitem__', '__iadd__', '__imul__']:
+    setattr(TrackedList, name, _mutator(getattr(list, name)))
+for name in ['add', 'discard', 'remove', 'pop', 'clear', 'update', 'difference_update',
+        'intersection_update', 'symmetric_difference_update', '__ior__', '__iand__', '__isub__', '__ixor__']:
+    setattr(TrackedSet, name, _mutator(getattr(set, name)))
+del name
 
-    def get(self, instance, value):
-        return [self.type.get(instance, item) for item in value]
 
-class Set(FieldType):
-    schema = {'type': 'set'}
+class Container(FieldType):
+    '''Lists and sets are returned as tracked containers, which are only rebuilt
+    when they are set, or their items need converting.
+    '''
+    tracked = None
 
     def __init__(self, type, **kwargs):
         self.type = type() if isclass(type) else type
@@ -136,16 +205,35 @@ class Set(FieldType):
         super().__init__(schema=self.type.schema, **kwargs)
 
     def __set_name__(self, owner, name):
+        self.name = name
         self.type.__set_name__(owner, name)
 
+    def _track(self, instance, items, resolved):
+        return self.tracked(items, instance, self.name, resolved if self.type.resolves else None)
+
     def set(self, instance, value):
-        return {self.type.set(instance, item) for item in value}
+        items = (self.type.set(instance, item) for item in value)
+        # foreign keys may be set to their keys, which are converted when the field is read
+        return self._track(instance, items, False)
 
     def get(self, instance, value):
-        return {self.type.get(instance, item) for item in value}
+        if type(value) is self.tracked and value.instance is instance and value.resolved is not False:
+            return value
+        if self.type.resolves:
+            value = [self.type.get(instance, item) for item in value]
+        return self._track(instance, value, True)
+
+class List(Container):
+    schema = {'type': 'list'}
+    tracked = TrackedList
+
+class Set(Container):
+    schema = {'type': 'set'}
+    tracked = TrackedSet
 
 class ForeignKey(FieldType):
     schema = {'type': 'string', 'coerce': 'primary_key'}
+    resolves = True
 
     def __init__(self, type, cascade=True, **kwargs):
         '''cascade indicates that when deleting this model, the linked model should be deleted too.
@@ -156,6 +244,8 @@ class ForeignKey(FieldType):
         self.cascade = cascade
 
     def __set_name__(self, owner, name):
+        owner._foreign_keys[name] = self.type
+        self.type._referrers.append((owner, name))
         # register the foreign key cascade with the owner
         if self.cascade:
             cascade = (name, self.type)
@@ -163,14 +253,16 @@ class ForeignKey(FieldType):
 
     def get(self, instance, value):
         if not isinstance(value, self.type):
-            value = instance.db.load(self.type, value)
+            if getattr(instance.db, 'asynchronous', False):
+                raise TypeError('Foreign keys must be loaded with prefetch or resolve when using an asynchronous database')
+            instrument = getattr(instance.db, 'instrument', None)
+            if instrument is None:
+                value = instance.db.load(self.type, value)
+            else:
+                with measure(instrument, self.type, 'dereference'):
+                    value = instance.db.load(self.type, value)
         return value
 
-    # TODO: when set, add a value to the foreign model
-    # TODO: when target model deleted, load the incoming foreign key fields, remove self, and resave
-    # if invalid, it will throw an error
-    # TODO: when built, add a schema value for this field in the target class
-
 
 #class AutoInteger(FieldType):
 #    schema = {'type': 'integer'}
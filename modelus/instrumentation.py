@@ -0,0 +1,251 @@
+'''Reports how long operations take, and where the time goes.
+
+Databases report the latency of each backend operation along with the number of round trips
+and bytes sent to and received from the backend. Models report the time spent validating,
+and foreign keys report the time spent loading them when they are accessed.
+
+Instrumentation is disabled by default, and costs nothing until it is enabled.
+
+>>> aggregator = Aggregator()
+>>> db.instrument = aggregator
+>>> Model.instrument = aggregator
+>>> ...
+>>> aggregator.report()['User']['load_documents']['p99']
+'''
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction, isawaitable
+from threading import Lock
+from time import perf_counter
+
+
+class Instrument(object):
+    '''Receives a record of every operation.
+    Implementations must be thread-safe if the database is shared between threads.
+    '''
+    def record(self, cls, operation, seconds, round_trips=0, bytes_read=0, bytes_written=0):
+        '''cls is the model the operation was performed on, or None if it was performed on several.
+        operation is the name of the database method, 'validate' or 'dereference'.
+        '''
+        pass
+
+
+class Histogram(object):
+    '''Counts values in exponentially sized buckets, each bucket is twice the size of the previous.
+    '''
+    def __init__(self, resolution=1e-6):
+        self.resolution = resolution
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        # bucket: count, values in bucket n are less than resolution * 2 ** n
+        self.buckets = {}
+
+    def add(self, value):
+        bucket = int(value / self.resolution).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        '''Returns an upper bound of the q-th percentile, q is between 0 and 100.
+        '''
+        if not self.count:
+            return 0.
+        remaining = self.count * q / 100.
+        for bucket in sorted(self.buckets):
+            remaining -= self.buckets[bucket]
+            if remaining <= 0:
+                break
+        return min(self.resolution * 2 ** bucket, self.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+
+class Aggregator(Instrument):
+    '''Keeps a latency histogram and the total round trips and bytes for each model and operation.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (model name, operation): [histogram, round trips, bytes read, bytes written]
+            self.operations = {}
+
+    def record(self, cls, operation, seconds, round_trips=0, bytes_read=0, bytes_written=0):
+        key = (cls.__name__ if cls is not None else None, operation)
+        with self._lock:
+            stats = self.operations.get(key)
+            if stats is None:
+                stats = self.operations[key] = [Histogram(), 0, 0, 0]
+            stats[0].add(seconds)
+            stats[1] += round_trips
+            stats[2] += bytes_read
+            stats[3] += bytes_written
+
+    def report(self):
+        '''Returns {model name: {operation: statistics}}, operations performed on several models
+        are reported under None. Times are in seconds.
+        '''
+        report = {}
+        with self._lock:
+            for (name, operation), (histogram, round_trips, bytes_read, bytes_written) in self.operations.items():
+                report.setdefault(name, {})[operation] = {
+                    'count': histogram.count,
+                    'total': histogram.total,
+                    'mean': histogram.mean,
+                    'p50': histogram.percentile(50),
+                    'p90': histogram.percentile(90),
+                    'p99': histogram.percentile(99),
+                    'max': histogram.max,
+                    'round_trips': round_trips,
+                    'bytes_read': bytes_read,
+                    'bytes_written': bytes_written,
+                }
+        return report
+
+
+class Measurement(object):
+    '''The round trips and bytes of the operation in progress.
+    Nested operations add their totals to the operation which called them.
+    '''
+    __slots__ = ('parent', 'round_trips', 'bytes_read', 'bytes_written')
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.round_trips = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+_measurement = ContextVar('modelus_measurement', default=None)
+
+class measure(object):
+    '''Context manager which times the block and reports it to the instrument.
+    '''
+    __slots__ = ('instrument', 'cls', 'operation', 'measurement', 'token', 'start')
+
+    def __init__(self, instrument, cls, operation):
+        self.instrument = instrument
+        self.cls = cls
+        self.operation = operation
+
+    def __enter__(self):
+        self.measurement = Measurement(_measurement.get())
+        self.token = _measurement.set(self.measurement)
+        self.start = perf_counter()
+        return self.measurement
+
+    def __exit__(self, type, value, traceback):
+        seconds = perf_counter() - self.start
+        _measurement.reset(self.token)
+        measurement = self.measurement
+        parent = measurement.parent
+        if parent is not None:
+            parent.round_trips += measurement.round_trips
+            parent.bytes_read += measurement.bytes_read
+            parent.bytes_written += measurement.bytes_written
+        self.instrument.record(self.cls, self.operation, seconds, measurement.round_trips, measurement.bytes_read, measurement.bytes_written)
+
+
+def instrumented(method, instrument):
+    '''Wraps a bound database method so each call is measured.
+    The method's first argument must be a model class, a list of models or a dict of {model class: keys}.
+    '''
+    def arguments(first, args):
+        if isinstance(first, type):
+            return first, (first, *args)
+        if isinstance(first, dict):
+            return next(iter(first)) if len(first) == 1 else None, (first, *args)
+        objs = list(first)
+        classes = {obj.__class__ for obj in objs}
+        return classes.pop() if len(classes) == 1 else None, (objs, *args)
+
+    name = method.__name__
+    if iscoroutinefunction(method):
+        @wraps(method)
+        async def wrapper(first, *args, **kwargs):
+            cls, args = arguments(first, args)
+            with measure(instrument, cls, name):
+                return await method(*args, **kwargs)
+    else:
+        @wraps(method)
+        def wrapper(first, *args, **kwargs):
+            cls, args = arguments(first, args)
+            with measure(instrument, cls, name):
+                return method(*args, **kwargs)
+    return wrapper
+
+
+def size(value):
+    '''Approximates the number of bytes a value is encoded as.
+    '''
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, dict):
+        return sum(size(k) + size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(size(item) for item in value)
+    return len(str(value))
+
+def _count(round_trips=0, bytes_read=0, bytes_written=0):
+    measurement = _measurement.get()
+    if measurement is not None:
+        measurement.round_trips += round_trips
+        measurement.bytes_read += bytes_read
+        measurement.bytes_written += bytes_written
+
+def _counted_result(result):
+    # asynchronous clients return coroutines
+    if isawaitable(result):
+        async def counted():
+            value = await result
+            _count(bytes_read=size(value))
+            return value
+        return counted()
+    _count(bytes_read=size(result))
+    return result
+
+
+class CountingRedis(object):
+    '''Proxies a synchronous or asynchronous redis client, or one of its pipelines,
+    counting the round trips and bytes of each command.
+    '''
+    # scan_iter makes an unknown number of round trips, so it isn't counted, multi doesn't make any
+    PASSTHROUGH = {'reset', 'close', 'aclose', 'scan_iter', 'multi'}
+    # pipeline commands which are sent immediately rather than queued
+    IMMEDIATE = {'watch', 'unwatch'}
+
+    def __init__(self, wrapped, pipeline=False):
+        self.wrapped = wrapped
+        self.pipeline_ = pipeline
+
+    def __getattr__(self, name):
+        attribute = getattr(self.wrapped, name)
+        if not callable(attribute):
+            return attribute
+        if name == 'pipeline':
+            return lambda *args, **kwargs: CountingRedis(attribute(*args, **kwargs), pipeline=True)
+        if name in self.PASSTHROUGH:
+            return attribute
+
+        def command(*args, **kwargs):
+            if self.pipeline_ and name == 'execute':
+                # the queued commands are sent in a single round trip
+                _count(round_trips=1)
+                return _counted_result(attribute(*args, **kwargs))
+            _count(bytes_written=len(name) + size(args) + size(kwargs))
+            if self.pipeline_ and name not in self.IMMEDIATE:
+                attribute(*args, **kwargs)
+                return self
+            _count(round_trips=1)
+            return _counted_result(attribute(*args, **kwargs))
+        return command
@@ -1,16 +1,92 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from datetime import datetime
+from threading import local
+from time import perf_counter
 from cerberus import Validator, TypeDefinition
 from modelus.fields import Field, FieldType, types_mapping
 
 
+# the number of compiled validators kept per model class, per thread
+VALIDATORS_SIZE = 64
+
 _models = {}
 def register_model(model):
-    _models[model.__class__.__name__] = model
+    _models[model.__name__] = model
 def model(name):
     return _models[name]
 
+class ValidationError(ValueError):
+    '''Raised when a document is invalid.
+    errors contains the cerberus errors of each field,
+    index is the position of the document when it was validated by validate_many.
+    '''
+    def __init__(self, errors, index=None):
+        self.errors = errors
+        self.index = index
+        super().__init__(str(errors))
+
+    def __reduce__(self):
+        # returned from worker processes by validate_many
+        return (self.__class__, (self.errors, self.index))
+
+def _lower(value):
+    # converts foreign keys, and containers of them, to their primary keys
+    def primary_key(value):
+        return value.primary_key if isinstance(value, Model) else value
+
+    if isinstance(value, list):
+        return [primary_key(item) for item in value]
+    if isinstance(value, set):
+        return {primary_key(item) for item in value}
+    return primary_key(value)
+
+class SlotData(MutableMapping):
+    '''A dict-like view of the field values stored in the slots of a compact model.
+    '''
+    __slots__ = ('instance',)
+
+    def __init__(self, instance):
+        self.instance = instance
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self.instance, self.instance._slots[name])
+        except (KeyError, AttributeError):
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        slot = self.instance._slots.get(name)
+        if slot is None:
+            raise KeyError(f'{self.instance.__class__.__name__} has no field "{name}"')
+        setattr(self.instance, slot, value)
+
+    def __delitem__(self, name):
+        try:
+            delattr(self.instance, self.instance._slots[name])
+        except (KeyError, AttributeError):
+            raise KeyError(name)
+
+    def __iter__(self):
+        instance = self.instance
+        return iter([name for name, slot in instance._slots.items() if hasattr(instance, slot)])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+def _get_slot_data(self):
+    return SlotData(self)
+def _set_slot_data(self, data):
+    view = SlotData(self)
+    view.clear()
+    view.update(data)
+
 class ModelMeta(type):
-    def __new__(metacls, name, bases, namespace, **kwargs):
+    def __new__(metacls, name, bases, namespace, compact=False, **kwargs):
+        '''If compact is True, field values are stored in __slots__ rather than a per instance dict.
+        This greatly reduces the memory used by each instance, at the cost of
+        not being able to set attributes other than the fields.
+        '''
         def discover_fields():
             return {k:v for k,v in namespace.items() if isinstance(v, Field)}
         def determine_primary_key(fields):
@@ -23,8 +99,16 @@ class ModelMeta(type):
                 if 1 < len(primary_keys):
                     raise TypeError(f'{name} has multiple fields specified as primary_key')
                 return primary_keys[0]
+        def discover_indexes(fields):
+            # indexed field name: unique
+            return {name: field.unique for name, field in fields.items() if field.index}
+        def discover_ordered(fields):
+            return [name for name, field in fields.items() if field.ordered]
         def create_schema():
             return {name: field.schema for name, field in fields.items()}
+        def create_slots(fields):
+            # field name: slot name
+            return {name: f'_slot_{name}' for name in fields}
         def register_model_(cls):
             if name != 'Model':
                 register_model(cls)
@@ -32,15 +116,84 @@ class ModelMeta(type):
         fields = discover_fields()
         namespace['_fields'] = fields
         namespace['_primary_key'] = determine_primary_key(fields)
+        namespace['_indexes'] = discover_indexes(fields)
+        namespace['_ordered'] = discover_ordered(fields)
         namespace['schema'] = create_schema()
-        #namespace['_foreign_key_fields'] = set()
+        # foreign key field name: target model
+        namespace['_foreign_keys'] = {}
         namespace['_foreign_key_cascades'] = set()
+        # the (model, field) of the foreign keys which reference this model
+        namespace['_referrers'] = []
+        # compiled validators are cached per class, per thread
+        namespace['_validators'] = local()
+        if compact:
+            slots = create_slots(fields)
+            namespace['_slots'] = slots
+            namespace['__slots__'] = ('db', '_dirty', *slots.values())
+            namespace['_data'] = property(_get_slot_data, _set_slot_data)
 
         cls = super().__new__(metacls, name, bases, namespace, **kwargs)
+        if compact:
+            for field_name, field in fields.items():
+                field.slot = slots[field_name]
         register_model_(cls)
+        # compile the schema up front so it is ready for the first save
+        # this also surfaces schema errors when the model is defined
+        cls.compiled_validator()
         return cls
 
+    def compiled_validator(cls, fields=None):
+        '''Returns the validator for this model's schema.
+        Validators are compiled once per class and re-used, cerberus validators are stateful
+        so each thread gets its own instance.
+        If fields is provided, the validator only covers those fields.
+        '''
+        key = frozenset(fields) if fields is not None else None
+        return cls._cached_validator(key, lambda: cls.schema if key is None else {name: cls.schema[name] for name in key})
+
+    def compiled_item_validator(cls, field):
+        '''Returns a validator for a single item of a list or set field, which validates {'item': value}.
+        '''
+        return cls._cached_validator(('item', field), lambda: {'item': cls.schema[field]['schema']})
+
+    def _cached_validator(cls, key, schema):
+        validators = getattr(cls._validators, 'validators', None)
+        if validators is None:
+            validators = OrderedDict()
+            cls._validators.validators = validators
+
+        validator = validators.get(key)
+        if validator is None:
+            validator_type = cls.Validator if hasattr(cls, 'Validator') else Validator
+            validator = validator_type(schema())
+            validators[key] = validator
+            # partial saves compile a validator for each set of changed fields, so only the most recently used are kept
+            while len(validators) > VALIDATORS_SIZE:
+                validators.popitem(last=False)
+        else:
+            validators.move_to_end(key)
+        return validator
+
+    def invalidate_validator(cls):
+        '''Discards the compiled validators, call this after modifying the schema.
+        '''
+        cls._validators = local()
+
 class Model(object, metaclass=ModelMeta):
+    '''Declare fields as class attributes.
+    Pass compact=True to store the fields in __slots__, which reduces the memory used per instance.
+
+    >>> class Point(Model, compact=True):
+    ...     id = Field(String, primary_key=True)
+    ...     x = Field(Integer)
+    '''
+    # allows compact models to omit __dict__
+    __slots__ = ()
+    # receives the time spent validating, see modelus.instrumentation
+    instrument = None
+    # loaded models only validate the fields which have changed, set to True to validate every field
+    revalidate = False
+
     class Validator(Validator):
         # load all the cerberus types that are defined in the FieldType classes
         types_mapping = {**Validator.types_mapping, **types_mapping()}
@@ -56,30 +209,115 @@ class Model(object, metaclass=ModelMeta):
     def __init__(self, db, **values):
         self.db = db
         self._data = {}
+        # None indicates the model has not been loaded or saved
+        # in which case every field is considered dirty
+        self._dirty = None
         for k,v in values.items():
             setattr(self, k, v)
 
+    @classmethod
+    def from_document(cls, db, document):
+        '''Creates a clean instance from a document which was validated when it was saved, ie. by a backend.
+        The values are stored as they are rather than being set through the fields.
+        '''
+        obj = cls.__new__(cls)
+        obj.db = db
+        obj._data = document
+        obj._dirty = set()
+        return obj
+
     @property
     def primary_key(self):
         return self._data.get(self._primary_key)
 
+    @property
+    def dirty(self):
+        '''The names of the fields which have changed since the model was last loaded or saved.
+        '''
+        if self._dirty is None:
+            return set(self._data)
+        return set(self._dirty)
+
+    def mark_dirty(self, name):
+        if self._dirty is not None:
+            self._dirty.add(name)
+
+    def mark_clean(self):
+        '''Called by the database once the model matches what is stored.
+        '''
+        self._dirty = set()
+
+    def referrers(self, cls=None, field=None):
+        '''Returns the models which reference this model with a foreign key.
+        cls and field limit the results to a single model or foreign key.
+        ie. modelb.referrers(ModelA, 'keys')
+        '''
+        return self.db.referrers(self, cls, field)
+
     @property
     def validator(self):
-        validator_type = self.Validator if hasattr(self, 'Validator') else Validator
-        return validator_type(self.schema)
+        return type(self).compiled_validator()
+
+    def validate(self, fields=None):
+        '''Normalises and validates the document.
+        If fields is provided, only those fields are normalised and validated.
+        '''
+        instrument = self.instrument
+        if instrument is None:
+            return self._validate(fields)
+        start = perf_counter()
+        try:
+            return self._validate(fields)
+        finally:
+            instrument.record(type(self), 'validate', perf_counter() - start)
+
+    def _validate(self, fields):
+        if fields is None:
+            validator = self.validator
+            document = dict(self._data)
+        else:
+            validator = type(self).compiled_validator(fields)
+            document = {k: v for k, v in self._data.items() if k in fields}
 
-    def validate(self):
         # apply transformation rules
         # validate the resulting document
-        validator = self.validator
-        document = validator.normalized(self._data)
+        document = validator.normalized(document)
         if not validator(document):
-            raise ValueError(str(validator.errors))
+            raise ValidationError(validator.errors)
         return document
 
+    def document(self, partial=False, validate=True):
+        '''Returns the validated document.
+        If partial is True, only the fields which have changed since the last load or save are included.
+        If validate is False, the values are trusted to be valid and are returned as they are,
+        other than foreign keys which are converted to their primary keys.
+        Once the model has been loaded or saved only the changed fields are validated, unless revalidate is set,
+        call validate to validate every field.
+        '''
+        fields = self.dirty if partial else None
+        if not validate:
+            return self._unvalidated(fields)
+        if fields is None and self._dirty is not None and not self.revalidate:
+            # the unchanged fields were validated when they were loaded or saved
+            document = self._unvalidated(set(self._data) - self._dirty)
+            if self._dirty:
+                document.update(self.document(partial=True))
+            return document
+        data = self.validate(fields)
+        self._normalised(data)
+        return data
+
+    def _normalised(self, data):
+        # update any values that were altered as part of normalisation
+        for name, value in data.items():
+            # foreign keys are coerced to their primary keys, keep the models so they aren't loaded again
+            if name in self._foreign_keys and _lower(self._data.get(name)) == value:
+                continue
+            self._data[name] = value
+
+    def _unvalidated(self, fields):
+        return {name: _lower(value) for name, value in self._data.items() if fields is None or name in fields}
+
     @property
     def data(self):
-        data = self.validate()
-        # update any values that were altered as part of normalisation
-        self._data.update(data)
-        return data
+        return self.document()
@@ -0,0 +1,147 @@
+'''Streaming export and import of every instance of a model.
+
+Two formats are supported:
+    jsonl: one JSON object per line, written to and read from a text stream.
+    binary: msgpack encoded records, written to and read from a binary stream.
+        This requires the msgpack package.
+
+Values which aren't supported by the format, such as dates and IP addresses,
+are encoded with the same rules as the Redis backend.
+
+>>> with open('users.jsonl', 'w') as f:
+...     export(db, User, f)
+...
+>>> with open('users.jsonl') as f:
+...     import_(other_db, User, f, workers=4)
+'''
+import json
+from itertools import islice
+from cerberedis import CerbeRedis
+from modelus.fields import rules
+from modelus.model import ValidationError
+from modelus.validation import pool, validate_many
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+FORMATS = ['jsonl', 'binary']
+# types which are stored as they are, everything else is encoded with the field rules
+NATIVE_TYPES = {
+    'jsonl': ['string', 'integer', 'float', 'number', 'boolean'],
+    'binary': ['string', 'integer', 'float', 'number', 'boolean', 'binary'],
+}
+
+def _rules(type):
+    codec = {**CerbeRedis.rules, **rules()}.get(type)
+    if codec is None:
+        raise TypeError(f'No rules specified for how to handle type "{type}"')
+    return codec
+
+def _lower(schema, value, native):
+    if value is None:
+        return None
+    if schema['type'] in ['list', 'set']:
+        return [_lower(schema['schema'], item, native) for item in value]
+    if schema['type'] in native:
+        return value
+    to_bytes, _ = _rules(schema['type'])
+    return str(to_bytes(value))
+
+def _raise(schema, value, native):
+    if value is None:
+        return None
+    if schema['type'] == 'list':
+        return [_raise(schema['schema'], item, native) for item in value]
+    if schema['type'] == 'set':
+        return {_raise(schema['schema'], item, native) for item in value}
+    if schema['type'] in native:
+        return value
+    _, from_bytes = _rules(schema['type'])
+    return from_bytes(value.encode('utf-8'))
+
+def _check_format(format):
+    if format not in FORMATS:
+        raise ValueError(f'Unknown format "{format}", must be one of {FORMATS}')
+    if format == 'binary' and msgpack is None:
+        raise ImportError('The binary format requires msgpack, install it with "pip install msgpack"')
+
+
+def export(db, cls, stream, format='jsonl', batch_size=1000):
+    '''Writes every instance of the model to the stream.
+    The models are read from the database and written in batches of batch_size.
+    Returns the number of models written.
+    '''
+    _check_format(format)
+    native = NATIVE_TYPES[format]
+    fields = list(cls.schema)
+    documents = db.iterate(cls, batch_size=batch_size, raw=True)
+
+    count = 0
+    if format == 'binary':
+        packer = msgpack.Packer()
+        # the field names are written once, each record is a list of values in the same order
+        stream.write(packer.pack(fields))
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            return count
+        count += len(batch)
+        records = [[_lower(cls.schema[name], document.get(name), native) for name in fields] for document in batch]
+        if format == 'binary':
+            stream.write(b''.join(packer.pack(record) for record in records))
+        else:
+            stream.write(''.join(json.dumps(dict(zip(fields, record))) + '\n' for record in records))
+
+def _read(cls, stream, format):
+    native = NATIVE_TYPES[format]
+    if format == 'binary':
+        records = msgpack.Unpacker(stream, use_list=True, raw=False)
+        fields = next(records, [])
+        records = (dict(zip(fields, record)) for record in records)
+    else:
+        records = (json.loads(line) for line in stream if line.strip())
+
+    for record in records:
+        # fields which the model no longer has are ignored
+        yield {
+            name: _raise(cls.schema[name], value, native)
+            for name, value in record.items()
+            if name in cls.schema and value is not None
+        }
+
+def import_(db, cls, stream, format='jsonl', batch_size=1000, validate=True, workers=None):
+    '''Reads models from the stream and saves them, batch_size models at a time.
+    If validate is False, the input is trusted to have already been validated, ie. it was exported
+    from another database, and is written without being validated.
+    If workers is provided, the models are validated by that many processes.
+    Returns the number of models read.
+    '''
+    _check_format(format)
+    documents = _read(cls, stream, format)
+    executor = pool(workers, [cls]) if validate and workers else None
+
+    count = 0
+    try:
+        while True:
+            batch = list(islice(documents, batch_size))
+            if not batch:
+                return count
+
+            if validate:
+                results = validate_many(cls, batch, workers, executor=executor)
+                for result in results:
+                    if isinstance(result, ValidationError):
+                        # the position in the stream rather than the batch
+                        result.index += count
+                        raise result
+                # the documents are already normalised, so they're saved as they are
+                db.save_many([cls.from_document(db, document) for document in results], validate=False)
+            else:
+                db.save_many([cls(db, **document) for document in batch], validate=False)
+            count += len(batch)
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,80 @@
+'''Validates large batches of documents in parallel.
+
+Cerberus validation is pure Python, so a process can only validate on a single core.
+validate_many splits the documents into chunks which are validated by a pool of processes,
+each of which compiles the model's validator once and re-uses it for every chunk.
+The models must be importable by the worker processes, ie. defined at the top level of a module.
+
+The results are the normalised documents, which can be saved without being validated again:
+
+>>> results = validate_many(User, rows, workers=8)
+>>> errors = [result for result in results if isinstance(result, ValidationError)]
+>>> db.save_many([User.from_document(db, result) for result in results if not isinstance(result, ValidationError)], validate=False)
+'''
+from concurrent.futures import ProcessPoolExecutor
+from modelus.model import ValidationError
+
+
+# the maximum number of documents sent to a worker at once
+CHUNK_SIZE = 1000
+
+def _preload(classes):
+    # runs once in each worker process
+    for cls in classes:
+        cls.compiled_validator()
+
+def pool(workers, classes=()):
+    '''Returns a process pool whose workers have compiled the validators of the classes.
+    Pass it to validate_many to share it between batches, and shut it down once finished.
+    '''
+    return ProcessPoolExecutor(workers, initializer=_preload, initargs=(list(classes),))
+
+def _normalised(cls, document):
+    # setting a value can fail before it is validated, ie. compact models have no slot for unknown fields
+    obj = cls(None)
+    errors = {}
+    for name, value in document.items():
+        if name not in cls.schema:
+            errors[name] = ['unknown field']
+            continue
+        try:
+            setattr(obj, name, value)
+        except (AttributeError, TypeError, ValueError) as e:
+            errors[name] = [str(e)]
+    if errors:
+        raise ValidationError(errors)
+    return obj.validate()
+
+def _validate(cls, documents, start=0):
+    results = []
+    for index, document in enumerate(documents, start):
+        try:
+            results.append(_normalised(cls, document))
+        except ValidationError as e:
+            e.index = index
+            results.append(e)
+    return results
+
+def validate_many(cls, documents, workers=None, chunk_size=CHUNK_SIZE, executor=None):
+    '''Normalises and validates the documents, in worker processes if workers or executor is provided.
+    Returns a list in the same order as the documents, of each normalised document
+    or the ValidationError of each invalid document, whose index is its position in documents.
+    '''
+    documents = list(documents)
+    if executor is None and not workers:
+        return _validate(cls, documents)
+
+    shutdown = executor is None
+    if executor is None:
+        executor = pool(workers, [cls])
+    if workers:
+        # smaller batches are split evenly between the workers
+        chunk_size = min(chunk_size, -(-len(documents) // workers))
+    chunk_size = max(chunk_size, 1)
+    try:
+        starts = range(0, len(documents), chunk_size)
+        chunks = executor.map(_validate, [cls] * len(starts), [documents[start:start + chunk_size] for start in starts], starts)
+        return [result for chunk in chunks for result in chunk]
+    finally:
+        if shutdown:
+            executor.shutdown()
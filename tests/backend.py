@@ -2,8 +2,10 @@ import unittest
 import string
 from secrets import choice
 from modelus import *
-from models import Complex, ModelA, ModelB, KEY_LENGTH
+from modelus.backends.database import IntegrityError, MissingKeysError
+from models import Complex, Counter, ModelA, ModelB, ModelC, User, Score, KEY_LENGTH
 from ipaddress import IPv4Address
+from datetime import datetime, timedelta
 
 class TestBackend(unittest.TestCase):
     '''Generic backend test that only requires a different self.db value in setUp
@@ -155,15 +157,374 @@ class TestBackend(unittest.TestCase):
         # a = A()
         # b = B(A=a)
         # a.B
-        # TODO:
+        testb = self.db.create(ModelB, id='a', value='a')
+        other = self.db.create(ModelB, id='b', value='b')
+        testa = self.db.create(ModelA, id='a', keys=[testb, other])
+        testa_b = self.db.create(ModelA, id='b', keys=[testb])
+        testc = self.db.create(ModelC, id='c', parent=testa)
+
+        self.assertEqual(sorted(model.id for model in testb.referrers(ModelA, 'keys')), ['a', 'b'])
+        self.assertEqual([model.id for model in testa.referrers()], ['c'])
+        self.assertEqual(self.db.load(ModelB, 'b').referrers(ModelA)[0].id, 'a')
+        with self.assertRaises(TypeError):
+            testb.referrers(ModelC, 'parent')
+
+        # references are updated on save
+        testa_b.keys = [other]
+        self.db.save(testa_b)
+        self.assertEqual([model.id for model in testb.referrers()], ['a'])
 
         # check that deleting a model that has an incoming foreign key
         # invalidates the outgoing foreign key
         # ie B -> A
         # delete A
         # should trigger an error when trying to delete B
-        testb = self.db.create(ModelB, id='a', value='a')
-        testa = self.db.create(ModelA, id='a', keys=[testb])
-
         with self.assertRaises(TypeError):
             self.db.delete(testb)
+        with self.assertRaises(TypeError):
+            self.db.delete_key(ModelA, 'a')
+        self.assertEqual(self.db.load(ModelB, 'a').value, 'a')
+
+        # including the models referencing the cascaded models
+        with self.assertRaises(TypeError):
+            self.db.delete_many([testc, testa])
+
+        # unless the referencing models are deleted too
+        self.db.delete_many([testc, testa, testa_b])
+        self.assertEqual(self.db.load_many(ModelB, ['a', 'b'], ignore_missing=True), [None, None])
+
+    def partial_save(self):
+        model = self.db.create(Complex,
+            id='abc',
+            string='def',
+            email='abc@example.com',
+            list=['a', 'b'],
+        )
+        self.assertEqual(model.dirty, set())
+
+        # reload and change a single field
+        model = self.db.load(Complex, 'abc')
+        self.assertEqual(model.dirty, set())
+        model.string = 'ghi'
+        self.assertEqual(model.dirty, {'string'})
+        self.db.save(model, partial=True)
+        self.assertEqual(model.dirty, set())
+
+        # untouched fields are preserved
+        model = self.db.load(Complex, 'abc')
+        self.assertEqual(model.string, 'ghi')
+        self.assertEqual(model.email, 'abc@example.com')
+        self.assertEqual(model.generated, 'a' * KEY_LENGTH)
+        self.assertEqual(model.list, ['a', 'b'])
+
+        # containers can be changed in place
+        model.list.append('c')
+        self.db.save(model, partial=True)
+        model = self.db.load(Complex, 'abc')
+        self.assertEqual(model.list, ['a', 'b', 'c'])
+
+        # only the changed fields are validated
+        model = self.db.load(Complex, 'abc')
+        model.email = 'invalid'
+        with self.assertRaises(ValueError):
+            self.db.save(model, partial=True)
+
+        # nothing is written when nothing has changed
+        model = self.db.load(Complex, 'abc')
+        self.db.delete_key(Complex, 'abc')
+        self.db.save(model, partial=True)
+        with self.assertRaises(ValueError):
+            self.db.load(Complex, 'abc')
+
+        # unsaved models are always saved in full
+        model = Complex(self.db, id='abc', string='def', email='abc@example.com')
+        self.db.save(model, partial=True)
+        model = self.db.load(Complex, 'abc')
+        self.assertEqual(model.generated, 'a' * KEY_LENGTH)
+
+    def batch(self):
+        models = [ModelB(self.db, id=str(i), value=str(i)) for i in range(5)]
+        self.db.save_many(models)
+
+        # results are returned in request order
+        loaded = self.db.load_many(ModelB, ['3', '1', '4'])
+        self.assertEqual([model.value for model in loaded], ['3', '1', '4'])
+
+        # missing keys are reported individually
+        with self.assertRaises(MissingKeysError) as context:
+            self.db.load_many(ModelB, ['1', 'x', '2', 'y'])
+        self.assertEqual(context.exception.keys, ['x', 'y'])
+
+        loaded = self.db.load_many(ModelB, ['1', 'x', '2'], ignore_missing=True)
+        self.assertEqual(loaded[0].value, '1')
+        self.assertIsNone(loaded[1])
+        self.assertEqual(loaded[2].value, '2')
+
+        # partial batch saves only write dirty models
+        loaded = self.db.load_many(ModelB, ['0', '1'])
+        loaded[1].value = 'changed'
+        self.db.save_many(loaded, partial=True)
+        self.assertEqual(self.db.load(ModelB, '1').value, 'changed')
+
+        parent = self.db.create(ModelA, id='a', keys=[models[0], models[1]])
+        self.db.delete_many([parent, models[2]])
+        loaded = self.db.load_many(ModelB, ['0', '1', '2', '3', '4'], ignore_missing=True)
+        self.assertEqual([model is None for model in loaded], [True, True, True, False, False])
+        with self.assertRaises(ValueError):
+            self.db.load(ModelA, 'a')
+
+    def prefetch(self):
+        children = [ModelB(self.db, id=str(i), value=str(i)) for i in range(10)]
+        parents = [ModelA(self.db, id=str(i), keys=children[i:i + 5]) for i in range(5)]
+        grandchildren = [ModelC(self.db, id=str(i), parent=parents[i % 5]) for i in range(10)]
+        self.db.save_many(children + parents + grandchildren)
+
+        # count the number of backend fetches
+        calls = []
+        load_documents = self.db.load_documents
+        def counted(cls, ids):
+            calls.append(cls)
+            return load_documents(cls, ids)
+        self.db.load_documents = counted
+
+        loaded = self.db.load_many(ModelC, [str(i) for i in range(10)], prefetch='parent.keys')
+        self.assertEqual(calls, [ModelC, ModelA, ModelB])
+
+        # resolving the foreign keys doesn't load anything further
+        for index, model in enumerate(loaded):
+            parent = model.parent
+            self.assertEqual(parent.id, str(index % 5))
+            self.assertEqual([key.value for key in parent.keys], [str(i) for i in range(index % 5, index % 5 + 5)])
+        self.assertEqual(calls, [ModelC, ModelA, ModelB])
+
+        # the keys are serialised as before
+        self.assertEqual(loaded[0].parent.data['keys'], ['0', '1', '2', '3', '4'])
+
+        del calls[:]
+        model = self.db.load(ModelA, '0', prefetch=['keys'])
+        self.assertEqual(calls, [ModelA, ModelB])
+        self.assertEqual(model.keys[4].value, '4')
+        self.assertEqual(calls, [ModelA, ModelB])
+
+        with self.assertRaises(TypeError):
+            self.db.load(ModelA, '0', prefetch='id')
+
+    def indexes(self):
+        self.db.create(User, id='a', email='a@example.com', group='x', tags={'red', 'blue'})
+        self.db.create(User, id='b', email='b@example.com', group='x', tags={'red'})
+        self.db.create(User, id='c', email='c@example.com', group='y')
+
+        self.assertEqual(self.db.find_keys(User, group='x'), ['a', 'b'])
+        self.assertEqual([user.id for user in self.db.find(User, group='y')], ['c'])
+        self.assertEqual(self.db.find_one(User, email='b@example.com').id, 'b')
+        self.assertIsNone(self.db.find_one(User, email='d@example.com'))
+
+        # containers match any of their values, and queries are combined
+        self.assertEqual(self.db.find_keys(User, tags='red'), ['a', 'b'])
+        self.assertEqual(self.db.find_keys(User, tags='red', group='x', email='a@example.com'), ['a'])
+        self.assertEqual(self.db.find_keys(User, tags='blue', group='y'), [])
+
+        # modifying a saved model doesn't change what is stored
+        user = self.db.load(User, 'c')
+        self.db.save(user)
+        user.tags = set()
+        user.tags.add('red')
+        self.assertEqual(self.db.find_keys(User, tags='red'), ['a', 'b'])
+
+        # indexes are updated on save
+        user = self.db.load(User, 'b')
+        user.group = 'y'
+        user.tags.add('blue')
+        self.db.save(user, partial=True)
+        self.assertEqual(self.db.find_keys(User, group='x'), ['a'])
+        self.assertEqual(self.db.find_keys(User, group='y'), ['b', 'c'])
+        self.assertEqual(self.db.find_keys(User, tags='blue'), ['a', 'b'])
+
+        # unique values can't be re-used
+        with self.assertRaises(ValueError):
+            self.db.create(User, id='d', email='a@example.com')
+        with self.assertRaises(ValueError):
+            self.db.save_many([
+                User(self.db, id='d', email='d@example.com'),
+                User(self.db, id='e', email='d@example.com'),
+            ])
+        self.assertIsNone(self.db.find_one(User, email='d@example.com'))
+
+        # but the owner can save it again
+        user = self.db.load(User, 'a')
+        self.db.save(user)
+        self.assertEqual(self.db.find_one(User, email='a@example.com').id, 'a')
+
+        # indexes are updated on delete
+        self.db.delete(user)
+        self.assertIsNone(self.db.find_one(User, email='a@example.com'))
+        self.assertEqual(self.db.find_keys(User, tags='blue'), ['b'])
+        self.db.create(User, id='d', email='a@example.com')
+
+        # only indexed fields can be queried
+        with self.assertRaises(TypeError):
+            self.db.find(User, id='a')
+
+    def ordered(self):
+        now = datetime(2020, 1, 1)
+        values = [5, 3, 9, 3, 1, 7]
+        self.db.save_many([
+            Score(self.db, id=str(index), value=value, created=now + timedelta(minutes=index))
+            for index, value in enumerate(values)
+        ])
+
+        # equal values are sorted by primary key
+        self.assertEqual(self.db.range_keys(Score, 'value'), ['4', '1', '3', '0', '5', '2'])
+        self.assertEqual(self.db.range_keys(Score, 'value', min=3, max=7), ['1', '3', '0', '5'])
+        self.assertEqual(self.db.range_keys(Score, 'value', min=4), ['0', '5', '2'])
+        self.assertEqual(self.db.range_keys(Score, 'value', max=3, descending=True), ['3', '1', '4'])
+        self.assertEqual(self.db.range_keys(Score, 'value', offset=1, limit=2), ['1', '3'])
+        self.assertEqual(self.db.range_keys(Score, 'value', descending=True, limit=1), ['2'])
+
+        # temporal fields
+        keys = self.db.range_keys(Score, 'created', min=now + timedelta(minutes=2), max=now + timedelta(minutes=3, seconds=30))
+        self.assertEqual(keys, ['2', '3'])
+
+        # values may be returned as their scores
+        items = self.db.range_items(Score, 'value', min=3, max=7, descending=True)
+        self.assertEqual([(self.db._score(value), key) for value, key in items], [(7, '5'), (5, '0'), (3, '3'), (3, '1')])
+        items = self.db.range_items(Score, 'created', offset=4)
+        self.assertEqual([(self.db._score(value), key) for value, key in items], [(self.db._score(now + timedelta(minutes=i)), str(i)) for i in [4, 5]])
+
+        # models are loaded as they are iterated
+        models = self.db.range(Score, 'value', min=7)
+        self.assertEqual([model.value for model in models], [7, 9])
+
+        # ordered indexes are updated on save and delete
+        model = self.db.load(Score, '2')
+        model.value = 0
+        self.db.save(model, partial=True)
+        self.db.delete(self.db.load(Score, '4'))
+        self.assertEqual(self.db.range_keys(Score, 'value', max=3), ['2', '1', '3'])
+
+        with self.assertRaises(TypeError):
+            self.db.range_keys(Score, 'id')
+
+    def iterate(self):
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(25)])
+        self.db.create(ModelA, id='a', keys=[])
+
+        models = list(self.db.iterate(ModelB, batch_size=10))
+        self.assertEqual(sorted(int(model.id) for model in models), list(range(25)))
+        self.assertTrue(all(model.value == model.id for model in models))
+
+        # raw documents are not hydrated
+        documents = list(self.db.iterate(ModelB, batch_size=7, raw=True))
+        self.assertEqual(sorted(int(document['id']) for document in documents), list(range(25)))
+        self.assertEqual(documents[0]['value'], documents[0]['id'])
+
+        # only a batch of keys is returned at a time
+        batches = list(self.db.scan_keys(ModelB, batch_size=10))
+        self.assertTrue(all(len(batch) <= 10 for batch in batches))
+        self.assertEqual(sorted(key for batch in batches for key in batch), sorted(str(i) for i in range(25)))
+
+        # models deleted while iterating are skipped
+        iterator = self.db.iterate(ModelB, batch_size=5)
+        first = next(iterator)
+        self.db.delete_keys(ModelB, [str(i) for i in range(25) if str(i) != first.id])
+        self.assertLessEqual(len(list(iterator)), 4)
+        self.assertEqual([model.id for model in self.db.iterate(ModelA)], ['a'])
+
+    def cascade(self):
+        children = [ModelB(self.db, id=str(i), value=str(i)) for i in range(10)]
+        # the parents share children
+        parents = [ModelA(self.db, id=str(i), keys=children[i:i + 5]) for i in range(5)]
+        self.db.save_many(children + parents)
+        parents = self.db.load_many(ModelA, [str(i) for i in range(5)])
+
+        calls = []
+        load_documents, delete_keys_many = self.db.load_documents, self.db.delete_keys_many
+        def counted_load(cls, ids):
+            calls.append(('load', cls, sorted(ids)))
+            return load_documents(cls, ids)
+        def counted_delete(keys):
+            calls.append(('delete', {cls: sorted(ids) for cls, ids in keys.items()}))
+            return delete_keys_many(keys)
+        self.db.load_documents, self.db.delete_keys_many = counted_load, counted_delete
+
+        # each level is loaded once, and every key is deleted together
+        self.db.delete_many(parents + parents[:1])
+        self.assertEqual(calls, [
+            ('load', ModelB, [str(i) for i in range(9)]),
+            ('delete', {ModelA: [str(i) for i in range(5)], ModelB: [str(i) for i in range(9)]}),
+        ])
+        self.assertEqual([model.id for model in self.db.iterate(ModelB)], ['9'])
+        self.assertEqual(list(self.db.iterate(ModelA)), [])
+
+    def atomic_updates(self):
+        counter = self.db.create(Counter, id='a', count=1, tags=['x'])
+        # the model is updated along with what is stored, empty fields are incremented from 0
+        self.assertEqual(self.db.increment(counter, 'count', 2), 3)
+        self.assertEqual(self.db.increment(counter, 'total', 0.5), 0.5)
+        self.db.append(counter, 'tags', 'y', 'x')
+        self.db.remove(counter, 'tags', 'x')
+        self.db.add(counter, 'labels', 'a', 'b')
+        self.db.discard(counter, 'labels', 'a', 'c')
+        for obj in [counter, self.db.load(Counter, 'a')]:
+            self.assertEqual((obj.count, obj.total, obj.tags, obj.labels), (3, 0.5, ['y'], {'b'}))
+        self.assertEqual(counter.dirty, set())
+
+        # updates aren't lost when made from models loaded at the same time
+        other = self.db.load(Counter, 'a')
+        self.db.update_key(Counter, 'a', 'count', 'increment', 10)
+        self.assertEqual(self.db.increment(other, 'count', -1), 12)
+        self.assertEqual(self.db.load(Counter, 'a').count, 12)
+
+        # indexes are updated
+        user = self.db.create(User, id='a', email='a@example.com', tags={'red'})
+        self.db.add(user, 'tags', 'blue')
+        self.db.discard(user, 'tags', 'red')
+        self.assertEqual(self.db.find_keys(User, tags='blue'), ['a'])
+        self.assertEqual(self.db.find_keys(User, tags='red'), [])
+        self.db.save_many([Score(self.db, id='a', value=1), Score(self.db, id='b', value=5)])
+        self.assertEqual(self.db.update_key(Score, 'a', 'value', 'increment', 10), 11)
+        self.assertEqual(self.db.range_keys(Score, 'value'), ['b', 'a'])
+
+        # unique values are checked
+        self.db.add(counter, 'codes', 'a', 'b')
+        second = self.db.create(Counter, id='b')
+        with self.assertRaises(ValueError):
+            self.db.add(second, 'codes', 'c', 'a')
+        self.assertEqual(self.db.find_keys(Counter, codes='a'), ['a'])
+        self.assertEqual(self.db.find_keys(Counter, codes='c'), [])
+
+        # foreign keys are stored as their primary key, and referenced models can't be deleted
+        child = self.db.create(ModelB, id='b', value='b')
+        parent = self.db.create(ModelA, id='a', keys=[])
+        self.db.append(parent, 'keys', child)
+        self.assertEqual([obj.value for obj in self.db.load(ModelA, 'a').keys], ['b'])
+        with self.assertRaises(IntegrityError):
+            self.db.delete_key(ModelB, 'b')
+        self.db.remove(parent, 'keys', 'b')
+        self.assertEqual(parent.keys, [])
+        self.db.delete_key(ModelB, 'b')
+
+        # the operation must match the field, and the values its schema
+        with self.assertRaises(TypeError):
+            self.db.increment(counter, 'tags')
+        with self.assertRaises(TypeError):
+            self.db.append(counter, 'labels', 'a')
+        with self.assertRaises(TypeError):
+            self.db.update_key(Counter, 'a', 'id', 'increment', 1)
+        with self.assertRaises(ValueError):
+            self.db.increment(counter, 'count', 0.5)
+        with self.assertRaises(ValueError):
+            self.db.append(counter, 'tags', 1)
+        with self.assertRaises(ValueError):
+            self.db.append(counter, 'emails', 'a@example.com', 'a')
+        self.db.append(counter, 'emails', 'a@example.com')
+        with self.assertRaises(ValueError):
+            self.db.update_key(Counter, 'a', 'count', 'multiply', 2)
+        counter = self.db.load(Counter, 'a')
+        self.assertEqual((counter.tags, counter.emails), (['y'], ['a@example.com']))
+
+        # updates don't create models
+        for field, operation, value in [('count', 'increment', 1), ('tags', 'append', 'a'), ('codes', 'add', 'd')]:
+            with self.assertRaises(MissingKeysError):
+                self.db.update_key(Counter, 'c', field, operation, value)
+        self.assertEqual(self.db.load_many(Counter, ['c'], ignore_missing=True), [None])
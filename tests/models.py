@@ -27,3 +27,47 @@ class ModelB(Model):
 class ModelA(Model):
     id = Field(String, primary_key=True)
     keys = Field(List(ForeignKey(ModelB, cascade=True)))
+
+class ModelC(Model):
+    id = Field(String, primary_key=True)
+    parent = Field(ForeignKey(ModelA, cascade=False))
+
+# models with indexed fields
+class User(Model):
+    id = Field(String, primary_key=True)
+    email = Field(EmailAddress, unique=True)
+    group = Field(String, index=True)
+    tags = Field(Set(String), index=True)
+
+# models with ordered fields
+class Score(Model):
+    id = Field(String, primary_key=True)
+    value = Field(Integer, ordered=True)
+    created = Field(DateTime, ordered=True)
+
+# models with fields which are updated atomically
+class Counter(Model):
+    id = Field(String, primary_key=True)
+    count = Field(Integer)
+    total = Field(Float)
+    tags = Field(List(String))
+    labels = Field(Set(String))
+    codes = Field(Set(String), unique=True)
+    emails = Field(List(EmailAddress))
+
+# models with fields that require encoding
+class Record(Model):
+    id = Field(Integer, primary_key=True)
+    day = Field(Date)
+    created = Field(DateTime)
+    address = Field(IPAddress)
+    ipv4_address = Field(IPV4Address)
+    ipv6_address = Field(IPV6Address)
+    days = Field(Set(Date))
+    flag = Field(Boolean)
+
+# a model whose fields are stored in slots
+class Point(Model, compact=True):
+    id = Field(String, primary_key=True)
+    x = Field(Integer)
+    tags = Field(List(String))
@@ -0,0 +1,156 @@
+import asyncio
+import gc
+import unittest
+from modelus import *
+from modelus.backends.async_redis import AsyncRedisDatabase
+from modelus.backends.database import MissingKeysError
+from modelus.backends.redis import RedisDatabase
+from fakeredis import FakeAsyncRedis, FakeServer, FakeRedis
+from models import Counter, ModelA, ModelB, ModelC, User
+
+class TestAsyncRedisDatabase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeServer()
+        self.redis = FakeAsyncRedis(server=self.server)
+        self.db = AsyncRedisDatabase(self.redis)
+
+    async def asyncTearDown(self):
+        await self.redis.flushall()
+
+    def count_pipelines(self):
+        calls = []
+        pipeline = self.redis.pipeline
+        def counted(*args, **kwargs):
+            calls.append(kwargs)
+            return pipeline(*args, **kwargs)
+        self.redis.pipeline = counted
+        return calls
+
+    async def test_not_found(self):
+        with self.assertRaises(ValueError):
+            await self.db.load(ModelB, 'abcdef')
+
+    async def test_create_load_save_delete(self):
+        model = await self.db.create(ModelB, id='a', value='a')
+        model = await self.db.load(ModelB, 'a')
+        self.assertEqual(model.value, 'a')
+
+        model.value = 'b'
+        await self.db.save(model, partial=True)
+        self.assertEqual((await self.db.load(ModelB, 'a')).value, 'b')
+
+        await self.db.delete(model)
+        with self.assertRaises(ValueError):
+            await self.db.load(ModelB, 'a')
+
+    async def test_shared_layout(self):
+        # models saved asynchronously can be loaded synchronously
+        await self.db.create(User, id='a', email='a@example.com', tags={'red'})
+        db = RedisDatabase(FakeRedis(server=self.server))
+        self.assertEqual(db.load(User, 'a').tags, {'red'})
+        self.assertEqual(db.find_keys(User, email='a@example.com'), ['a'])
+        self.assertEqual(await self.db.find_keys(User, tags='red'), ['a'])
+
+    async def test_concurrent_loads(self):
+        await self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(10)])
+        calls = self.count_pipelines()
+
+        # concurrent loads are sent in a single pipeline
+        models = await asyncio.gather(*[self.db.load(ModelB, str(i)) for i in range(10)])
+        self.assertEqual([model.value for model in models], [str(i) for i in range(10)])
+        self.assertEqual(len(calls), 1)
+
+        # errors are reported to the correct caller
+        results = await asyncio.gather(
+            self.db.load(ModelB, '1'),
+            self.db.load(ModelB, 'missing'),
+            self.db.load_many(ModelB, ['2', 'x', 'y'], ignore_missing=True),
+            return_exceptions=True,
+        )
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(results[0].value, '1')
+        self.assertIsInstance(results[1], MissingKeysError)
+        self.assertEqual(results[2][0].value, '2')
+        self.assertEqual(results[2][1:], [None, None])
+
+        # the task sending the pipeline is referenced until it finishes, so it can't be garbage collected
+        load = asyncio.ensure_future(self.db.load(ModelB, '1'))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(len(self.db._tasks), 1)
+        gc.collect()
+        self.assertEqual((await load).value, '1')
+        self.assertEqual(self.db._tasks, set())
+
+    async def test_foreign_keys(self):
+        children = [await self.db.create(ModelB, id=str(i), value=str(i)) for i in range(3)]
+        await self.db.create(ModelA, id='a', keys=children)
+        await self.db.create(ModelC, id='c', parent='a')
+
+        # foreign keys can't be loaded synchronously
+        model = await self.db.load(ModelA, 'a')
+        with self.assertRaises(TypeError):
+            model.keys
+
+        keys = await self.db.resolve(model, 'keys')
+        self.assertEqual([key.value for key in keys], ['0', '1', '2'])
+
+        model = await self.db.load(ModelC, 'c', prefetch='parent.keys')
+        self.assertEqual(model.parent.keys[2].value, '2')
+
+        # models which are still referenced can't be deleted
+        self.assertEqual([model.id for model in await model.parent.referrers(ModelC)], ['c'])
+        with self.assertRaises(TypeError):
+            await self.db.delete(await self.db.load(ModelA, 'a'))
+
+        # cascades are followed
+        await self.db.delete_many([await self.db.load(ModelA, 'a'), await self.db.load(ModelC, 'c')])
+        self.assertEqual(await self.db.load_many(ModelB, ['0', '1', '2'], ignore_missing=True), [None, None, None])
+
+    async def test_iterate(self):
+        await self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(25)])
+        await self.db.create(ModelA, id='a', keys=['0'])
+
+        models = [model async for model in self.db.iterate(ModelB, batch_size=10)]
+        self.assertEqual(sorted(int(model.id) for model in models), list(range(25)))
+
+        documents = [document async for document in self.db.iterate(ModelA, raw=True)]
+        self.assertEqual(documents, [{'id': 'a', 'keys': ['0']}])
+
+    async def test_atomic_updates(self):
+        counter = await self.db.create(Counter, id='a', count=1)
+        user = await self.db.create(User, id='a', tags={'red'})
+        results = await asyncio.gather(*[self.db.increment(counter, 'count') for i in range(5)])
+        self.assertEqual(sorted(results), [2, 3, 4, 5, 6])
+        await asyncio.gather(self.db.append(counter, 'tags', 'a'), self.db.add(user, 'tags', 'blue'), self.db.discard(user, 'tags', 'red'))
+        self.assertEqual((await self.db.load(Counter, 'a')).tags, ['a'])
+        self.assertEqual(user.tags, {'blue'})
+        self.assertEqual(await self.db.find_keys(User, tags='blue'), ['a'])
+        self.assertEqual(await self.db.find_keys(User, tags='red'), [])
+
+        with self.assertRaises(MissingKeysError):
+            await self.db.update_key(Counter, 'b', 'count', 'increment', 1)
+        with self.assertRaises(MissingKeysError):
+            await self.db.update_key(User, 'b', 'tags', 'add', 'red')
+
+        # blob models are rewritten in a watched transaction
+        self.db = AsyncRedisDatabase(self.redis, blob_models=[Counter])
+        counter = await self.db.create(Counter, id='b', tags=['a'])
+        await asyncio.gather(self.db.increment(counter, 'count', 2), self.db.append(counter, 'tags', 'b'))
+        counter = await self.db.load(Counter, 'b')
+        self.assertEqual((counter.count, counter.tags), (2, ['a', 'b']))
+
+    async def test_blob_models(self):
+        self.db = AsyncRedisDatabase(self.redis, blob_models=[ModelA, ModelB])
+        await asyncio.gather(*[self.db.create(ModelB, id=str(i), value=str(i)) for i in range(3)])
+        await self.db.create(ModelA, id='a', keys=['0', '1'])
+        self.assertEqual(await self.redis.type('ModelA::a'), b'string')
+
+        models = await asyncio.gather(self.db.load(ModelA, 'a', prefetch='keys'), self.db.load(ModelB, '2'))
+        self.assertEqual([key.id for key in models[0].keys], ['0', '1'])
+        self.assertEqual(models[1].value, '2')
+        self.assertEqual(sorted([model.id async for model in self.db.iterate(ModelB)]), ['0', '1', '2'])
+
+        # the layout is shared with the synchronous backend
+        db = RedisDatabase(FakeRedis(server=self.server), blob_models=[ModelA, ModelB])
+        self.assertEqual(db.load(ModelB, '1').value, '1')
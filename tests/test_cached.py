@@ -0,0 +1,164 @@
+import unittest
+from modelus import *
+from modelus.backends.cached import CachedDatabase
+from modelus.backends.memory import MemoryDatabase
+from backend import TestBackend
+from models import ModelA, ModelB
+
+class TestCachedDatabase(TestBackend):
+    def setUp(self):
+        self.memory = MemoryDatabase()
+        self.db = CachedDatabase(self.memory)
+
+    def count_loads(self):
+        calls = []
+        load_documents = self.memory.load_documents
+        def counted(cls, ids):
+            calls.append(list(ids))
+            return load_documents(cls, ids)
+        self.memory.load_documents = counted
+        return calls
+
+    def test_not_found(self):
+        self.not_found()
+
+    def test_model_and_fields(self):
+        self.model_and_fields()
+
+    def test_foreign_keys(self):
+        self.foreign_keys()
+
+    def test_partial_save(self):
+        self.partial_save()
+
+    def test_batch(self):
+        self.batch()
+
+    def test_prefetch(self):
+        self.prefetch()
+
+    def test_indexes(self):
+        self.indexes()
+
+    def test_ordered(self):
+        self.ordered()
+
+    def test_iterate(self):
+        self.iterate()
+
+    def test_cascade(self):
+        self.cascade()
+
+    def test_reverse_foreign_keys(self):
+        self.reverse_foreign_keys()
+
+    def test_atomic_updates(self):
+        self.atomic_updates()
+
+    def test_read_through(self):
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(3)])
+        calls = self.count_loads()
+
+        self.assertEqual(self.db.load(ModelB, '0').value, '0')
+        self.assertEqual([model.value for model in self.db.load_many(ModelB, ['0', '1', '2'])], ['0', '1', '2'])
+        # only the uncached documents are loaded
+        self.assertEqual(calls, [['0'], ['1', '2']])
+        self.assertEqual(self.db.stats, {'hits': 1, 'misses': 3, 'evictions': 0, 'size': 3})
+
+        # cached models can be modified without changing the cache
+        model = self.db.load(ModelB, '0')
+        model.value = 'changed'
+        self.assertEqual(self.db.load(ModelB, '0').value, '0')
+        self.assertEqual(len(calls), 2)
+
+        # saves and deletes invalidate the cache
+        self.db.save(model)
+        self.assertEqual(self.db.load(ModelB, '0').value, 'changed')
+        self.db.delete(model)
+        with self.assertRaises(ValueError):
+            self.db.load(ModelB, '0')
+        self.assertEqual(len(calls), 4)
+
+    def test_invalidated_while_loading(self):
+        self.db.save_many([ModelB(self.db, id=str(i), value='old') for i in range(2)])
+        load_documents = self.memory.load_documents
+        def interleave(cls, ids):
+            # another thread saves and deletes after the documents were read, but before they are cached
+            documents = load_documents(cls, ids)
+            self.memory.load_documents = load_documents
+            self.db.save(ModelB(self.db, id='0', value='new'))
+            self.db.delete_key(ModelB, '1')
+            return documents
+        self.memory.load_documents = interleave
+
+        self.assertEqual([model.value for model in self.db.load_many(ModelB, ['0', '1'])], ['old', 'old'])
+        self.assertEqual(self.db.stats['size'], 0)
+        self.assertEqual(self.db.load(ModelB, '0').value, 'new')
+        self.assertEqual(self.db.load_many(ModelB, ['1'], ignore_missing=True), [None])
+
+    def test_invalidated_after_loading(self):
+        class Interleave(object):
+            # runs hook before the lock is next acquired count times
+            def __init__(self, lock):
+                self.lock = lock
+                self.count = None
+            def __enter__(self):
+                if self.count is not None:
+                    self.count -= 1
+                    if not self.count:
+                        self.count = None
+                        self.hook()
+                return self.lock.__enter__()
+            def __exit__(self, *args):
+                return self.lock.__exit__(*args)
+
+        lock = self.db._lock = Interleave(self.db._lock)
+        load_documents = self.memory.load_documents
+        def fetched(cls, ids):
+            documents = load_documents(cls, ids)
+            lock.count = self.count
+            return documents
+        self.memory.load_documents = fetched
+
+        # another thread saves at each point after the document is fetched
+        for self.count in [1, 2]:
+            self.db.create(ModelB, id='a', value='old')
+            lock.hook = lambda: self.db.save(ModelB(self.db, id='a', value='new'))
+            self.assertEqual(self.db.load(ModelB, 'a').value, 'old')
+            self.assertIsNone(lock.count)
+            self.assertEqual(self.db.load(ModelB, 'a').value, 'new')
+            self.db.clear()
+
+    def test_lru(self):
+        self.db = CachedDatabase(self.memory, maxsize=2)
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(3)])
+        calls = self.count_loads()
+
+        self.db.load_many(ModelB, ['0', '1'])
+        self.db.load(ModelB, '0')
+        self.db.load(ModelB, '2')
+        self.assertEqual(self.db.stats['evictions'], 1)
+
+        # the least recently used document was evicted
+        self.db.load_many(ModelB, ['0', '2'])
+        self.assertEqual(len(calls), 2)
+        self.db.load(ModelB, '1')
+        self.assertEqual(len(calls), 3)
+
+    def test_ttl(self):
+        self.db = CachedDatabase(self.memory, ttl=0)
+        self.db.create(ModelB, id='a', value='a')
+        calls = self.count_loads()
+        self.db.load(ModelB, 'a')
+        self.db.load(ModelB, 'a')
+        self.assertEqual(len(calls), 2)
+
+    def test_models(self):
+        self.db = CachedDatabase(self.memory, models=[ModelA])
+        testb = self.db.create(ModelB, id='a', value='a')
+        self.db.create(ModelA, id='a', keys=[testb])
+        calls = self.count_loads()
+        for i in range(2):
+            self.db.load(ModelA, 'a')
+            self.db.load(ModelB, 'a')
+        self.assertEqual(len(calls), 3)
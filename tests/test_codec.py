@@ -0,0 +1,34 @@
+import unittest
+from datetime import date, datetime, timezone
+from ipaddress import IPv4Address, IPv6Address
+from modelus import codec
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        document = {
+            'id': 'a',
+            'count': 1,
+            'ratio': 0.5,
+            'flag': True,
+            'data': b'\x00\x01',
+            'day': date(2020, 1, 2),
+            'created': datetime(2020, 1, 2, 3, 4, 5, 6),
+            'aware': datetime(2020, 1, 2, tzinfo=timezone.utc),
+            'ipv4': IPv4Address('127.0.0.1'),
+            'ipv6': IPv6Address('::1'),
+            'days': {date(2020, 1, 1), date(2020, 1, 2)},
+            'tags': ['a', 'b'],
+        }
+        self.assertEqual(codec.unpack(codec.pack(document)), document)
+
+    def test_extension(self):
+        with self.assertRaises(TypeError):
+            codec.pack({'point': Point(1, 2)})
+
+        codec.register_extension(100, Point, lambda x: codec.pack([x.x, x.y]), lambda x: Point(*codec.unpack(x)))
+        point = codec.unpack(codec.pack({'point': Point(1, 2)}))['point']
+        self.assertEqual((point.x, point.y), (1, 2))
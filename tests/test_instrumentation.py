@@ -0,0 +1,88 @@
+import asyncio
+import unittest
+from modelus import *
+from modelus.backends.async_redis import AsyncRedisDatabase
+from modelus.backends.memory import MemoryDatabase
+from modelus.backends.redis import RedisDatabase
+from modelus.instrumentation import Aggregator, CountingRedis, Histogram
+from fakeredis import FakeAsyncRedis, FakeRedis
+from models import ModelA, ModelB
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = Aggregator()
+        Model.instrument = self.aggregator
+
+    def tearDown(self):
+        Model.instrument = None
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in [0.001] * 98 + [0.1, 1.]:
+            histogram.add(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.mean, (0.098 + 1.1) / 100)
+        # percentiles are an upper bound within a factor of 2
+        self.assertTrue(0.001 <= histogram.percentile(50) < 0.002)
+        self.assertTrue(0.1 <= histogram.percentile(99) < 0.2)
+        self.assertEqual(histogram.percentile(100), 1.)
+
+    def test_memory(self):
+        db = MemoryDatabase()
+        db.instrument = self.aggregator
+        children = [ModelB(db, id=str(i), value=str(i)) for i in range(3)]
+        db.save_many(children)
+        db.create(ModelA, id='a', keys=children)
+        model = db.load(ModelA, 'a')
+        [key.value for key in model.keys]
+
+        report = self.aggregator.report()
+        self.assertEqual(report['ModelB']['save_many']['count'], 1)
+        self.assertEqual(report['ModelB']['validate']['count'], 3)
+        self.assertEqual(report['ModelA']['load_documents']['count'], 1)
+        # foreign keys loaded on access are reported, along with the loads they made
+        self.assertEqual(report['ModelB']['dereference']['count'], 3)
+        self.assertEqual(report['ModelB']['load_documents']['count'], 3)
+        self.assertEqual(report['ModelB']['load_documents']['round_trips'], 0)
+
+        # removing the instrument removes the wrappers
+        db.instrument = None
+        self.assertNotIn('load_documents', vars(db))
+        db.load(ModelB, '0')
+        self.assertEqual(self.aggregator.report()['ModelB']['load_documents']['count'], 3)
+
+    def test_redis(self):
+        redis = FakeRedis()
+        db = RedisDatabase(redis)
+        db.instrument = self.aggregator
+        self.assertIsInstance(db.redis, CountingRedis)
+
+        db.save_many([ModelB(db, id=str(i), value='x' * 100) for i in range(10)])
+        db.load_many(ModelB, [str(i) for i in range(10)])
+        db.load(ModelB, '0')
+
+        report = self.aggregator.report()['ModelB']
+        # batches are pipelined into a single round trip
+        self.assertEqual(report['save_many']['round_trips'], 1)
+        self.assertGreater(report['save_many']['bytes_written'], 1000)
+        self.assertEqual(report['load_documents']['count'], 2)
+        self.assertEqual(report['load_documents']['round_trips'], 2)
+        self.assertGreater(report['load_documents']['bytes_read'], 1100)
+        self.assertGreater(report['load_documents']['p50'], 0)
+
+        db.instrument = None
+        self.assertIs(db.redis, redis)
+
+    def test_async_redis(self):
+        async def run():
+            db = AsyncRedisDatabase(FakeAsyncRedis())
+            db.instrument = self.aggregator
+            await db.save_many([ModelB(db, id=str(i), value=str(i)) for i in range(5)])
+            await asyncio.gather(*[db.load(ModelB, str(i)) for i in range(5)])
+        asyncio.run(run())
+
+        report = self.aggregator.report()['ModelB']
+        self.assertEqual(report['save_many']['round_trips'], 1)
+        self.assertEqual(report['load_documents']['count'], 5)
+        # concurrent loads share a single round trip
+        self.assertEqual(report['load_documents']['round_trips'], 1)
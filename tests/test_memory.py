@@ -1,13 +1,21 @@
+import os
 import unittest
 import string
+from datetime import datetime
 from secrets import choice
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import sleep
 from modelus import *
-from modelus.backends.memory import MemoryDatabase
+from modelus.backends.memory import MemoryDatabase, ConcurrentMemoryDatabase
 from backend import TestBackend
+from models import Counter, ModelA, ModelB, User, Score
 
 class TestMemoryDatabase(TestBackend):
+    database = MemoryDatabase
+
     def setUp(self):
-        self.db = MemoryDatabase()
+        self.db = self.database()
 
     def test_not_found(self):
         self.not_found()
@@ -18,6 +26,209 @@ class TestMemoryDatabase(TestBackend):
     def test_foreign_keys(self):
         self.foreign_keys()
 
-    @unittest.skip('Reverse foreign keys not implemented')
+    def test_partial_save(self):
+        self.partial_save()
+
+    def test_batch(self):
+        self.batch()
+
+    def test_prefetch(self):
+        self.prefetch()
+
+    def test_indexes(self):
+        self.indexes()
+
+    def test_ordered(self):
+        self.ordered()
+
+    def test_iterate(self):
+        self.iterate()
+
+    def test_cascade(self):
+        self.cascade()
+
     def test_reverse_foreign_keys(self):
         self.reverse_foreign_keys()
+
+    def test_atomic_updates(self):
+        self.atomic_updates()
+
+    def test_plain_documents(self):
+        model = self.db.create(Counter, id='a', tags=['a'], labels={'a'})
+        model.tags.append('b')
+        self.db.save(model)
+        # the stored containers aren't attached to the model
+        document = self.db.models[Counter]['a']
+        self.assertIs(type(document['tags']), list)
+        self.assertIs(type(document['labels']), set)
+        model.tags.append('c')
+        self.assertEqual(document['tags'], ['a', 'b'])
+
+
+class TestDurableMemoryDatabase(TestMemoryDatabase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = self.directory.name
+        # compact often so snapshots are exercised by the generic tests
+        self.db = self.database(self.path, snapshot_every=5)
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def reopen(self, **kwargs):
+        self.db.close()
+        self.db = self.database(self.path, **kwargs)
+
+    def test_persistence(self):
+        self.reopen(snapshot_every=None)
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(5)])
+        self.db.create(User, id='a', email='a@example.com', tags={'red'})
+        self.db.create(Score, id='a', value=3, created=datetime(2020, 1, 1))
+        model = self.db.load(ModelB, '1')
+        model.value = 'changed'
+        self.db.save(model, partial=True)
+        self.db.delete_keys(ModelB, ['2', '3'])
+        self.db.update_key(Score, 'a', 'value', 'increment', 2)
+        self.db.update_key(User, 'a', 'tags', 'add', 'blue')
+
+        # nothing has been snapshotted, so everything is replayed from the log
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'snapshot')))
+        self.reopen()
+        self.assertEqual(self.db.load(ModelB, '1').value, 'changed')
+        self.assertEqual(self.db.load_many(ModelB, ['0', '2', '3', '4'], ignore_missing=True)[1:3], [None, None])
+        # indexes are rebuilt
+        self.assertEqual(self.db.find_keys(User, tags='red'), ['a'])
+        self.assertEqual(self.db.find_keys(User, tags='blue'), ['a'])
+        self.assertEqual(self.db.range_keys(Score, 'value', min=5), ['a'])
+
+        # the snapshot replaces the log
+        self.db.snapshot()
+        self.assertEqual(os.path.getsize(os.path.join(self.path, 'log')), 0)
+        self.db.create(ModelB, id='5', value='5')
+        self.reopen()
+        self.assertEqual(sorted(model.id for model in self.db.iterate(ModelB)), ['0', '1', '4', '5'])
+        self.assertEqual(self.db.find_one(User, email='a@example.com').id, 'a')
+
+    def test_compaction(self):
+        for i in range(12):
+            self.db.create(ModelB, id=str(i), value=str(i))
+        # the log is emptied every 5 operations
+        self.assertEqual(self.db.journal.records, 2)
+        self.reopen()
+        self.assertEqual(len(list(self.db.iterate(ModelB))), 12)
+
+    def test_partial_record(self):
+        self.db.create(ModelB, id='a', value='a')
+        self.db.create(ModelB, id='b', value='b')
+        self.db.close()
+
+        # simulate a crash part way through writing the last record
+        log = os.path.join(self.path, 'log')
+        size = os.path.getsize(log)
+        with open(log, 'r+b') as f:
+            f.truncate(size - 3)
+
+        self.reopen()
+        self.assertEqual(self.db.load(ModelB, 'a').value, 'a')
+        self.assertIsNone(self.db.load_many(ModelB, ['b'], ignore_missing=True)[0])
+        # new records are written after the last complete record
+        self.db.create(ModelB, id='c', value='c')
+        self.reopen()
+        self.assertEqual(sorted(model.id for model in self.db.iterate(ModelB)), ['a', 'c'])
+
+    def test_fsync(self):
+        for fsync in ['never', 50]:
+            self.reopen(fsync=fsync)
+            self.db.create(ModelB, id=str(fsync), value='a')
+        self.reopen()
+        self.assertEqual(len(list(self.db.iterate(ModelB))), 2)
+
+        with self.assertRaises(ValueError):
+            MemoryDatabase(self.path, fsync='sometimes')
+
+    def test_fsync_interval(self):
+        self.reopen(fsync=200)
+        journal = self.db.journal
+        synced = journal._synced
+        self.db.create(ModelB, id='a', value='a')
+        self.db.create(ModelB, id='b', value='b')
+        # the last records are flushed once the interval passes, without waiting for another write
+        self.assertTrue(journal._unsynced)
+        for i in range(200):
+            if not journal._unsynced:
+                break
+            sleep(0.01)
+        self.assertFalse(journal._unsynced)
+        self.assertGreater(journal._synced, synced)
+        self.assertIsNone(journal._timer)
+
+
+class TestConcurrentMemoryDatabase(TestMemoryDatabase):
+    database = ConcurrentMemoryDatabase
+
+    def run_threads(self, target, count=8):
+        errors = []
+        def run(index):
+            try:
+                target(index)
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=run, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_threads(self):
+        def work(thread):
+            for i in range(20):
+                self.db.save_many([ModelB(self.db, id=f'{thread}-{i}-{j}', value=str(j)) for j in range(5)])
+                self.db.load_many(ModelB, [f'{thread}-{i}-{j}' for j in range(5)])
+                self.db.delete_keys(ModelB, [f'{thread}-{i}-0'])
+        self.assertEqual(self.run_threads(work), [])
+        self.assertEqual(len(list(self.db.iterate(ModelB))), 8 * 20 * 4)
+
+    def test_unique_contention(self):
+        # only one of the threads can claim the value
+        errors = self.run_threads(lambda thread: self.db.create(User, id=str(thread), email='a@example.com'))
+        self.assertEqual(len(errors), 7)
+        self.assertEqual(len(self.db.find_keys(User, email='a@example.com')), 1)
+
+    def test_cascade_contention(self):
+        self.db.save_many([ModelB(self.db, id=str(i)) for i in range(50)])
+        self.db.save_many([ModelA(self.db, id=str(i), keys=[str(i)]) for i in range(50)])
+        # each parent is deleted with its child, while other threads read them
+        def work(thread):
+            for i in range(thread, 50, 8):
+                self.db.delete(self.db.load(ModelA, str(i)))
+                self.db.load_many(ModelB, [str(i) for i in range(50)], ignore_missing=True)
+        self.assertEqual(self.run_threads(work), [])
+        self.assertEqual(list(self.db.iterate(ModelA)) + list(self.db.iterate(ModelB)), [])
+
+    def test_update_contention(self):
+        self.db.create(Counter, id='a')
+        # concurrent updates aren't lost
+        def work(thread):
+            for i in range(25):
+                self.db.update_key(Counter, 'a', 'count', 'increment', 1)
+                self.db.update_key(Counter, 'a', 'tags', 'append', str(thread))
+        self.assertEqual(self.run_threads(work), [])
+        counter = self.db.load(Counter, 'a')
+        self.assertEqual((counter.count, len(counter.tags)), (200, 200))
+
+
+class TestDurableConcurrentMemoryDatabase(TestDurableMemoryDatabase):
+    database = ConcurrentMemoryDatabase
+
+    def test_threads(self):
+        def work(thread):
+            self.db.save_many([ModelB(self.db, id=f'{thread}-{i}', value=str(i)) for i in range(20)])
+        threads = [Thread(target=work, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.reopen()
+        self.assertEqual(len(list(self.db.iterate(ModelB))), 160)
@@ -2,7 +2,7 @@ import unittest
 import string
 from secrets import choice
 from modelus import *
-from models import Complex, ModelA, ModelB, KEY_LENGTH
+from models import Complex, ModelA, ModelB, User, KEY_LENGTH
 from ipaddress import IPv4Address
 
 class TestModels(unittest.TestCase):
@@ -87,3 +87,195 @@ class TestModels(unittest.TestCase):
         d = testb_c.data
         self.assertEqual(d['id'], 'c')
         self.assertEqual(d['value'], 'c')
+
+    def test_validator_cached(self):
+        # validators are compiled once per class and re-used between instances
+        model_a = ModelB(None, id='a', value='a')
+        model_b = ModelB(None, id='b', value='b')
+        self.assertIs(model_a.validator, model_b.validator)
+        self.assertIs(model_a.validator, ModelB.compiled_validator())
+        self.assertIsNot(ModelA.compiled_validator(), ModelB.compiled_validator())
+
+        # each thread gets its own validator
+        from threading import Thread
+        validators = []
+        thread = Thread(target=lambda: validators.append(ModelB.compiled_validator()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(validators[0], ModelB.compiled_validator())
+
+    def test_validator_cache_size(self):
+        from itertools import combinations
+        from modelus.model import VALIDATORS_SIZE
+        class Wide(Model):
+            id = Field(String, primary_key=True)
+            a, b, c, d, e, f, g, h = [Field(Integer) for _ in range(8)]
+
+        validator = Wide.compiled_validator()
+        # a validator is compiled for each set of fields, but only the most recently used are kept
+        for count in range(1, 9):
+            for fields in combinations('abcdefgh', count):
+                Wide.compiled_validator(fields)
+                Wide.compiled_validator()
+        self.assertEqual(len(Wide._validators.validators), VALIDATORS_SIZE)
+        self.assertIs(Wide.compiled_validator(), validator)
+
+    def test_validator_invalidate(self):
+        class Invalidated(Model):
+            id = Field(String, primary_key=True)
+            value = Field(String)
+
+        validator = Invalidated.compiled_validator()
+        Invalidated.schema['value']['maxlength'] = 1
+        Invalidated.invalidate_validator()
+        self.assertIsNot(validator, Invalidated.compiled_validator())
+
+        with self.assertRaises(ValueError):
+            Invalidated(None, id='a', value='too long').data
+
+    def test_dirty(self):
+        model = ModelB(None, id='a', value='a')
+        # models that haven't been loaded or saved are entirely dirty
+        self.assertEqual(model.dirty, {'id', 'value'})
+
+        model.mark_clean()
+        self.assertEqual(model.dirty, set())
+        model.value = 'b'
+        self.assertEqual(model.dirty, {'value'})
+
+        # only the dirty fields are included in a partial document
+        self.assertEqual(model.document(partial=True), {'value': 'b'})
+        self.assertEqual(model.data, {'id': 'a', 'value': 'b'})
+
+    def test_ordered_types(self):
+        with self.assertRaises(TypeError):
+            Field(String, ordered=True)
+        with self.assertRaises(TypeError):
+            Field(List(Integer), ordered=True)
+
+    def test_compact(self):
+        class Compact(Model, compact=True):
+            id = Field(String, primary_key=True)
+            value = Field(Integer)
+            items = Field(List(String))
+
+        model = Compact(None, id='a', value=1, items=['x'])
+        # compact models don't have an instance dict
+        self.assertFalse(hasattr(model, '__dict__'))
+        with self.assertRaises(AttributeError):
+            model.unknown = 'a'
+
+        self.assertEqual(model.primary_key, 'a')
+        self.assertEqual(model.value, 1)
+        self.assertEqual(model.data, {'id': 'a', 'value': 1, 'items': ['x']})
+        self.assertEqual(model.dirty, {'id', 'value', 'items'})
+
+        model.mark_clean()
+        model.value = 2
+        self.assertEqual(model.document(partial=True), {'value': 2})
+
+        # unset fields aren't included in the data
+        model = Compact(None, id='b')
+        self.assertEqual(dict(model._data), {'id': 'b'})
+        with self.assertRaises(ValueError):
+            Compact(None, id='c', value='not an integer').data
+
+    def test_from_document(self):
+        class Trusted(Model):
+            id = Field(String, primary_key=True)
+            value = Field(Integer)
+            items = Field(List(String))
+
+        class Compact(Model, compact=True):
+            id = Field(String, primary_key=True)
+            value = Field(Integer)
+            items = Field(List(String))
+
+        for cls in [Trusted, Compact]:
+            # the document isn't validated when the model is created
+            model = cls.from_document(None, {'id': 'a', 'value': 'not an integer'})
+            self.assertEqual(model.dirty, set())
+            self.assertEqual(model.value, 'not an integer')
+
+            # only the changed fields are validated
+            self.assertEqual(model.data, {'id': 'a', 'value': 'not an integer'})
+            model.items = ['x']
+            self.assertEqual(model.data, {'id': 'a', 'value': 'not an integer', 'items': ['x']})
+            model.items = [1]
+            with self.assertRaises(ValueError):
+                model.data
+
+            # every field is validated when requested
+            model = cls.from_document(None, {'id': 'a', 'value': 'not an integer'})
+            with self.assertRaises(ValueError):
+                model.validate()
+            cls.revalidate = True
+            try:
+                with self.assertRaises(ValueError):
+                    model.data
+            finally:
+                del cls.revalidate
+
+    def test_tracked_containers(self):
+        from copy import copy, deepcopy
+        model = Complex(None, id='a', list=['x'])
+        model.mark_clean()
+
+        # reading a container doesn't mark it dirty, and returns the same container
+        self.assertIs(model.list, model.list)
+        self.assertEqual(model.dirty, set())
+
+        model.list.append('y')
+        self.assertEqual(model.dirty, {'list'})
+        self.assertEqual(model.document(partial=True), {'list': ['x', 'y']})
+
+        # copies aren't attached to the model
+        for copied in [copy(model.list), deepcopy(model.list), list(model.list)]:
+            self.assertIs(type(copied), list)
+        model.mark_clean()
+        copy(model.list).append('z')
+        self.assertEqual(model.dirty, set())
+
+        model = User(None, id='a', tags={'x'})
+        model.mark_clean()
+        model.tags.discard('x')
+        self.assertEqual(model.dirty, {'tags'})
+        model.mark_clean()
+        model.tags |= {'y'}
+        self.assertEqual(model.tags, {'y'})
+        self.assertEqual(model.dirty, {'tags'})
+
+    def test_foreign_keys_resolved_once(self):
+        loads = []
+        class Database(object):
+            def load(self, cls, key):
+                loads.append(key)
+                return cls(self, id=key)
+
+        db = Database()
+        model = ModelA(db, id='a', keys=['b', 'c'])
+        for _ in range(3):
+            self.assertEqual([key.id for key in model.keys], ['b', 'c'])
+        self.assertEqual(loads, ['b', 'c'])
+
+        # appended keys are resolved when the field is next read
+        model.keys.append('d')
+        self.assertEqual([key.id for key in model.keys], ['b', 'c', 'd'])
+        self.assertEqual(loads, ['b', 'c', 'd'])
+
+    def test_foreign_keys_kept_on_save(self):
+        from modelus.backends.memory import MemoryDatabase
+        db = MemoryDatabase()
+        testbs = [db.create(ModelB, id=str(i), value=str(i)) for i in range(5)]
+        testa = db.create(ModelA, id='a', keys=testbs)
+        loaded = db.load(ModelA, 'a', prefetch='keys')
+        db.save(loaded)
+
+        calls = []
+        load_documents = db.load_documents
+        db.load_documents = lambda cls, ids: calls.append(ids) or load_documents(cls, ids)
+        # saving doesn't replace the models with their primary keys
+        self.assertEqual(testa.keys, testbs)
+        self.assertIs(testa.keys[0], testbs[0])
+        self.assertEqual([key.id for key in loaded.keys], ['0', '1', '2', '3', '4'])
+        self.assertEqual(calls, [])
@@ -3,8 +3,11 @@ import string
 from secrets import choice
 from modelus import *
 from modelus.backends.redis import RedisDatabase
-from redis_mock import Redis
+from fakeredis import FakeRedis as Redis
 from backend import TestBackend
+from threading import Thread
+from modelus.instrumentation import Aggregator
+from models import Complex, Counter, ModelA, ModelB, ModelC, User, Score, Record
 
 class TestRedisDatabase(TestBackend):
     def setUp(self):
@@ -23,6 +26,98 @@ class TestRedisDatabase(TestBackend):
     def test_foreign_keys(self):
         self.foreign_keys()
 
-    @unittest.skip('Reverse foreign keys not implemented')
+    def test_partial_save(self):
+        self.partial_save()
+
+    def test_batch(self):
+        self.batch()
+
+    def test_prefetch(self):
+        self.prefetch()
+
+    def test_indexes(self):
+        self.indexes()
+
+    def test_ordered(self):
+        self.ordered()
+
+    def test_iterate(self):
+        self.iterate()
+
+    def test_cascade(self):
+        self.cascade()
+
     def test_reverse_foreign_keys(self):
         self.reverse_foreign_keys()
+
+    def test_atomic_updates(self):
+        self.atomic_updates()
+
+    def test_update_contention(self):
+        self.db.create(Counter, id='a')
+        self.db.create(Score, id='a', value=0)
+        # ordered fields are updated in a watched transaction, which is retried if the model changes
+        def work():
+            for i in range(25):
+                self.db.update_key(Counter, 'a', 'count', 'increment', 1)
+                self.db.update_key(Score, 'a', 'value', 'increment', 1)
+        threads = [Thread(target=work) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.db.load(Counter, 'a').count, 100)
+        self.assertEqual(self.db.load(Score, 'a').value, 100)
+        self.assertEqual(self.db.range_keys(Score, 'value', min=100), ['a'])
+
+    def test_save_contention(self):
+        other = RedisDatabase(self.redis, blob_models=self.db.blob_models)
+        self.db.create(User, id='a', tags={'red'})
+        read = self.db._read_indexes
+        def interleave(*args):
+            # another client saves between the indexes being read and written
+            self.db._read_indexes = read
+            result = read(*args)
+            other.create(User, id='b', email='b@example.com')
+            other.save(User(other, id='a', tags={'blue'}), partial=True)
+            return result
+        self.db._read_indexes = interleave
+
+        # the save is retried, so sees the value which has been claimed
+        with self.assertRaises(ValueError):
+            self.db.save(User(self.db, id='a', email='b@example.com', tags={'green'}), partial=True)
+        self.assertEqual(self.db.find_keys(User, email='b@example.com'), ['b'])
+        self.assertEqual(self.db.find_keys(User, tags='blue'), ['a'])
+
+        self.db._read_indexes = interleave
+        self.db.save(User(self.db, id='a', tags={'green'}), partial=True)
+        self.assertEqual(self.db.find_keys(User, tags='blue'), [])
+        self.assertEqual(self.db.find_keys(User, tags='green'), ['a'])
+
+    def test_update_round_trips(self):
+        db = RedisDatabase(self.redis)
+        counter = db.create(Counter, id='a')
+        db.increment(counter, 'count')
+        db.instrument = aggregator = Aggregator()
+        # fields without an index are updated by a single script
+        db.increment(counter, 'count')
+        db.append(counter, 'tags', 'a', 'b')
+        self.assertEqual(aggregator.report()['Counter']['update_key']['round_trips'], 2)
+        self.assertEqual(self.redis.hget('Counter::a', 'count'), b'2')
+
+
+class TestRedisBlobDatabase(TestRedisDatabase):
+    def setUp(self):
+        self.redis = Redis()
+        self.db = RedisDatabase(self.redis, blob_models=[Complex, Counter, ModelA, ModelB, ModelC, User, Score, Record])
+
+    def test_blob(self):
+        model = self.db.create(ModelA, id='a', keys=[self.db.create(ModelB, id='b', value='b')])
+        # each model is a single string
+        self.assertEqual(self.redis.type('ModelA::a'), b'string')
+        self.assertEqual(self.redis.keys('ModelA::*'), [b'ModelA::a'])
+
+        model.keys = []
+        model.keys.append(ModelB(self.db, id='b'))
+        self.db.save(model, partial=True)
+        self.assertEqual([key.id for key in self.db.load(ModelA, 'a').keys], ['b'])
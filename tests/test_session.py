@@ -0,0 +1,148 @@
+import unittest
+from modelus import *
+from modelus.backends.memory import MemoryDatabase
+from modelus.backends.session import Session
+from models import ModelA, ModelB, User, Score
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.session = Session(self.db)
+
+    def tearDown(self):
+        self.db = None
+        self.session = None
+
+    def count_calls(self, name):
+        calls = []
+        method = getattr(self.db, name)
+        def counted(*args, **kwargs):
+            calls.append(args)
+            return method(*args, **kwargs)
+        setattr(self.db, name, counted)
+        return calls
+
+    def test_identity_map(self):
+        testb = self.db.create(ModelB, id='a', value='a')
+        self.db.create(ModelA, id='a', keys=[testb])
+        self.db.create(ModelA, id='b', keys=[testb])
+        calls = self.count_calls('load_documents')
+
+        modelas = self.session.load_many(ModelA, ['a', 'b'])
+        # the same child is only loaded once
+        self.assertIs(modelas[0].keys[0], modelas[1].keys[0])
+        self.assertIs(self.session.load(ModelB, 'a'), modelas[0].keys[0])
+        self.assertIs(self.session.load(ModelA, 'a'), modelas[0])
+        self.assertEqual(len(calls), 2)
+
+        with self.assertRaises(ValueError):
+            self.session.load(ModelB, 'missing')
+
+    def test_flush(self):
+        calls = self.count_calls('save_many')
+
+        testb_a = self.session.create(ModelB, id='a', value='a')
+        testb_b = self.session.create(ModelB, id='b', value='b')
+        testa = self.session.create(ModelA, id='a', keys=[testb_a, testb_b])
+        testb_a.value = 'changed'
+        self.session.save(testb_a)
+
+        # nothing is written until flushed
+        with self.assertRaises(ValueError):
+            self.db.load(ModelB, 'a')
+
+        self.session.flush()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.db.load(ModelB, 'a').value, 'changed')
+        self.assertEqual(self.db.load(ModelA, 'a').data['keys'], ['a', 'b'])
+
+        # deletes are queued too, and cascade
+        self.session.delete(testa)
+        with self.assertRaises(ValueError):
+            self.session.load(ModelB, 'a')
+        self.assertEqual(self.db.load(ModelB, 'a').value, 'changed')
+
+        self.session.flush()
+        for cls, id in [(ModelA, 'a'), (ModelB, 'a'), (ModelB, 'b')]:
+            with self.assertRaises(ValueError):
+                self.db.load(cls, id)
+
+    def test_context_manager(self):
+        with Session(self.db) as session:
+            session.create(ModelB, id='a', value='a')
+        self.assertEqual(self.db.load(ModelB, 'a').value, 'a')
+
+        # changes are discarded on error
+        with self.assertRaises(RuntimeError):
+            with Session(self.db) as session:
+                session.create(ModelB, id='b', value='b')
+                raise RuntimeError()
+        with self.assertRaises(ValueError):
+            self.db.load(ModelB, 'b')
+
+    def test_failed_flush(self):
+        self.session.create(ModelB, id='a', value=1)
+        with self.assertRaises(ValueError):
+            self.session.flush()
+
+        # the save is still queued
+        model = self.session.load(ModelB, 'a')
+        model.value = 'a'
+        self.session.flush()
+        self.assertEqual(self.db.load(ModelB, 'a').value, 'a')
+
+    def test_iterate(self):
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(5)])
+        loaded = self.session.load(ModelB, '1')
+        self.session.delete_key(ModelB, '2')
+
+        # iterated models go through the identity map
+        models = {model.id: model for model in self.session.iterate(ModelB, batch_size=2)}
+        self.assertIs(models['1'], loaded)
+        self.assertEqual(sorted(models), ['0', '1', '3', '4'])
+
+    def test_queries(self):
+        self.db.create(User, id='a', email='a@example.com', group='x')
+        self.db.create(User, id='b', group='x')
+        self.db.save_many([Score(self.db, id=str(i), value=i) for i in range(5)])
+        testb = self.db.create(ModelB, id='a', value='a')
+        self.db.create(ModelA, id='a', keys=[testb])
+
+        # found models go through the identity map
+        loaded = self.session.load(User, 'a')
+        self.assertIs(self.session.find_one(User, email='a@example.com'), loaded)
+        self.assertEqual([user.id for user in self.session.find(User, group='x')], ['a', 'b'])
+        self.assertEqual([score.id for score in self.session.range(Score, 'value', min=1, max=3)], ['1', '2', '3'])
+        self.assertIs(self.session.load(ModelB, 'a').referrers()[0], self.session.load(ModelA, 'a'))
+
+        # queued deletes are excluded
+        self.session.delete_key(User, 'b')
+        self.session.delete_key(Score, '2')
+        self.assertEqual([user.id for user in self.session.find(User, group='x')], ['a'])
+        self.assertEqual(self.session.range_keys(Score, 'value', min=1, max=3), ['1', '3'])
+
+    def test_flush_references(self):
+        testb = self.db.create(ModelB, id='a', value='a')
+        self.db.create(ModelA, id='a', keys=[testb])
+
+        # the reference is removed before the referenced model is deleted
+        testa = self.session.load(ModelA, 'a')
+        testa.keys = []
+        self.session.save(testa)
+        self.session.delete_key(ModelB, 'a')
+        self.session.flush()
+        self.assertEqual(self.db.load_many(ModelB, ['a'], ignore_missing=True), [None])
+
+        # models which are still referenced cannot be deleted
+        testb = self.db.create(ModelB, id='b', value='b')
+        self.db.create(ModelA, id='b', keys=[testb])
+        self.session.delete_key(ModelB, 'b')
+        with self.assertRaises(TypeError):
+            self.session.flush()
+
+        # the delete is still queued, and is written once the reference is removed
+        testa = self.session.load(ModelA, 'b')
+        testa.keys = []
+        self.session.save(testa)
+        self.session.flush()
+        self.assertEqual(self.db.load_many(ModelB, ['b'], ignore_missing=True), [None])
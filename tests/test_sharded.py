@@ -0,0 +1,147 @@
+import unittest
+from collections import Counter
+from modelus import *
+from modelus.backends.database import IntegrityError
+from modelus.backends.memory import MemoryDatabase
+from modelus.backends.redis import RedisDatabase
+from modelus.backends.sharded import ShardedDatabase, HashRing
+from fakeredis import FakeRedis, FakeServer
+from backend import TestBackend
+from models import ModelA, ModelB, User, Score
+
+class TestShardedDatabase(TestBackend):
+    def setUp(self):
+        self.memories = [MemoryDatabase() for _ in range(3)]
+        self.db = ShardedDatabase(self.memories)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_not_found(self):
+        self.not_found()
+
+    def test_model_and_fields(self):
+        self.model_and_fields()
+
+    def test_foreign_keys(self):
+        self.foreign_keys()
+
+    def test_partial_save(self):
+        self.partial_save()
+
+    def test_batch(self):
+        self.batch()
+
+    def test_prefetch(self):
+        self.prefetch()
+
+    def test_indexes(self):
+        self.indexes()
+
+    def test_ordered(self):
+        self.ordered()
+
+    def test_iterate(self):
+        self.iterate()
+
+    def test_cascade(self):
+        self.cascade()
+
+    def test_reverse_foreign_keys(self):
+        self.reverse_foreign_keys()
+
+    def test_atomic_updates(self):
+        self.atomic_updates()
+
+    def test_ring(self):
+        ring = HashRing(['a', 'b', 'c'])
+        nodes = Counter(ring.node(str(key)) for key in range(3000))
+        # keys are spread across every node
+        self.assertEqual(set(nodes), {'a', 'b', 'c'})
+        self.assertTrue(all(count > 500 for count in nodes.values()))
+
+        # adding a node only moves keys to that node
+        before = {key: ring.node(str(key)) for key in range(3000)}
+        ring.add('d')
+        moved = {key for key in range(3000) if ring.node(str(key)) != before[key]}
+        self.assertTrue(moved)
+        self.assertEqual({ring.node(str(key)) for key in moved}, {'d'})
+
+    def test_distribution(self):
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(100)])
+        # each model is stored in exactly one shard
+        counts = [len(memory.models.get(ModelB, {})) for memory in self.memories]
+        self.assertEqual(sum(counts), 100)
+        self.assertTrue(all(counts))
+        for i in range(100):
+            self.assertIn(str(i), self.db.shard(ModelB, str(i)).models[ModelB])
+
+    def test_cross_shard_references(self):
+        # find models which are stored in different shards
+        children = [ModelB(self.db, id=str(i)) for i in range(20)]
+        self.db.save_many(children)
+        parent = self.db.create(ModelA, id='a', keys=children)
+        self.assertGreater(len({self.db._owner(ModelB, child.id) for child in children} | {self.db._owner(ModelA, 'a')}), 1)
+
+        self.assertEqual([key.id for key in self.db.load(ModelA, 'a').keys], [child.id for child in children])
+        for child in children:
+            with self.assertRaises(IntegrityError):
+                self.db.delete(child)
+        self.db.delete(parent)
+        self.assertEqual(self.db.load_many(ModelB, [child.id for child in children], ignore_missing=True), [None] * 20)
+
+    def test_unique_across_shards(self):
+        self.db.create(User, id='a', email='a@example.com')
+        for id in 'bcdefgh':
+            with self.assertRaises(ValueError):
+                self.db.create(User, id=id, email='a@example.com')
+
+    def test_range_merge(self):
+        self.db.save_many([Score(self.db, id=str(i), value=i % 10) for i in range(30)])
+        loads = []
+        for shard in self.db.shards.values():
+            shard.load_documents = lambda cls, ids: loads.append(ids)
+        # the shards' results are merged by their ordered index values, without loading the models
+        self.assertEqual(self.db.range_keys(Score, 'value', min=8, descending=True, limit=4), ['9', '29', '19', '8'])
+        self.assertEqual(self.db.range_keys(Score, 'value', offset=2, limit=2), ['20', '1'])
+        self.assertEqual(loads, [])
+
+    def test_rebalance(self):
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(100)])
+        self.db.create(ModelA, id='a', keys=[str(i) for i in range(10)])
+        self.db.create(User, id='a', email='a@example.com', tags={'red'})
+
+        memory = MemoryDatabase()
+        self.db.add_shard('3', memory)
+        moved = self.db.rebalance([ModelA, ModelB, User])
+        self.assertEqual(moved, sum(len(instances) for instances in memory.models.values()))
+        self.assertTrue(moved)
+
+        self.assertEqual([model.value for model in self.db.load_many(ModelB, [str(i) for i in range(100)])], [str(i) for i in range(100)])
+        self.assertEqual([key.id for key in self.db.load(ModelA, 'a').keys], [str(i) for i in range(10)])
+        self.assertEqual(self.db.find_keys(User, tags='red'), ['a'])
+        # nothing is moved once the shards are balanced
+        self.assertEqual(self.db.rebalance([ModelA, ModelB, User]), 0)
+
+        # removing a shard moves its models to the others
+        self.assertIs(self.db.remove_shard('3', [ModelA, ModelB, User]), memory)
+        self.assertEqual(memory.models.get(ModelB, {}), {})
+        self.assertEqual(len(self.db.load_many(ModelB, [str(i) for i in range(100)])), 100)
+
+
+class TestShardedRedisDatabase(TestShardedDatabase):
+    def setUp(self):
+        self.memories = None
+        self.db = ShardedDatabase([RedisDatabase(FakeRedis(server=FakeServer())) for _ in range(3)])
+
+    def test_distribution(self):
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(100)])
+        counts = [len(list(self.db.shards[name].scan_keys(ModelB))) for name in self.db.shards]
+        self.assertTrue(all(counts))
+        self.assertEqual(sorted(model.id for model in self.db.iterate(ModelB)), sorted(str(i) for i in range(100)))
+
+    def test_rebalance(self):
+        self.db.save_many([ModelB(self.db, id=str(i), value=str(i)) for i in range(100)])
+        self.db.add_shard('3', RedisDatabase(FakeRedis(server=FakeServer())))
+        self.assertTrue(self.db.rebalance([ModelB]))
+        self.assertEqual([model.value for model in self.db.load_many(ModelB, [str(i) for i in range(100)])], [str(i) for i in range(100)])
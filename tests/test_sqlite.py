@@ -0,0 +1,99 @@
+import os
+import unittest
+from datetime import date, datetime, timezone, timedelta
+from ipaddress import IPv4Address, IPv6Address
+from tempfile import TemporaryDirectory
+from threading import Thread
+from modelus import *
+from modelus.backends.sqlite import SQLiteDatabase
+from backend import TestBackend
+from models import ModelB, User, Score, Record
+
+class TestSQLiteDatabase(TestBackend):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'models.db')
+        self.db = SQLiteDatabase(self.path)
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def test_not_found(self):
+        self.not_found()
+
+    def test_model_and_fields(self):
+        self.model_and_fields()
+
+    def test_foreign_keys(self):
+        self.foreign_keys()
+
+    def test_partial_save(self):
+        self.partial_save()
+
+    def test_batch(self):
+        self.batch()
+
+    def test_prefetch(self):
+        self.prefetch()
+
+    def test_indexes(self):
+        self.indexes()
+
+    def test_ordered(self):
+        self.ordered()
+
+    def test_iterate(self):
+        self.iterate()
+
+    def test_cascade(self):
+        self.cascade()
+
+    def test_reverse_foreign_keys(self):
+        self.reverse_foreign_keys()
+
+    def test_atomic_updates(self):
+        self.atomic_updates()
+
+    def test_persistence(self):
+        record = Record(self.db,
+            id=1,
+            day=date(2020, 1, 2),
+            created=datetime(2020, 1, 2, 3, 4, 5, 6),
+            address=IPv6Address('::1'),
+            ipv4_address=IPv4Address('127.0.0.1'),
+            ipv6_address=IPv6Address('::2'),
+            days={date(2021, 1, 1), date(2021, 2, 1)},
+            flag=False,
+        )
+        self.db.save(record)
+        self.db.create(User, id='a', email='a@example.com', tags={'red', 'blue'})
+
+        # the models are read back by a new connection
+        self.db.close()
+        self.db = SQLiteDatabase(self.path)
+        self.assertEqual(self.db.load(Record, 1).data, record.data)
+        self.assertEqual(self.db.find_keys(User, tags='red'), ['a'])
+        with self.assertRaises(ValueError):
+            self.db.create(User, id='b', email='a@example.com')
+
+    def test_aware_datetimes(self):
+        # aware datetimes are ordered by the time they represent
+        created = datetime(2020, 1, 1, 12, tzinfo=timezone(timedelta(hours=2)))
+        self.db.create(Score, id='a', created=created)
+        self.db.create(Score, id='b', created=datetime(2020, 1, 1, 11, tzinfo=timezone.utc))
+        self.assertEqual(self.db.range_keys(Score, 'created'), ['a', 'b'])
+        self.assertEqual(self.db.load(Score, 'a').created, created)
+
+    def test_threads(self):
+        def save(thread):
+            self.db.save_many([ModelB(self.db, id=f'{thread}-{i}', value=str(i)) for i in range(50)])
+
+        threads = [Thread(target=save, args=(thread,)) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # each thread used its own connection
+        self.assertEqual(len(self.db._connections), 4)
+        self.assertEqual(len([model for model in self.db.iterate(ModelB)]), 200)
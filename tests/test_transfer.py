@@ -0,0 +1,82 @@
+import io
+import json
+import unittest
+from datetime import date, datetime
+from ipaddress import IPv4Address, IPv6Address
+from modelus import *
+from modelus.backends.memory import MemoryDatabase
+from modelus.transfer import export, import_
+from models import Record, ModelB
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.db.save_many([
+            Record(self.db,
+                id=i,
+                day=date(2020, 1, i + 1),
+                created=datetime(2020, 1, 1, 12, i),
+                address=IPv4Address(f'10.0.0.{i}') if i % 2 else IPv6Address(f'::{i}'),
+                ipv4_address=IPv4Address(f'127.0.0.{i}'),
+                ipv6_address=IPv6Address(f'::{i + 1}'),
+                days={date(2021, 1, i + 1), date(2021, 2, i + 1)},
+                flag=bool(i % 2),
+            )
+            for i in range(10)
+        ])
+        self.db.create(Record, id=10)
+
+    def assertRoundTrip(self, db):
+        for id in range(11):
+            self.assertEqual(db.load(Record, id).data, self.db.load(Record, id).data)
+
+    def test_jsonl(self):
+        stream = io.StringIO()
+        self.assertEqual(export(self.db, Record, stream, batch_size=3), 11)
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(json.loads(lines[0])['day'], '2020-01-01')
+
+        db = MemoryDatabase()
+        stream.seek(0)
+        self.assertEqual(import_(db, Record, stream, batch_size=4), 11)
+        self.assertRoundTrip(db)
+
+    def test_binary(self):
+        stream = io.BytesIO()
+        self.assertEqual(export(self.db, Record, stream, format='binary', batch_size=3), 11)
+
+        db = MemoryDatabase()
+        stream.seek(0)
+        self.assertEqual(import_(db, Record, stream, format='binary', validate=False), 11)
+        self.assertRoundTrip(db)
+
+    def test_workers(self):
+        stream = io.StringIO()
+        export(self.db, Record, stream)
+
+        db = MemoryDatabase()
+        stream.seek(0)
+        self.assertEqual(import_(db, Record, stream, batch_size=5, workers=2), 11)
+        self.assertRoundTrip(db)
+
+    def test_invalid(self):
+        stream = io.StringIO('{"id": "a", "value": "a"}\n{"id": "b", "value": 1}\n')
+        with self.assertRaises(ValidationError) as cm:
+            import_(MemoryDatabase(), ModelB, stream)
+        self.assertEqual(cm.exception.index, 1)
+
+        stream.seek(0)
+        with self.assertRaises(ValidationError) as cm:
+            import_(MemoryDatabase(), ModelB, stream, batch_size=1, workers=2)
+        self.assertEqual(cm.exception.index, 1)
+
+        # unvalidated imports are written as they are
+        db = MemoryDatabase()
+        stream.seek(0)
+        import_(db, ModelB, stream, validate=False)
+        self.assertEqual(db.load(ModelB, 'b').value, 1)
+
+        with self.assertRaises(ValueError):
+            export(db, ModelB, io.StringIO(), format='xml')
@@ -0,0 +1,92 @@
+import pickle
+import unittest
+from modelus import *
+from modelus.backends.memory import MemoryDatabase
+from modelus.validation import pool, validate_many
+from models import Complex, ModelB, Point
+
+class TestValidation(unittest.TestCase):
+    def setUp(self):
+        self.documents = [{'id': str(i), 'value': str(i) if i % 3 else i} for i in range(10)]
+
+    def assertResults(self, results):
+        self.assertEqual(len(results), 10)
+        for index, result in enumerate(results):
+            if index % 3:
+                self.assertEqual(result, {'id': str(index), 'value': str(index)})
+            else:
+                self.assertIsInstance(result, ValidationError)
+                self.assertEqual(result.index, index)
+                self.assertIn('value', result.errors)
+
+    def test_validate_many(self):
+        self.assertResults(validate_many(ModelB, self.documents))
+        # normalised values are returned
+        document = {'id': 'a', 'string': 'a', 'email': 'a@example.com'}
+        self.assertEqual(validate_many(Complex, [document], workers=1), [{**document, 'generated': 'a' * 10}])
+        self.assertEqual(validate_many(ModelB, []), [])
+
+    def test_workers(self):
+        self.assertResults(validate_many(ModelB, self.documents, workers=2))
+        self.assertResults(validate_many(ModelB, self.documents, workers=2, chunk_size=3))
+
+        executor = pool(2, [ModelB])
+        try:
+            self.assertResults(validate_many(ModelB, self.documents, executor=executor, chunk_size=4))
+            self.assertResults(validate_many(ModelB, iter(self.documents), executor=executor))
+        finally:
+            executor.shutdown()
+
+    def test_invalid_rows(self):
+        documents = [
+            {'id': 'a', 'x': 1, 'tags': ['a']},
+            {'id': 'b', 'bogus': 1},
+            {'id': 'c', 'x': 'c'},
+            {'id': 'd', 'tags': 1},
+            {'id': 'e', 'x': 2},
+        ]
+        # rows which can't be set on the model are reported like rows which fail validation
+        for workers in [None, 2]:
+            results = validate_many(Point, documents, workers=workers)
+            self.assertEqual([results[0], results[4]], [documents[0], documents[4]])
+            for index, field in [(1, 'bogus'), (2, 'x'), (3, 'tags')]:
+                self.assertIsInstance(results[index], ValidationError)
+                self.assertEqual(results[index].index, index)
+                self.assertEqual(list(results[index].errors), [field])
+
+    def test_save(self):
+        db = MemoryDatabase()
+        results = validate_many(ModelB, self.documents, workers=2)
+        db.save_many([ModelB.from_document(db, result) for result in results if not isinstance(result, ValidationError)], validate=False)
+        self.assertEqual(sorted(key for keys in db.scan_keys(ModelB) for key in keys), ['1', '2', '4', '5', '7', '8'])
+
+    def test_save_many(self):
+        db = MemoryDatabase()
+        executor = pool(2, [Complex])
+        try:
+            models = [Complex(db, id=str(i), string='a', email='a@example.com') for i in range(3)]
+            db.save_many(models, executor=executor)
+            # the models are normalised
+            self.assertEqual(db.load(Complex, '2').generated, 'a' * 10)
+            self.assertEqual(models[0].generated, 'a' * 10)
+            self.assertEqual(models[0].dirty, set())
+
+            # the first invalid model is raised, and nothing is written
+            models = [Complex(db, id=str(i), string='a', email='a@example.com' if i % 2 else 'invalid') for i in range(3, 7)]
+            with self.assertRaises(ValidationError) as cm:
+                db.save_many(models, workers=2)
+            self.assertEqual(cm.exception.index, 1)
+            self.assertEqual(db.load_many(Complex, ['3'], ignore_missing=True), [None])
+        finally:
+            executor.shutdown()
+
+    def test_error(self):
+        error = ValidationError({'value': ['must be of string type']}, 3)
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(str(error), "{'value': ['must be of string type']}")
+        copy = pickle.loads(pickle.dumps(error))
+        self.assertEqual((copy.errors, copy.index), (error.errors, error.index))
+
+        with self.assertRaises(ValidationError) as cm:
+            ModelB(None, id='a', value=1).validate()
+        self.assertIsNone(cm.exception.index)